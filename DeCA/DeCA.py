@@ -1,4 +1,5 @@
 import os
+import sys
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
@@ -13,6 +14,13 @@ import csv
 import vtk.util.numpy_support as vtk_np
 from pathlib import Path
 import shutil
+import time
+import traceback
+from DeCALib import alignment, closestPoint, correspondence, markupsIO, methodComparison, parallel, procrustes, profiling, referenceFrame, resultCache, tps
+from DeCALib.journal import OutputJournal
+from DeCALib.subjectTracker import SubjectTracker
+from DeCALib.warpCache import WarpedMeshCache
+from DeCALib.workQueue import WorkQueue
 
 #
 # DeCA
@@ -194,6 +202,50 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     self.writeErrorCheckBox.setToolTip("If checked, DeCA will create a directory of results for use in estimating point correspondence error.")
     DeCAWidgetLayout.addRow("Create output for error checking: ", self.writeErrorCheckBox)
 
+    #
+    # Hidden performance options
+    #
+    self.performanceCollapsibleButtonDC = ctk.ctkCollapsibleButton()
+    self.performanceCollapsibleButtonDC.text = "Performance Options"
+    self.performanceCollapsibleButtonDC.collapsed = True
+    DeCAWidgetLayout.addRow(self.performanceCollapsibleButtonDC)
+    performanceOptionLayoutDC = qt.QFormLayout(self.performanceCollapsibleButtonDC)
+
+    #
+    # Parallel workers
+    #
+    self.workerCountDC = qt.QSpinBox()
+    self.workerCountDC.minimum = 0
+    self.workerCountDC.maximum = os.cpu_count() or 1
+    self.workerCountDC.value = 0
+    self.workerCountDC.specialValueText = "All cores"
+    self.workerCountDC.setToolTip("Number of worker processes used for the exact closest-point correspondence query. 0 uses all cores; 1 runs in the Slicer process. Results are identical for any setting.")
+    performanceOptionLayoutDC.addRow("Parallel workers: ", self.workerCountDC)
+
+    #
+    # Parallelize over subjects option
+    #
+    self.parallelSubjectsCheckBoxDC = qt.QCheckBox()
+    self.parallelSubjectsCheckBoxDC.checked = False
+    self.parallelSubjectsCheckBoxDC.setToolTip("If checked, whole subjects are processed concurrently by the worker processes (each worker uses its share of the cores). This is usually faster than parallelizing only the closest-point query, but each worker holds one subject mesh in memory. Rigid alignment and mirroring then also read and write several subjects at a time. Results are identical.")
+    performanceOptionLayoutDC.addRow("Process subjects in parallel: ", self.parallelSubjectsCheckBoxDC)
+
+    #
+    # NumPy thin-plate spline option
+    #
+    self.numpyTPSCheckBoxDC = qt.QCheckBox()
+    self.numpyTPSCheckBoxDC.checked = False
+    self.numpyTPSCheckBoxDC.setToolTip("If checked, the thin-plate spline warps are computed with a vectorized, multithreaded NumPy implementation that factorizes the mean-shape system once per run instead of building VTK transforms for every subject. Results match the VTK warps to floating-point tolerance.")
+    performanceOptionLayoutDC.addRow("Vectorized thin-plate splines: ", self.numpyTPSCheckBoxDC)
+
+    #
+    # Write aligned meshes option
+    #
+    self.writeAlignedModelsCheckBoxDC = qt.QCheckBox()
+    self.writeAlignedModelsCheckBoxDC.checked = True
+    self.writeAlignedModelsCheckBoxDC.setToolTip("If unchecked, the aligned copies of the meshes are not written to alignedModels: each mesh is aligned in memory when the correspondence step reads it, which saves writing and reading back every mesh. The aligned landmarks and the alignment transforms are still written, and results are identical.")
+    performanceOptionLayoutDC.addRow("Write aligned meshes: ", self.writeAlignedModelsCheckBoxDC)
+
     #
     # Run DeCA Button
     #
@@ -345,6 +397,14 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     self.originalFrameCheckBoxDCL.setToolTip("If checked, the generated semi-landmarks (and merged point lists) are also written in the original, un-aligned coordinate frame of each input model, by inverting the alignment that mapped the subject onto the atlas. Saved to 'DeCALOutput_originalFrame' (and 'mergedLMs_originalFrame').")
     DeCALWidgetLayout.addRow("Output landmarks in original frame: ", self.originalFrameCheckBoxDCL)
 
+    #
+    # Also write all correspondences to one HDF5 file
+    #
+    self.correspondenceStoreCheckBoxDCL = qt.QCheckBox()
+    self.correspondenceStoreCheckBoxDCL.checked = False
+    self.correspondenceStoreCheckBoxDCL.setToolTip("If checked, the fixed and semi-landmarks of every subject are also written to one compressed HDF5 file, 'decalCorrespondences.h5' in the output folder, together with the subject names, the atlas points, which points are fixed or semi-landmarks and the run settings. It can be read in Python (h5py) or R (rhdf5, hdf5r) without loading the point lists one by one. Requires h5py, which is installed if missing.")
+    DeCALWidgetLayout.addRow("Write correspondence store: ", self.correspondenceStoreCheckBoxDCL)
+
     #
     # Fast (approximate) correspondence option -- DeCAL only, off by default
     #
@@ -353,6 +413,110 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     self.fastCorrespondenceCheckBoxDCL.setToolTip("Off (default) uses the canonical exact closest-point-on-surface correspondence, matching the published DeCA method. If checked, DeCAL computes correspondences with a much faster approximate method that snaps each point to the nearest mesh vertex instead of the exact closest point on the surface; on dense meshes the difference is typically a few hundredths of a millimeter. The atlas/template is always built with the exact method, and this option does not affect the DeCA tab.")
     DeCALWidgetLayout.addRow("Compute fast correspondences: ", self.fastCorrespondenceCheckBoxDCL)
 
+    #
+    # Hybrid correspondence option
+    #
+    self.hybridCorrespondenceCheckBoxDCL = qt.QCheckBox()
+    self.hybridCorrespondenceCheckBoxDCL.checked = False
+    self.hybridCorrespondenceCheckBoxDCL.setToolTip("If checked, DeCAL finds each point's nearest mesh vertex as the fast method does and then projects it onto the triangles around that vertex and onto every other triangle close enough to hold a nearer point, falling back to the full exact search where there are too many of those. Results match the exact method; the search is vectorized and multithreaded, so it pays off mainly with several cores. Overrides the fast option.")
+    DeCALWidgetLayout.addRow("Compute hybrid correspondences: ", self.hybridCorrespondenceCheckBoxDCL)
+
+    #
+    # Calibrated fast correspondence option
+    #
+    self.calibrateFastCheckBoxDCL = qt.QCheckBox()
+    self.calibrateFastCheckBoxDCL.checked = False
+    self.calibrateFastCheckBoxDCL.setToolTip("With fast or hybrid correspondences, also recompute 20 specimens spread over the size range with the exact method and estimate the small measurement error of the fast method from them. The estimate and the Procrustes variance and distances corrected for it are saved to a fastCalibration folder in the output, so absolute disparity can be reported from a fast run.")
+    DeCALWidgetLayout.addRow("Calibrate fast correspondences: ", self.calibrateFastCheckBoxDCL)
+
+    #
+    # Hidden performance options
+    #
+    self.performanceCollapsibleButtonDCL = ctk.ctkCollapsibleButton()
+    self.performanceCollapsibleButtonDCL.text = "Performance Options"
+    self.performanceCollapsibleButtonDCL.collapsed = True
+    DeCALWidgetLayout.addRow(self.performanceCollapsibleButtonDCL)
+    performanceOptionLayoutDCL = qt.QFormLayout(self.performanceCollapsibleButtonDCL)
+
+    #
+    # Parallel workers
+    #
+    self.workerCountDCL = qt.QSpinBox()
+    self.workerCountDCL.minimum = 0
+    self.workerCountDCL.maximum = os.cpu_count() or 1
+    self.workerCountDCL.value = 0
+    self.workerCountDCL.specialValueText = "All cores"
+    self.workerCountDCL.setToolTip("Number of worker processes used for the exact closest-point correspondence query (atlas build and DeCAL). 0 uses all cores; 1 runs in the Slicer process. Results are identical for any setting.")
+    performanceOptionLayoutDCL.addRow("Parallel workers: ", self.workerCountDCL)
+
+    #
+    # Parallelize over subjects option
+    #
+    self.parallelSubjectsCheckBoxDCL = qt.QCheckBox()
+    self.parallelSubjectsCheckBoxDCL.checked = False
+    self.parallelSubjectsCheckBoxDCL.setToolTip("If checked, whole subjects (mesh load, warps and correspondence query) are processed concurrently by the worker processes, largest mesh first, and each worker uses its share of the cores. This is usually faster than parallelizing only the closest-point query, but each worker holds one subject mesh in memory. Rigid alignment then also reads and writes several subjects at a time. Results are identical.")
+    performanceOptionLayoutDCL.addRow("Process subjects in parallel: ", self.parallelSubjectsCheckBoxDCL)
+
+    #
+    # NumPy thin-plate spline option
+    #
+    self.numpyTPSCheckBoxDCL = qt.QCheckBox()
+    self.numpyTPSCheckBoxDCL.checked = False
+    self.numpyTPSCheckBoxDCL.setToolTip("If checked, the thin-plate spline warps are computed with a vectorized, multithreaded NumPy implementation that factorizes the mean-shape system once per run instead of building VTK transforms for every subject. Results match the VTK warps to floating-point tolerance.")
+    performanceOptionLayoutDCL.addRow("Vectorized thin-plate splines: ", self.numpyTPSCheckBoxDCL)
+
+    #
+    # Write aligned meshes option
+    #
+    self.writeAlignedModelsCheckBoxDCL = qt.QCheckBox()
+    self.writeAlignedModelsCheckBoxDCL.checked = True
+    self.writeAlignedModelsCheckBoxDCL.setToolTip("If unchecked, the aligned copies of the meshes are not written to alignedModels: each mesh is aligned in memory when the correspondence step reads it, which saves writing and reading back every mesh. The aligned landmarks and the alignment transforms are still written, and results are identical.")
+    performanceOptionLayoutDCL.addRow("Write aligned meshes: ", self.writeAlignedModelsCheckBoxDCL)
+
+    #
+    # Warped mesh cache option
+    #
+    self.warpCacheCheckBoxDCL = qt.QCheckBox()
+    self.warpCacheCheckBoxDCL.checked = False
+    self.warpCacheCheckBoxDCL.setToolTip("If checked, every subject mesh warped onto the mean shape is kept in Slicer's cache folder and reused by later runs with the same subject, landmarks and mean shape (for example after changing the point spacing or the selected points). Older entries are removed once the cache exceeds 4 GB. Results are identical.")
+    performanceOptionLayoutDCL.addRow("Cache warped meshes between runs: ", self.warpCacheCheckBoxDCL)
+
+    #
+    # Correspondence result cache option
+    #
+    self.resultCacheCheckBoxDCL = qt.QCheckBox()
+    self.resultCacheCheckBoxDCL.checked = False
+    self.resultCacheCheckBoxDCL.setToolTip("If checked, every subject's corresponding points are also kept in Slicer's cache folder under a hash of the subject's inputs, atlas, mean shape and method, so a later run with the same inputs (also into another output folder) reuses them instead of recomputing. Older entries are removed once the cache exceeds the size below. Results are identical.")
+    performanceOptionLayoutDCL.addRow("Cache correspondences between runs: ", self.resultCacheCheckBoxDCL)
+
+    self.resultCacheSizeDCL = qt.QSpinBox()
+    self.resultCacheSizeDCL.minimum = 1
+    self.resultCacheSizeDCL.maximum = 1024
+    self.resultCacheSizeDCL.value = 16
+    self.resultCacheSizeDCL.suffix = " GB"
+    self.resultCacheSizeDCL.setToolTip("Size above which the least recently used correspondences are removed from the cache.")
+    performanceOptionLayoutDCL.addRow("Correspondence cache size: ", self.resultCacheSizeDCL)
+
+    self.clearResultCacheButtonDCL = qt.QPushButton("Clear correspondence cache")
+    self.clearResultCacheButtonDCL.toolTip = "Remove every correspondence kept in Slicer's cache folder by earlier runs"
+    performanceOptionLayoutDCL.addRow(self.clearResultCacheButtonDCL)
+
+    #
+    # Verify resumed output option
+    #
+    self.verifyOutputCheckBoxDCL = qt.QCheckBox()
+    self.verifyOutputCheckBoxDCL.checked = False
+    self.verifyOutputCheckBoxDCL.setToolTip("If checked, subjects already completed in the output folder are only skipped if their file still matches the checksum recorded when it was written; otherwise completed subjects are skipped after a lookup in the folder's journal.")
+    performanceOptionLayoutDCL.addRow("Verify existing output on resume: ", self.verifyOutputCheckBoxDCL)
+
+    #
+    # Profiling trace option
+    #
+    self.profileTraceCheckBoxDCL = qt.QCheckBox()
+    self.profileTraceCheckBoxDCL.checked = False
+    self.profileTraceCheckBoxDCL.setToolTip("If checked, the time each subject spends in every stage (mesh load, forward TPS, locator build, query, inverse TPS, write) is recorded and saved as decalTrace.json in the output folder, which chrome://tracing or Perfetto can display. Stage totals are shown in the log.")
+    performanceOptionLayoutDCL.addRow("Write a profiling trace: ", self.profileTraceCheckBoxDCL)
+
     #
     # Apply Button
     #
@@ -411,6 +575,14 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     self.DCLLandmarkDirectory.setToolTip("Select directory for DeCAL sampled landmarks to subset")
     DeCALSubsetLayout.addRow("DeCAL landmark directory: ", self.DCLLandmarkDirectory)
 
+    #
+    # Restrict the next DeCAL run to the selected points
+    #
+    self.restrictToSelectionCheckBox = qt.QCheckBox()
+    self.restrictToSelectionCheckBox.checked = False
+    self.restrictToSelectionCheckBox.setToolTip("If checked, the next DeCAL run computes and writes only the points selected in the atlas landmarks above, instead of subsetting the full output afterwards. The atlas point set must come from a run with the same point density.")
+    DeCALSubsetLayout.addRow("Compute selected points only: ", self.restrictToSelectionCheckBox)
+
     #
     # Apply Subsetting Button
     #
@@ -419,6 +591,54 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     self.subsetApplyButton.enabled = False
     DeCALSubsetLayout.addRow(self.subsetApplyButton)
 
+    #
+    # Append menu
+    #
+    self.appendCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.appendCollapsibleButton.text = "Append specimens to an existing run"
+    self.appendCollapsibleButton.collapsed = True
+    self.appendCollapsibleButton.enabled = True
+    DeCALWidgetLayout.addRow(self.appendCollapsibleButton)
+    DeCALAppendLayout = qt.QFormLayout(self.appendCollapsibleButton)
+
+    #
+    # Select DeCAL run directory
+    #
+    self.appendRunDirectoryDCL=ctk.ctkPathLineEdit()
+    self.appendRunDirectoryDCL.filters = ctk.ctkPathLineEdit.Dirs
+    self.appendRunDirectoryDCL.setToolTip("Select the timestamped folder of an earlier DeCAL run. Specimens in the mesh and landmark directories above that are not yet in its output are aligned to its atlas and put into correspondence in its frozen reference frame (mean shape, warped atlas and point set), so existing output stays valid. Run DeCAL again to refreeze the frame and recompute every specimen.")
+    DeCALAppendLayout.addRow("DeCAL run directory: ", self.appendRunDirectoryDCL)
+
+    #
+    # Apply Append Button
+    #
+    self.appendApplyButtonDCL = qt.QPushButton("Append new specimens")
+    self.appendApplyButtonDCL.toolTip = "Compute corresponding landmarks for new specimens in the frame of an existing run"
+    self.appendApplyButtonDCL.enabled = False
+    DeCALAppendLayout.addRow(self.appendApplyButtonDCL)
+
+    #
+    # Compare correspondence methods Area
+    #
+    self.compareCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.compareCollapsibleButton.text = "Compare exact and fast correspondence"
+    self.compareCollapsibleButton.collapsed = True
+    self.compareCollapsibleButton.enabled = True
+    DeCALWidgetLayout.addRow(self.compareCollapsibleButton)
+    DeCALCompareLayout = qt.QFormLayout(self.compareCollapsibleButton)
+
+    self.compareSubjectCountDCL = qt.QSpinBox()
+    self.compareSubjectCountDCL.minimum = 3
+    self.compareSubjectCountDCL.maximum = 10000
+    self.compareSubjectCountDCL.value = 20
+    self.compareSubjectCountDCL.setToolTip("Number of specimens, spread evenly over the input, to run through both correspondence methods. 15-25 specimens spanning the size range are usually enough.")
+    DeCALCompareLayout.addRow("Specimens to compare: ", self.compareSubjectCountDCL)
+
+    self.compareApplyButtonDCL = qt.QPushButton("Compare methods")
+    self.compareApplyButtonDCL.toolTip = "Run the exact and the fast correspondence on a subset of the specimens and write their agreement (Procrustes distance, centroid size and PC score correlations, joint-GPA differences) and timings as tables and figures to a methodComparison folder in the output"
+    self.compareApplyButtonDCL.enabled = False
+    DeCALCompareLayout.addRow(self.compareApplyButtonDCL)
+
     # connections
     self.calculateAtlasOptionDCL.connect('toggled(bool)', self.onToggleAtlasDCL)
     self.loadAtlasOptionDCL.connect('toggled(bool)', self.onToggleAtlasDCL)
@@ -433,6 +653,10 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     self.subsetApplyButton.connect('clicked(bool)', self.onSubsetApplyButton)
     self.pointSelection.connect('currentNodeChanged(vtkMRMLNode*)', self.onPointSelectionSelect)
     self.DCLLandmarkDirectory.connect('validInputChanged(bool)', self.onDCLLandmarkDirectorySelect)
+    self.appendRunDirectoryDCL.connect('validInputChanged(bool)', self.onParameterSelectDCL)
+    self.appendApplyButtonDCL.connect('clicked(bool)', self.onDCLAppendButton)
+    self.compareApplyButtonDCL.connect('clicked(bool)', self.onDCLCompareButton)
+    self.clearResultCacheButtonDCL.connect('clicked(bool)', self.onClearResultCacheButton)
 
     ################################### Visualize Tab ###################################
     # Layout within the tab
@@ -468,61 +692,30 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
 
   ################################### GUI SUpport Functions
   def setUpDeCADir(self, outDir, symmetryOption=False, errorDirectoryOption=False, DeCALOption=False, loadAtlasOption = False):
-    dateTimeStamp = datetime.now().strftime('%Y_%m-%d_%H_%M_%S')
-    outputFolderDC = os.path.join(outDir, dateTimeStamp)
-    fileNameDictionary = {}
-    try:
-      os.makedirs(outputFolderDC)
-      alignedLMFolderDC = os.path.join(outputFolderDC, "alignedLMs")
-      os.makedirs(alignedLMFolderDC)
-      alignedModelFolderDC = os.path.join(outputFolderDC, "alignedModels")
-      os.makedirs(alignedModelFolderDC)
-      # initialize the filename dictionary
-      fileNameDictionary['output'] = str(outputFolderDC)
-      fileNameDictionary['alignedLMs'] = str(alignedLMFolderDC)
-      fileNameDictionary['alignedModels'] = str(alignedModelFolderDC)
-      if not loadAtlasOption:
-        tempLMFolderDC = os.path.join(outputFolderDC, "tempAlignedLMs")
-        os.makedirs(tempLMFolderDC)
-        tempModelFolderDC = os.path.join(outputFolderDC, "tempAlignedModels")
-        os.makedirs(tempModelFolderDC)
-        fileNameDictionary['tempAlignedLMs'] = str(tempLMFolderDC)
-        fileNameDictionary['tempAlignedModels'] = str(tempModelFolderDC)
-      if symmetryOption:
-        mirrorLMFolderDC = os.path.join(outputFolderDC, "mirrorLMs")
-        os.makedirs(mirrorLMFolderDC)
-        mirrorModelFolderDC = os.path.join(outputFolderDC, "mirrorModels")
-        os.makedirs(mirrorModelFolderDC)
-        fileNameDictionary['mirrorLMs'] = str(mirrorLMFolderDC)
-        fileNameDictionary['mirrorModels'] = str(mirrorModelFolderDC)
-      if errorDirectoryOption:
-        errorCheckingFolderDC = os.path.join(outputFolderDC, "errorChecking")
-        os.makedirs(errorCheckingFolderDC)
-        fileNameDictionary['error'] = str(errorCheckingFolderDC)
-      if DeCALOption:
-        DeCALOutputFolder = os.path.join(outputFolderDC, "DeCALOutput")
-        os.makedirs(DeCALOutputFolder)
-        fileNameDictionary['DeCALOutput'] = str(DeCALOutputFolder)
-        # per-subject alignment transforms are saved here so DeCAL output can later
-        # be mapped back into each subject's original (un-aligned) coordinate frame
-        alignmentTransformFolder = os.path.join(outputFolderDC, "alignmentTransforms")
-        os.makedirs(alignmentTransformFolder)
-        fileNameDictionary['alignmentTransforms'] = str(alignmentTransformFolder)
-    except:
-      logging.debug('Result directory failed: Could not create output folder')
-    return fileNameDictionary
+    return DeCALogic().setUpOutputDirectories(outDir, symmetryOption, errorDirectoryOption, DeCALOption)
 
-  def makeProgressCallback(self, progressBar):
+  def makeProgressCallback(self, progressBar, log=None, logInterval=60):
     # Returns a progressCallback(current, total, message) that updates the given
     # QProgressBar and pumps the Qt event loop so the UI stays responsive during
     # long single-threaded per-subject loops (atlas building, dense correspondence)
-    # instead of appearing to stall.
+    # instead of appearing to stall. Updates are throttled to a few per second,
+    # since a refresh per item costs real time on large runs, and show the
+    # throughput and ETA of the current stage; with a log, these are also
+    # appended to it every logInterval seconds.
+    rate = profiling.ProgressRate()
+    lastLogged = [0.0]
     def progressCallback(current, total, message):
       total = max(total, 1)
+      if not rate.update(current, total, message):
+        return
+      rateText = rate.describe(current, total)
       progressBar.minimum = 0
       progressBar.maximum = total
       progressBar.value = current
-      progressBar.setFormat(f"{message}: {current}/{total}")
+      progressBar.setFormat(f"{message}: {current}/{total}" + (f" ({rateText})" if rateText else ""))
+      if log is not None and rateText and current < total and time.monotonic() - lastLogged[0] >= logInterval:
+        lastLogged[0] = time.monotonic()
+        log.appendPlainText(f"{message}: {current}/{total}, {rateText}")
       slicer.app.processEvents()
     return progressCallback
 
@@ -592,6 +785,8 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     atlasPathSelected = bool(self.DCLBaseModelSelector.currentPath and self.DCLBaseLMSelector.currentPath) or self.calculateAtlasOptionDCL.checked
     inputPathsSelected = bool(self.meshDirectoryDCL.currentPath and self.landmarkDirectoryDCL.currentPath and self.OutputDirectoryDCL.currentPath)
     self.getAtlasButton.enabled = bool(atlasPathSelected and inputPathsSelected)
+    frameSelected = bool(self.appendRunDirectoryDCL.currentPath) and os.path.exists(os.path.join(self.appendRunDirectoryDCL.currentPath, "decalReferenceFrame.npz"))
+    self.appendApplyButtonDCL.enabled = bool(frameSelected and self.meshDirectoryDCL.currentPath and self.landmarkDirectoryDCL.currentPath)
 
   def onPointSelectionSelect(self):
     self.subsetApplyButton.enabled = bool(self.DCLLandmarkDirectory.currentPath and self.pointSelection.currentNode())
@@ -631,7 +826,8 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
           return
       else:
         removeScale = True
-        self.atlasModel, self.atlasLMs = self.generateNewAtlas(removeScale, self.logInfoDCL, progressCallback)
+        self.atlasModel, self.atlasLMs = self.generateNewAtlas(removeScale, self.logInfoDCL, progressCallback, self.workerCountDCL.value, self.parallelSubjectsCheckBoxDCL.checked,
+          self.numpyTPSCheckBoxDCL.checked)
       atlasModelPath = os.path.join(self.folderNames['output'], 'decaAtlasModel.ply')
       self.logInfoDCL.appendPlainText(f"Saving atlas model to {atlasModelPath}")
       slicer.util.saveNode(self.atlasModel, atlasModelPath)
@@ -645,33 +841,21 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
       self.getAtlasButton.enabled = True
       self.resetProgressBar(self.progressBarDCL, "Atlas ready" if succeeded else "Idle")
 
-  def generateNewAtlas(self, removeScale, log, progressCallback=None):
+  def generateNewAtlas(self, removeScale, log, progressCallback=None, workers=1, parallelSubjects=False, useNumpyTPS=False):
     logic = DeCALogic()
-    closestToMeanLandmarkPath = logic.getClosestToMeanPath(self.folderNames['originalLMs'])
-    tempBaseLMs = slicer.util.loadMarkups(os.path.join(self.folderNames['originalLMs'],closestToMeanLandmarkPath))
-    subjectID = Path(closestToMeanLandmarkPath)
-    while subjectID.suffix in {'.fcsv', '.mrk', '.json'}:
-      subjectID = subjectID.with_suffix('')
-    log.appendPlainText(f"Sample selected for rigid alignment: {subjectID}")
-    tempBaseModel = logic.getModelFileByID(self.folderNames['originalModels'], subjectID)
     try:
-      logic.runAlign(tempBaseModel, tempBaseLMs, self.folderNames['originalModels'], self.folderNames['originalLMs'], self.folderNames['tempAlignedModels'], self.folderNames['tempAlignedLMs'], removeScale, progressCallback=progressCallback)
+      return logic.runAtlas(self.folderNames['originalModels'], self.folderNames['originalLMs'], removeScale, log, progressCallback,
+        workers=workers, parallelSubjects=parallelSubjects, useNumpyTPS=useNumpyTPS)
     except ValueError as errorText:
       log.appendPlainText(str(errorText))
       return
-    log.appendPlainText(f"Generating the average template")
-    atlasModel, atlasLMs = logic.runMean(self.folderNames['tempAlignedLMs'], self.folderNames['tempAlignedModels'], log, progressCallback)
-    slicer.mrmlScene.RemoveNode(tempBaseModel)
-    slicer.mrmlScene.RemoveNode(tempBaseLMs)
-    shutil.rmtree(self.folderNames['tempAlignedModels'])
-    shutil.rmtree(self.folderNames['tempAlignedLMs'])
-    return atlasModel, atlasLMs
 
   def onGetPointNumberButton(self):
     logic = DeCALogic()
     subsampledTemplate, pointNumber = logic.runCheckPoints(self.atlasModel, self.spacingTolerance.value)
     self.logInfoDCL.appendPlainText(f'The subsampled template has a total of {pointNumber} points.')
     self.DCLApplyButton.enabled = True
+    self.compareApplyButtonDCL.enabled = True
 
   def onDCApplyButton(self):
     if self._busy:
@@ -730,7 +914,8 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
           self.logInfoDC.appendPlainText(f"Can't load landmarks from: {atlasLMPath}")
           return
       else:
-        self.atlasModel, self.atlasLMs = self.generateNewAtlas(removeScaleOption, self.logInfoDC, progressCallback)
+        self.atlasModel, self.atlasLMs = self.generateNewAtlas(removeScaleOption, self.logInfoDC, progressCallback, self.workerCountDC.value, self.parallelSubjectsCheckBoxDC.checked,
+          self.numpyTPSCheckBoxDC.checked)
       # save atlas model and landmarks to output file
       atlasModelPath = os.path.join(self.folderNames['output'], 'decaAtlasModel.ply')
       self.logInfoDC.appendPlainText(f"Saving atlas model to {atlasModelPath}")
@@ -740,7 +925,8 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
       slicer.util.saveNode(self.atlasLMs, atlasLMPath)
       # rigid alignment to atlas
       try:
-        logic.runAlign(self.atlasModel, self.atlasLMs, self.folderNames['originalModels'], self.folderNames['originalLMs'], self.folderNames['alignedModels'], self.folderNames['alignedLMs'], removeScaleOption, progressCallback=progressCallback)
+        logic.runAlign(self.atlasModel, self.atlasLMs, self.folderNames['originalModels'], self.folderNames['originalLMs'], self.folderNames['alignedModels'], self.folderNames['alignedLMs'], removeScaleOption, progressCallback=progressCallback,
+          workers=self.workerCountDC.value if self.parallelSubjectsCheckBoxDC.checked else 1, writeMeshes=self.writeAlignedModelsCheckBoxDC.checked)
       except ValueError as errorText:
         self.logInfoDC.appendPlainText(str(errorText))
         return
@@ -748,7 +934,8 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
       if self.analysisTypeShape.checked:
         self.logInfoDC.appendPlainText(f"Calculating point correspondences to atlas")
         logic.runDCAlign(atlasModelPath, atlasLMPath, self.folderNames['alignedModels'],
-        self.folderNames['alignedLMs'], self.folderNames['output'], self.writeErrorCheckBox.checked, progressCallback)
+        self.folderNames['alignedLMs'], self.folderNames['output'], self.writeErrorCheckBox.checked, progressCallback,
+        workers=self.workerCountDC.value, parallelSubjects=self.parallelSubjectsCheckBoxDC.checked, useNumpyTPS=self.numpyTPSCheckBoxDC.checked)
       # run DeCA symmetry analysis
       else:
         ##
@@ -761,14 +948,16 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
         self.logInfoDC.appendPlainText(f"Generating mirrored models and landmarks")
         try:
           logic.runMirroring(self.folderNames['alignedModels'], self.folderNames['alignedLMs'], self.folderNames['mirrorModels'],
-          self.folderNames['mirrorLMs'], axis, mirror_map_string) # Use the validated string
+          self.folderNames['mirrorLMs'], axis, mirror_map_string, # Use the validated string
+          progressCallback=progressCallback, workers=self.workerCountDC.value if self.parallelSubjectsCheckBoxDC.checked else 1)
         except ValueError as errorText:
           self.logInfoDC.appendPlainText(str(errorText))
           return
         self.logInfoDC.appendPlainText(f"Calculating point correspondences to atlas")
         logic.runDCAlignSymmetric(atlasModelPath, atlasLMPath, self.folderNames['alignedModels'],
         self.folderNames['alignedLMs'], self.folderNames['mirrorModels'], self.folderNames['mirrorLMs'], self.folderNames['output'],
-        self.writeErrorCheckBox.checked, progressCallback)
+        self.writeErrorCheckBox.checked, progressCallback, workers=self.workerCountDC.value,
+        parallelSubjects=self.parallelSubjectsCheckBoxDC.checked, useNumpyTPS=self.numpyTPSCheckBoxDC.checked)
         ##
         ## END OF MODIFIED SECTION
         ##
@@ -788,27 +977,44 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     succeeded = False
     try:
       logic = DeCALogic()
-      progressCallback = self.makeProgressCallback(self.progressBarDCL)
+      progressCallback = self.makeProgressCallback(self.progressBarDCL, self.logInfoDCL)
       # rigidly align to template
       self.logInfoDCL.appendPlainText(f"Rigid alignment to the atlas")
       removeScale = True
       # only persist per-subject alignment transforms when original-frame output is
       # requested, so an unchecked run does no extra transform I/O
-      transformDirectory = self.folderNames['alignmentTransforms'] if self.originalFrameCheckBoxDCL.checked else None
+      transformDirectory = self.folderNames['alignmentTransforms'] if self.originalFrameCheckBoxDCL.checked or not self.writeAlignedModelsCheckBoxDCL.checked else None
       try:
-        logic.runAlign(self.atlasModel, self.atlasLMs, self.folderNames['originalModels'], self.folderNames['originalLMs'],self.folderNames['alignedModels'], self.folderNames['alignedLMs'], removeScale, transformDirectory=transformDirectory, progressCallback=progressCallback)
+        logic.runAlign(self.atlasModel, self.atlasLMs, self.folderNames['originalModels'], self.folderNames['originalLMs'],self.folderNames['alignedModels'], self.folderNames['alignedLMs'], removeScale, transformDirectory=transformDirectory, progressCallback=progressCallback,
+          workers=self.workerCountDCL.value if self.parallelSubjectsCheckBoxDCL.checked else 1, writeMeshes=self.writeAlignedModelsCheckBoxDCL.checked)
       except ValueError as errorText:
         self.logInfoDCL.appendPlainText(str(errorText))
         return
       # generate point correspondences
       self.logInfoDCL.appendPlainText(f"Calculating point correspondences")
+      selectedPointIndices = None
+      if self.restrictToSelectionCheckBox.checked and self.pointSelection.currentNode():
+        selectedPointIndices = self.getSelectedTemplateIndices(self.pointSelection.currentNode())
+        self.logInfoDCL.appendPlainText(f"Computing only the {len(selectedPointIndices)} selected points")
       try:
         atlasDenseLandmarks = logic.runDeCAL(self.atlasModel, self.atlasLMs, self.folderNames['alignedModels'],
         self.folderNames['alignedLMs'], self.folderNames['DeCALOutput'], self.spacingTolerance.value, progressCallback,
-        useFastCorrespondence=self.fastCorrespondenceCheckBoxDCL.checked)
+        useFastCorrespondence=self.fastCorrespondenceCheckBoxDCL.checked, useHybridCorrespondence=self.hybridCorrespondenceCheckBoxDCL.checked,
+        calibrateFastCorrespondence=self.calibrateFastCheckBoxDCL.checked, calibrationSizeDirectory=self.folderNames['originalLMs'],
+        workers=self.workerCountDCL.value,
+        parallelSubjects=self.parallelSubjectsCheckBoxDCL.checked, useNumpyTPS=self.numpyTPSCheckBoxDCL.checked,
+        selectedPointIndices=selectedPointIndices, useWarpCache=self.warpCacheCheckBoxDCL.checked,
+        useResultCache=self.resultCacheCheckBoxDCL.checked, resultCacheSizeGB=self.resultCacheSizeDCL.value,
+        referenceFrameOutputPath=os.path.join(self.folderNames['output'], "decalReferenceFrame.npz"),
+        verifyOutput=self.verifyOutputCheckBoxDCL.checked,
+        traceOutputPath=os.path.join(self.folderNames['output'], "decalTrace.json") if self.profileTraceCheckBoxDCL.checked else None,
+        correspondenceStorePath=os.path.join(self.folderNames['output'], "decalCorrespondences.h5") if self.correspondenceStoreCheckBoxDCL.checked else None)
       except ValueError as errorText:
         self.logInfoDCL.appendPlainText(str(errorText))
         return
+      for cacheSummary in (logic.resultCacheSummary, logic.warpCacheSummary, logic.traceSummary, logic.calibrationSummary):
+        if cacheSummary:
+          self.logInfoDCL.appendPlainText(cacheSummary.capitalize())
       # optionally merge the generated semi-landmarks with the fixed landmarks used
       # to establish correspondence (both are in the atlas-aligned coordinate frame)
       mergedCount = None
@@ -847,6 +1053,96 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
       self.DCLApplyButton.enabled = True
       self.resetProgressBar(self.progressBarDCL, "Done" if succeeded else "Idle")
 
+  def onDCLAppendButton(self):
+    if self._busy:
+      return
+    self._busy = True
+    self.appendApplyButtonDCL.enabled = False
+    succeeded = False
+    try:
+      logic = DeCALogic()
+      progressCallback = self.makeProgressCallback(self.progressBarDCL, self.logInfoDCL)
+      # reuse the folders of the selected run; only missing subjects are added
+      runDirectory = self.appendRunDirectoryDCL.currentPath
+      self.folderNames = {'output': runDirectory,
+        'alignedModels': os.path.join(runDirectory, "alignedModels"),
+        'alignedLMs': os.path.join(runDirectory, "alignedLMs"),
+        'DeCALOutput': os.path.join(runDirectory, "DeCALOutput"),
+        'alignmentTransforms': os.path.join(runDirectory, "alignmentTransforms"),
+        'originalModels': self.meshDirectoryDCL.currentPath,
+        'originalLMs': self.landmarkDirectoryDCL.currentPath}
+      try:
+        self.atlasModel = slicer.util.loadModel(os.path.join(runDirectory, 'decaAtlasModel.ply'))
+        self.atlasLMs = slicer.util.loadMarkups(os.path.join(runDirectory, 'decaAtlasLM.mrk.json'))
+      except:
+        self.logInfoDCL.appendPlainText(f"Can't load the atlas saved in: {runDirectory}")
+        return
+      self.logInfoDCL.appendPlainText(f"Rigid alignment of new specimens to the atlas")
+      transformDirectory = self.folderNames['alignmentTransforms'] if os.path.isdir(self.folderNames['alignmentTransforms']) else None
+      try:
+        logic.runAlign(self.atlasModel, self.atlasLMs, self.folderNames['originalModels'], self.folderNames['originalLMs'], self.folderNames['alignedModels'], self.folderNames['alignedLMs'], True,
+          transformDirectory=transformDirectory, progressCallback=progressCallback, skipExisting=True,
+          workers=self.workerCountDCL.value if self.parallelSubjectsCheckBoxDCL.checked else 1, writeMeshes=self.writeAlignedModelsCheckBoxDCL.checked)
+      except ValueError as errorText:
+        self.logInfoDCL.appendPlainText(str(errorText))
+        return
+      self.logInfoDCL.appendPlainText(f"Calculating point correspondences in the frozen reference frame")
+      try:
+        atlasDenseLandmarks = logic.appendDeCAL(self.folderNames['alignedModels'], self.folderNames['alignedLMs'],
+        self.folderNames['DeCALOutput'], os.path.join(runDirectory, "decalReferenceFrame.npz"), progressCallback,
+        workers=self.workerCountDCL.value, parallelSubjects=self.parallelSubjectsCheckBoxDCL.checked,
+        useWarpCache=self.warpCacheCheckBoxDCL.checked,
+        useResultCache=self.resultCacheCheckBoxDCL.checked, resultCacheSizeGB=self.resultCacheSizeDCL.value,
+        verifyOutput=self.verifyOutputCheckBoxDCL.checked,
+        traceOutputPath=os.path.join(runDirectory, "decalTrace.json") if self.profileTraceCheckBoxDCL.checked else None,
+        correspondenceStorePath=os.path.join(runDirectory, "decalCorrespondences.h5") if self.correspondenceStoreCheckBoxDCL.checked else None)
+      except ValueError as errorText:
+        self.logInfoDCL.appendPlainText(str(errorText))
+        return
+      for cacheSummary in (logic.resultCacheSummary, logic.warpCacheSummary, logic.traceSummary, logic.calibrationSummary):
+        if cacheSummary:
+          self.logInfoDCL.appendPlainText(cacheSummary.capitalize())
+      self.logInfoDCL.appendPlainText("Merged and original-frame landmark folders of the run are not updated by appending.")
+      self.pointSelection.setCurrentNode(atlasDenseLandmarks)
+      self.DCLLandmarkDirectory.setCurrentPath(self.folderNames['DeCALOutput'])
+      succeeded = True
+    finally:
+      self._busy = False
+      self.onParameterSelectDCL()
+      self.resetProgressBar(self.progressBarDCL, "Done" if succeeded else "Idle")
+
+  def onDCLCompareButton(self):
+    if self._busy:
+      return
+    self._busy = True
+    self.compareApplyButtonDCL.enabled = False
+    succeeded = False
+    try:
+      logic = DeCALogic()
+      progressCallback = self.makeProgressCallback(self.progressBarDCL, self.logInfoDCL)
+      comparisonDirectory = os.path.join(self.folderNames['output'], "methodComparison")
+      self.logInfoDCL.appendPlainText(f"Comparing exact and fast correspondence on {self.compareSubjectCountDCL.value} specimens")
+      try:
+        comparison = logic.runMethodComparison(self.atlasModel, self.atlasLMs, self.folderNames['originalModels'], self.folderNames['originalLMs'],
+          comparisonDirectory, self.spacingTolerance.value, self.compareSubjectCountDCL.value, progressCallback=progressCallback,
+          workers=self.workerCountDCL.value, parallelSubjects=self.parallelSubjectsCheckBoxDCL.checked, useNumpyTPS=self.numpyTPSCheckBoxDCL.checked,
+          useHybridCorrespondence=self.hybridCorrespondenceCheckBoxDCL.checked)
+      except ValueError as errorText:
+        self.logInfoDCL.appendPlainText(str(errorText))
+        return
+      self.logInfoDCL.appendPlainText(comparison.describe())
+      self.logInfoDCL.appendPlainText(f"Comparison tables and figures saved to {comparisonDirectory}")
+      succeeded = True
+    finally:
+      self._busy = False
+      self.compareApplyButtonDCL.enabled = True
+      self.resetProgressBar(self.progressBarDCL, "Done" if succeeded else "Idle")
+
+  def onClearResultCacheButton(self):
+    logic = DeCALogic()
+    logic.clearResultCache()
+    self.logInfoDCL.appendPlainText("Cleared the correspondence cache")
+
   def onSubsetApplyButton(self):
     logic = DeCALogic()
     topDir = os.path.dirname(self.DCLLandmarkDirectory.currentPath)
@@ -855,6 +1151,18 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     atlasNode = self.pointSelection.currentNode()
     lmDirectorySubset = logic.runSubsetLandmarks(atlasNode, self.DCLLandmarkDirectory.currentPath, lmDirectorySubset)
 
+  def getSelectedTemplateIndices(self, atlasPointNode):
+    # Template positions of the selected points of a DeCAL atlas point set. DeCAL
+    # labels every point with its template position, so the labels stay valid for
+    # a point set that was itself already subset; unlabelled points fall back to
+    # their position in the node.
+    selectedIndices = []
+    for i in range(atlasPointNode.GetNumberOfControlPoints()):
+      if atlasPointNode.GetNthControlPointSelected(i):
+        label = atlasPointNode.GetNthControlPointLabel(i)
+        selectedIndices.append(int(label) if label.isdigit() else i)
+    return selectedIndices
+
   ##
   ## NEW HELPER FUNCTION: getActualLandmarkCount
   ##
@@ -864,18 +1172,15 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     Raises ValueError if no files found or can't read them.
     """
     import os
-    landmark_files = [f for f in os.listdir(landmarkDirectory) if f.endswith('.fcsv') or f.endswith('.json')]
+    landmark_files = [f for f in os.listdir(landmarkDirectory) if markupsIO.isLandmarkFile(f)]
     
     if not landmark_files:
       raise ValueError(f"No landmark files (.fcsv or .json) found in directory: {landmarkDirectory}")
     
-    # Load the first landmark file to check the count
+    # Read the first landmark file to check the count (parsed directly, not loaded into the scene)
     sample_file = os.path.join(landmarkDirectory, landmark_files[0])
     try:
-      sample_lm = slicer.util.loadMarkups(sample_file)
-      landmark_count = sample_lm.GetNumberOfControlPoints()
-      slicer.mrmlScene.RemoveNode(sample_lm)
-      return landmark_count
+      return len(markupsIO.readMarkupsPoints(sample_file))
     except Exception as e:
       raise ValueError(f"Error reading landmark file {sample_file}: {str(e)}")
   ##
@@ -959,70 +1264,10 @@ class DeCAWidget(ScriptedLoadableModuleWidget):
     Args:
       expected_landmark_count: If provided, validates that all landmarks are specified
     """
-    try:
-      midline_indices = self._parse_indices(self.midlineLandmarksText.text)
-      left_indices = self._parse_indices(self.leftLandmarksText.text)
-      right_indices = self._parse_indices(self.rightLandmarksText.text)
-
-      if len(left_indices) != len(right_indices):
-        raise ValueError(f"Error: Left ({len(left_indices)}) and Right ({len(right_indices)}) landmark lists have different lengths.")
-      
-      num_specified_landmarks = len(midline_indices) + len(left_indices) + len(right_indices)
-      if num_specified_landmarks == 0:
-        raise ValueError("Error: No indices provided in Midline, Left, or Right fields.")
-            
-      # Check for duplicates
-      all_indices_list = midline_indices + left_indices + right_indices
-      all_indices_set = set(all_indices_list)
-      if len(all_indices_list) != len(all_indices_set):
-        raise ValueError("Error: Duplicate indices found. Each landmark must be in only one list (midline, left, or right).")
-
-      # If expected count is provided, validate that ALL landmarks are specified
-      if expected_landmark_count is not None:
-        expected_indices = set(range(expected_landmark_count))
-        if all_indices_set != expected_indices:
-          missing_indices = expected_indices - all_indices_set
-          extra_indices = all_indices_set - expected_indices
-          
-          error_msg = f"Error: Not all landmarks are specified. The landmark files contain {expected_landmark_count} landmarks."
-          if missing_indices:
-            missing_1based = sorted([x + 1 for x in missing_indices])
-            error_msg += f"\nMissing landmarks (1-based): {missing_1based}"
-          if extra_indices:
-            extra_1based = sorted([x + 1 for x in extra_indices])
-            error_msg += f"\nExtra landmarks not in files (1-based): {extra_1based}"
-          error_msg += f"\nPlease ensure ALL landmarks (1-{expected_landmark_count}) are assigned to Midline, Left, or Right fields."
-          raise ValueError(error_msg)
-
-      # The mirror map size must accommodate the highest landmark index
-      max_index = max(all_indices_list)
-      total_landmarks = max_index + 1  # 0-based, so add 1
-      
-      # All checks passed, create the map
-      # Initialize: each landmark maps to itself by default
-      mirror_map = list(range(total_landmarks))
-      
-      for i in midline_indices:
-        mirror_map[i] = i
-      
-      for l_idx, r_idx in zip(left_indices, right_indices):
-        mirror_map[l_idx] = r_idx
-        mirror_map[r_idx] = l_idx
-      
-      # Convert list of ints to comma-separated string
-      map_string = ",".join(map(str, mirror_map))
-      
-      # Print to console as requested
-      print("--- DeCA Symmetry Map Generated ---")
-      print(map_string)
-      print(f"Total Landmarks: {total_landmarks}")
-      print("-------------------------------------")
-      
-      return map_string
-      
-    except Exception as e:
-      # Re-raise the exception to be caught by onDCApplyButton
-      raise e
+    midline_indices = self._parse_indices(self.midlineLandmarksText.text)
+    left_indices = self._parse_indices(self.leftLandmarksText.text)
+    right_indices = self._parse_indices(self.rightLandmarksText.text)
+    return DeCALogic().mirrorMapString(midline_indices, left_indices, right_indices, expected_landmark_count)
   ##
   ## END OF NEW HELPER FUNCTION
   ##
@@ -1041,138 +1286,770 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+  def setUpOutputDirectories(self, outDir, symmetryOption=False, errorDirectoryOption=False, DeCALOption=False, runFolder=None):
+    # Create a timestamped run folder in outDir (or use runFolder, which may
+    # already exist) with the subfolders a DeCA or DeCAL run writes to; returns
+    # their paths by role ({} if creation failed).
+    dateTimeStamp = datetime.now().strftime('%Y_%m-%d_%H_%M_%S')
+    outputFolderDC = runFolder or os.path.join(outDir, dateTimeStamp)
+    existOK = runFolder is not None
+    fileNameDictionary = {}
+    try:
+      os.makedirs(outputFolderDC, exist_ok=existOK)
+      alignedLMFolderDC = os.path.join(outputFolderDC, "alignedLMs")
+      os.makedirs(alignedLMFolderDC, exist_ok=existOK)
+      alignedModelFolderDC = os.path.join(outputFolderDC, "alignedModels")
+      os.makedirs(alignedModelFolderDC, exist_ok=existOK)
+      # initialize the filename dictionary
+      fileNameDictionary['output'] = str(outputFolderDC)
+      fileNameDictionary['alignedLMs'] = str(alignedLMFolderDC)
+      fileNameDictionary['alignedModels'] = str(alignedModelFolderDC)
+      if symmetryOption:
+        mirrorLMFolderDC = os.path.join(outputFolderDC, "mirrorLMs")
+        os.makedirs(mirrorLMFolderDC, exist_ok=existOK)
+        mirrorModelFolderDC = os.path.join(outputFolderDC, "mirrorModels")
+        os.makedirs(mirrorModelFolderDC, exist_ok=existOK)
+        fileNameDictionary['mirrorLMs'] = str(mirrorLMFolderDC)
+        fileNameDictionary['mirrorModels'] = str(mirrorModelFolderDC)
+      if errorDirectoryOption:
+        errorCheckingFolderDC = os.path.join(outputFolderDC, "errorChecking")
+        os.makedirs(errorCheckingFolderDC, exist_ok=existOK)
+        fileNameDictionary['error'] = str(errorCheckingFolderDC)
+      if DeCALOption:
+        DeCALOutputFolder = os.path.join(outputFolderDC, "DeCALOutput")
+        os.makedirs(DeCALOutputFolder, exist_ok=existOK)
+        fileNameDictionary['DeCALOutput'] = str(DeCALOutputFolder)
+        # per-subject alignment transforms are saved here so DeCAL output can later
+        # be mapped back into each subject's original (un-aligned) coordinate frame
+        alignmentTransformFolder = os.path.join(outputFolderDC, "alignmentTransforms")
+        os.makedirs(alignmentTransformFolder, exist_ok=existOK)
+        fileNameDictionary['alignmentTransforms'] = str(alignmentTransformFolder)
+    except:
+      logging.debug('Result directory failed: Could not create output folder')
+    return fileNameDictionary
+
+  def runBatch(self, config, log=None, progressCallback=None):
+    # Run a whole DeCA or DeCAL workflow without the widget, as the tab buttons
+    # would, from a config dict (see loadBatchConfig and main at the end of this
+    # file). Keys, with their defaults:
+    #   workflow            "DeCAL" or "DeCA"
+    #   meshDirectory, landmarkDirectory, outputDirectory (required)
+    #   atlasModel, atlasLandmarks   atlas files to use instead of building one
+    #   removeScale (True), workers (0, all cores), parallelSubjects (False),
+    #   useNumpyTPS (False), writeAlignedMeshes (True; False aligns the meshes
+    #   in memory in the correspondence step instead, see runAlign)
+    #   DeCA:  analysis ("shape" or "symmetry"), writeErrorCheck (False), and for
+    #          symmetry midline, left, right: 1-based landmark indices
+    #   DeCAL: spacingTolerance (4), useFastCorrespondence (False),
+    #          useHybridCorrespondence (False), calibrateFastCorrespondence
+    #          (False) with calibrationCount (20),
+    #          useWarpCache (False), useResultCache (False) with
+    #          resultCacheSizeGB (16), verifyOutput (False), selectedPoints
+    #          (template indices), mergeLandmarks (False), originalFrame (False),
+    #          appendToRun (run folder of an earlier DeCAL run to append to),
+    #          traceFile (path of a per-subject stage timing trace, see _correspondDeCALSubjects),
+    #          correspondenceStore (False; True also writes every subject's
+    #          points to decalCorrespondences.h5 in the output folder, see
+    #          correspondenceStore; in a distributed run the "finalize" stage
+    #          writes it)
+    #   DeCAL over several processes or hosts sharing runDirectory: stage
+    #          "prepare" (once: atlas, alignment, reference frame), then
+    #          "correspond" (any number of processes at once), then "finalize"
+    #          (once every subject is done); the default stage "all" runs
+    #          everything in this process
+    # log is any object with appendPlainText (printed if None). Returns the
+    # folders of the run by role, as setUpOutputDirectories does.
+    if log is None:
+      log = _BatchLog()
+    workflow = config.get("workflow", "DeCAL")
+    if workflow not in ("DeCA", "DeCAL"):
+      raise ValueError(f"Unknown workflow '{workflow}': use DeCA or DeCAL")
+    stage = config.get("stage", "all")
+    if stage not in ("all", "prepare", "correspond", "finalize"):
+      raise ValueError(f"Unknown stage '{stage}': use all, prepare, correspond or finalize")
+    if stage != "all" and (workflow != "DeCAL" or not config.get("runDirectory")):
+      raise ValueError("Distributed stages are only available for DeCAL and need 'runDirectory'")
+    for key in ("meshDirectory", "landmarkDirectory", "outputDirectory"):
+      if not config.get(key):
+        raise ValueError(f"The batch configuration needs '{key}'")
+    removeScale = config.get("removeScale", True)
+    workers = config.get("workers", 0)
+    parallelSubjects = config.get("parallelSubjects", False)
+    useNumpyTPS = config.get("useNumpyTPS", False)
+    writeAlignedMeshes = config.get("writeAlignedMeshes", True)
+    symmetryOption = workflow == "DeCA" and config.get("analysis", "shape") == "symmetry"
+    writeErrorOption = workflow == "DeCA" and config.get("writeErrorCheck", False)
+    mirrorMap = None
+    if symmetryOption:
+      # validated before any processing, as onDCApplyButton does
+      landmarkFiles = sorted(f for f in os.listdir(config["landmarkDirectory"]) if markupsIO.isLandmarkFile(f))
+      if not landmarkFiles:
+        raise ValueError(f"No landmark files (.fcsv or .json) found in directory: {config['landmarkDirectory']}")
+      landmarkCount = len(markupsIO.readMarkupsPoints(os.path.join(config["landmarkDirectory"], landmarkFiles[0])))
+      mirrorMap = self.mirrorMapString(*[[int(index) - 1 for index in config.get(side, [])] for side in ("midline", "left", "right")],
+        expected_landmark_count=landmarkCount)
+    # an existing DeCAL run folder is reused when appending or in the later stages
+    # of a distributed run
+    existingRun = config.get("appendToRun") if workflow == "DeCAL" else None
+    if stage in ("correspond", "finalize"):
+      existingRun = config["runDirectory"]
+    if existingRun:
+      folderNames = {'output': existingRun}
+      for role in ("alignedModels", "alignedLMs", "DeCALOutput", "alignmentTransforms"):
+        folderNames[role] = os.path.join(existingRun, role)
+      atlasModelPath = os.path.join(existingRun, 'decaAtlasModel.ply')
+      atlasLMPath = os.path.join(existingRun, 'decaAtlasLM.mrk.json')
+      if stage != "finalize":
+        atlasModel = slicer.util.loadModel(atlasModelPath)
+        atlasLMs = slicer.util.loadMarkups(atlasLMPath)
+    else:
+      folderNames = self.setUpOutputDirectories(config["outputDirectory"], symmetryOption, writeErrorOption, workflow == "DeCAL",
+        runFolder=config.get("runDirectory") if stage == "prepare" else None)
+      if folderNames == {}:
+        raise ValueError(f"Output folders could not be created in {config['outputDirectory']}")
+      if config.get("atlasModel"):
+        atlasModel = slicer.util.loadModel(config["atlasModel"])
+        atlasLMs = slicer.util.loadMarkups(config["atlasLandmarks"])
+      else:
+        log.appendPlainText("Building the atlas")
+        atlasModel, atlasLMs = self.runAtlas(config["meshDirectory"], config["landmarkDirectory"], removeScale, log, progressCallback,
+          workers=workers, parallelSubjects=parallelSubjects, useNumpyTPS=useNumpyTPS)
+      atlasModelPath = os.path.join(folderNames['output'], 'decaAtlasModel.ply')
+      log.appendPlainText(f"Saving atlas model to {atlasModelPath}")
+      slicer.util.saveNode(atlasModel, atlasModelPath)
+      atlasLMPath = os.path.join(folderNames['output'], 'decaAtlasLM.mrk.json')
+      log.appendPlainText(f"Saving atlas landmarks to {atlasLMPath}")
+      slicer.util.saveNode(atlasLMs, atlasLMPath)
+    folderNames['originalModels'] = config["meshDirectory"]
+    folderNames['originalLMs'] = config["landmarkDirectory"]
+    frameOutputPath = os.path.join(folderNames['output'], "decalReferenceFrame.npz")
+    storePath = os.path.join(folderNames['output'], "decalCorrespondences.h5") if config.get("correspondenceStore", False) else None
+    originalFrame = workflow == "DeCAL" and config.get("originalFrame", False)
+    transformDirectory = None
+    if originalFrame or (workflow == "DeCAL" and not writeAlignedMeshes) or (existingRun and os.path.isdir(folderNames['alignmentTransforms'])):
+      transformDirectory = folderNames['alignmentTransforms']
+    if stage in ("all", "prepare"):
+      log.appendPlainText("Rigid alignment to the atlas")
+      self.runAlign(atlasModel, atlasLMs, folderNames['originalModels'], folderNames['originalLMs'], folderNames['alignedModels'], folderNames['alignedLMs'],
+        removeScale, transformDirectory=transformDirectory, progressCallback=progressCallback, skipExisting=bool(existingRun),
+        workers=workers if parallelSubjects else 1, writeMeshes=writeAlignedMeshes)
+    if workflow == "DeCA":
+      log.appendPlainText("Calculating point correspondences to atlas")
+      if not symmetryOption:
+        self.runDCAlign(atlasModelPath, atlasLMPath, folderNames['alignedModels'], folderNames['alignedLMs'], folderNames['output'],
+          writeErrorOption, progressCallback, workers=workers, parallelSubjects=parallelSubjects, useNumpyTPS=useNumpyTPS)
+      else:
+        self.runMirroring(folderNames['alignedModels'], folderNames['alignedLMs'], folderNames['mirrorModels'], folderNames['mirrorLMs'], [-1,1,1], mirrorMap,
+          progressCallback=progressCallback, workers=workers if parallelSubjects else 1)
+        self.runDCAlignSymmetric(atlasModelPath, atlasLMPath, folderNames['alignedModels'], folderNames['alignedLMs'], folderNames['mirrorModels'],
+          folderNames['mirrorLMs'], folderNames['output'], writeErrorOption, progressCallback, workers=workers,
+          parallelSubjects=parallelSubjects, useNumpyTPS=useNumpyTPS)
+      log.appendPlainText(f"Done: {folderNames['output']}")
+      return folderNames
+    if stage != "finalize":
+      correspondenceSettings = {"useFastCorrespondence": config.get("useFastCorrespondence", False),
+        "useHybridCorrespondence": config.get("useHybridCorrespondence", False), "useNumpyTPS": useNumpyTPS,
+        "selectedPointIndices": config.get("selectedPoints")}
+      subjectSettings = {"workers": workers, "parallelSubjects": parallelSubjects, "useWarpCache": config.get("useWarpCache", False),
+        "verifyOutput": config.get("verifyOutput", False), "useResultCache": config.get("useResultCache", False),
+        "resultCacheSizeGB": config.get("resultCacheSizeGB", 16), "traceOutputPath": config.get("traceFile")}
+      calibrationSettings = {"calibrateFastCorrespondence": config.get("calibrateFastCorrespondence", False),
+        "calibrationCount": config.get("calibrationCount", 20), "calibrationSizeDirectory": config["landmarkDirectory"]}
+      if stage == "prepare":
+        log.appendPlainText("Freezing the reference frame")
+        self.freezeDeCALFrame(atlasModel, atlasLMs, folderNames['alignedLMs'], config.get("spacingTolerance", 4), frameOutputPath,
+          progressCallback, **correspondenceSettings)
+      elif stage == "correspond":
+        log.appendPlainText("Calculating point correspondences")
+        self.correspondDistributedDeCAL(folderNames['alignedModels'], folderNames['alignedLMs'], folderNames['DeCALOutput'], frameOutputPath,
+          progressCallback, **subjectSettings)
+      elif existingRun:
+        log.appendPlainText("Calculating point correspondences in the frozen reference frame")
+        self.appendDeCAL(folderNames['alignedModels'], folderNames['alignedLMs'], folderNames['DeCALOutput'], frameOutputPath,
+          progressCallback, correspondenceStorePath=storePath, **subjectSettings, **calibrationSettings)
+      else:
+        log.appendPlainText("Calculating point correspondences")
+        self.runDeCAL(atlasModel, atlasLMs, folderNames['alignedModels'], folderNames['alignedLMs'], folderNames['DeCALOutput'],
+          config.get("spacingTolerance", 4), progressCallback, referenceFrameOutputPath=frameOutputPath, correspondenceStorePath=storePath,
+          **correspondenceSettings, **subjectSettings, **calibrationSettings)
+      if stage != "prepare":
+        for cacheSummary in (self.resultCacheSummary, self.warpCacheSummary, self.traceSummary, self.calibrationSummary):
+          if cacheSummary:
+            log.appendPlainText(cacheSummary.capitalize())
+      if stage != "all":
+        log.appendPlainText(f"Done: {folderNames['output']}")
+        return folderNames
+    else:
+      log.appendPlainText(f"Saved atlas points to {self.finalizeDeCAL(folderNames['alignedModels'], folderNames['DeCALOutput'], frameOutputPath, folderNames['alignedLMs'], storePath)}")
+    mergedCount = None
+    mergedDirectory = os.path.join(folderNames['output'], "mergedLMs")
+    if config.get("mergeLandmarks", False):
+      os.makedirs(mergedDirectory, exist_ok=True)
+      mergedCount = self.runMergeLandmarks(folderNames['alignedLMs'], folderNames['DeCALOutput'], mergedDirectory, atlasLMPath)
+      if mergedCount is None:
+        log.appendPlainText("Merge skipped: the SlicerMorph extension (MergeMarkups module) is required.")
+      else:
+        log.appendPlainText(f"Saved {mergedCount} merged landmark files.")
+    if originalFrame:
+      originalSemiDirectory = os.path.join(folderNames['output'], "DeCALOutput_originalFrame")
+      semiCount = self.runBackTransformLandmarks(folderNames['DeCALOutput'], transformDirectory, originalSemiDirectory)
+      log.appendPlainText(f"Saved {semiCount} original-frame semi-landmark files to {originalSemiDirectory}")
+      if mergedCount:
+        mergedOriginalDirectory = os.path.join(folderNames['output'], "mergedLMs_originalFrame")
+        mergedOriginalCount = self.runBackTransformLandmarks(mergedDirectory, transformDirectory, mergedOriginalDirectory, "_merged")
+        log.appendPlainText(f"Saved {mergedOriginalCount} original-frame merged landmark files to {mergedOriginalDirectory}")
+    log.appendPlainText(f"Done: {folderNames['output']}")
+    return folderNames
+
+  def mirrorMapString(self, midline_indices, left_indices, right_indices, expected_landmark_count=None):
+    """
+    Generates the 0-based full mirror map string (as runMirroring expects) from
+    0-based midline, left, and right landmark indices.
+    Prints the result to the console and returns the string.
+    Raises a ValueError if validation fails.
+
+    Args:
+      expected_landmark_count: If provided, validates that all landmarks are specified
+    """
+    if len(left_indices) != len(right_indices):
+      raise ValueError(f"Error: Left ({len(left_indices)}) and Right ({len(right_indices)}) landmark lists have different lengths.")
+    
+    num_specified_landmarks = len(midline_indices) + len(left_indices) + len(right_indices)
+    if num_specified_landmarks == 0:
+      raise ValueError("Error: No indices provided in Midline, Left, or Right fields.")
+          
+    # Check for duplicates
+    all_indices_list = midline_indices + left_indices + right_indices
+    all_indices_set = set(all_indices_list)
+    if len(all_indices_list) != len(all_indices_set):
+      raise ValueError("Error: Duplicate indices found. Each landmark must be in only one list (midline, left, or right).")
+
+    # If expected count is provided, validate that ALL landmarks are specified
+    if expected_landmark_count is not None:
+      expected_indices = set(range(expected_landmark_count))
+      if all_indices_set != expected_indices:
+        missing_indices = expected_indices - all_indices_set
+        extra_indices = all_indices_set - expected_indices
+        
+        error_msg = f"Error: Not all landmarks are specified. The landmark files contain {expected_landmark_count} landmarks."
+        if missing_indices:
+          missing_1based = sorted([x + 1 for x in missing_indices])
+          error_msg += f"\nMissing landmarks (1-based): {missing_1based}"
+        if extra_indices:
+          extra_1based = sorted([x + 1 for x in extra_indices])
+          error_msg += f"\nExtra landmarks not in files (1-based): {extra_1based}"
+        error_msg += f"\nPlease ensure ALL landmarks (1-{expected_landmark_count}) are assigned to Midline, Left, or Right fields."
+        raise ValueError(error_msg)
+
+    # The mirror map size must accommodate the highest landmark index
+    max_index = max(all_indices_list)
+    total_landmarks = max_index + 1  # 0-based, so add 1
+    
+    # All checks passed, create the map
+    # Initialize: each landmark maps to itself by default
+    mirror_map = list(range(total_landmarks))
+    
+    for i in midline_indices:
+      mirror_map[i] = i
+    
+    for l_idx, r_idx in zip(left_indices, right_indices):
+      mirror_map[l_idx] = r_idx
+      mirror_map[r_idx] = l_idx
+    
+    # Convert list of ints to comma-separated string
+    map_string = ",".join(map(str, mirror_map))
+    
+    # Print to console as requested
+    print("--- DeCA Symmetry Map Generated ---")
+    print(map_string)
+    print(f"Total Landmarks: {total_landmarks}")
+    print("-------------------------------------")
+    
+    return map_string
+
   def runSubsetLandmarks(self, baseNode, lmDirectory, lmDirectorySubset):
-    deletionIndex = []
-    for i in range(baseNode.GetNumberOfControlPoints()):
-      if not baseNode.GetNthControlPointSelected(i):
-        deletionIndex.append(i)
+    # Keep the points selected in baseNode in every landmark file. Files are read
+    # and written directly (labels and descriptions kept), without loading them
+    # into the scene.
+    keepIndex = [i for i in range(baseNode.GetNumberOfControlPoints()) if baseNode.GetNthControlPointSelected(i)]
     for lmFileName in os.listdir(lmDirectory):
-      if(not lmFileName.startswith(".")):
-        currentLMNode = slicer.util.loadMarkups(os.path.join(lmDirectory, lmFileName))
-        for index in reversed(deletionIndex):
-          currentLMNode.RemoveNthControlPoint(index)
-      slicer.util.saveNode(currentLMNode, os.path.join(lmDirectorySubset, lmFileName))
-      slicer.mrmlScene.RemoveNode(currentLMNode)
+      if markupsIO.isLandmarkFile(lmFileName):
+        pointsXYZ, labels, descriptions = markupsIO.readMarkups(os.path.join(lmDirectory, lmFileName))
+        markupsIO.writeMarkups(os.path.join(lmDirectorySubset, lmFileName), pointsXYZ[keepIndex],
+          [labels[i] for i in keepIndex], [descriptions[i] for i in keepIndex])
+    return lmDirectorySubset
 
   def runCheckPoints(self, atlasNode, spacingTolerance):
     spacingPercentage = spacingTolerance/100
     templateModel = self.downsampleModel(atlasNode, spacingPercentage)
     return templateModel, templateModel.GetNumberOfPoints()
 
-  def _existingLandmarkFileIsComplete(self, markupsPath, expectedPointCount):
-    # Resume must only skip a subject whose existing output is genuinely complete
-    # for the CURRENT parameters. Load the file and require its control-point count
-    # to equal expectedPointCount (derived from the current spacingTolerance / base
-    # mesh). A file truncated by a crash mid-write, or left over from a run with a
-    # different point density, fails this check and is recomputed rather than being
-    # silently trusted. (Resume still assumes the same atlas; the normal workflow
-    # writes each atlas run to its own timestamped output folder.)
-    node = None
-    try:
-      node = slicer.util.loadMarkups(markupsPath)
-      return node is not None and node.GetNumberOfControlPoints() == expectedPointCount
-    except Exception:
-      return False
-    finally:
-      if node is not None:
-        self._removeNodeFully(node)
-
-  def runDeCAL(self, baseNode, baseLMPath, meshDirectory, landmarkDirectory, outputDirectory, spacingTolerance, progressCallback=None, useFastCorrespondence=False):
-    spacingPercentage = spacingTolerance/100
-    loadOption=False
-    baseLandmarks=self.fiducialNodeToPolyData(baseLMPath, loadOption).GetPoints()
-    modelExt=['ply','stl','vtp', 'vtk']
+  def runDeCAL(self, baseNode, baseLMPath, meshDirectory, landmarkDirectory, outputDirectory, spacingTolerance, progressCallback=None, useFastCorrespondence=False, workers=1, parallelSubjects=False, useNumpyTPS=False, selectedPointIndices=None, computeOutputPointsOnly=True, useWarpCache=False, referenceFrameOutputPath=None, verifyOutput=False, useResultCache=False, traceOutputPath=None, useHybridCorrespondence=False, calibrateFastCorrespondence=False, calibrationCount=20, calibrationSizeDirectory=None, correspondenceStorePath=None, resultCacheSizeGB=16):
+    # Put every subject in meshDirectory/landmarkDirectory into correspondence
+    # with the atlas and write their points, and the atlas points, to
+    # outputDirectory. The reference frame of the run (see _buildReferenceFrame)
+    # is written to referenceFrameOutputPath, so that new specimens can be
+    # appended to it later (appendDeCAL). Subjects completed by an earlier run
+    # into outputDirectory are skipped (see _correspondDeCALSubjects for the
+    # other options). Returns the atlas point node.
+    if correspondenceStorePath:
+      self._ensureH5py()
+    landmarks, meshPaths, meshMatrices = self._loadDeCALSubjects(meshDirectory, landmarkDirectory, outputDirectory, progressCallback)
+    # The hybrid method is the fast nearest-vertex query projected onto the
+    # triangles around each vertex and onto every triangle that could hold a
+    # nearer point: exact-method results from vectorized queries (see
+    # closestPoint.projectedNearestVertices).
+    if useHybridCorrespondence:
+      useFastCorrespondence = True
+    if useFastCorrespondence:
+      # install scipy here, once, rather than in every worker
+      useFastCorrespondence = self._ensureScipy()
+    frame, meanWarpedBase = self._buildReferenceFrame(baseNode, baseLMPath, landmarks, spacingTolerance, useFastCorrespondence,
+      useNumpyTPS, useHybridCorrespondence and useFastCorrespondence, selectedPointIndices)
+    if referenceFrameOutputPath:
+      referenceFrame.writeReferenceFrame(referenceFrameOutputPath, frame)
+    # Each output point's correspondence depends only on its own meanWarpedBase
+    # point (closest-point query and inverse TPS are both per point), so by default
+    # only the output points are queried and inverse-warped. The written files are
+    # identical to querying the full-resolution base and subsetting afterwards.
+    meanWarpedBase = None if computeOutputPointsOnly else meanWarpedBase
+    self._correspondDeCALSubjects(frame, landmarks, meshPaths, meshMatrices, outputDirectory, progressCallback, workers, parallelSubjects,
+      useWarpCache, verifyOutput, useResultCache, resultCacheSizeGB, correspondenceStorePath, traceOutputPath, meanWarpedBase=meanWarpedBase)
+    return self._finishDeCAL(frame, landmarks, meshPaths, meshMatrices, outputDirectory, progressCallback, workers,
+      calibrateFastCorrespondence, calibrationCount, calibrationSizeDirectory, meanWarpedBase)
+
+  def freezeDeCALFrame(self, baseNode, baseLMPath, landmarkDirectory, spacingTolerance, referenceFrameOutputPath, progressCallback=None, useFastCorrespondence=False, useNumpyTPS=False, useHybridCorrespondence=False, selectedPointIndices=None):
+    # First step of a distributed DeCAL run: compute the run's reference frame
+    # from the atlas and every subject's landmarks and write it to
+    # referenceFrameOutputPath, without computing any subject. The subjects are
+    # then computed by any number of processes running correspondDistributedDeCAL
+    # against this frame, and finalizeDeCAL completes the run. Returns the frame.
+    landmarks = self.importLandmarks(landmarkDirectory, progressCallback)[1]
+    if useHybridCorrespondence:
+      useFastCorrespondence = True
+    if useFastCorrespondence:
+      useFastCorrespondence = self._ensureScipy()
+    frame = self._buildReferenceFrame(baseNode, baseLMPath, landmarks, spacingTolerance, useFastCorrespondence,
+      useNumpyTPS, useHybridCorrespondence and useFastCorrespondence, selectedPointIndices)[0]
+    referenceFrame.writeReferenceFrame(referenceFrameOutputPath, frame)
+    return frame
+
+  def appendDeCAL(self, meshDirectory, landmarkDirectory, outputDirectory, referenceFramePath, progressCallback=None, workers=1, parallelSubjects=False, useWarpCache=False, verifyOutput=False, useResultCache=False, traceOutputPath=None, calibrateFastCorrespondence=False, calibrationCount=20, calibrationSizeDirectory=None, correspondenceStorePath=None, resultCacheSizeGB=16):
+    # Add new specimens to an earlier run: the mean shape, warped base and
+    # output points come from the run's frozen reference frame at
+    # referenceFramePath, so subjects already in outputDirectory stay valid
+    # (their journal entries match) and only new ones are computed. The frame's
+    # correspondence settings apply. Returns the atlas point node.
+    if correspondenceStorePath:
+      self._ensureH5py()
+    frame = self._readReferenceFrame(referenceFramePath)
+    landmarks, meshPaths, meshMatrices = self._loadDeCALSubjects(meshDirectory, landmarkDirectory, outputDirectory, progressCallback)
+    self._correspondDeCALSubjects(frame, landmarks, meshPaths, meshMatrices, outputDirectory, progressCallback, workers, parallelSubjects,
+      useWarpCache, verifyOutput, useResultCache, resultCacheSizeGB, correspondenceStorePath, traceOutputPath)
+    return self._finishDeCAL(frame, landmarks, meshPaths, meshMatrices, outputDirectory, progressCallback, workers,
+      calibrateFastCorrespondence, calibrationCount, calibrationSizeDirectory)
+
+  def correspondDistributedDeCAL(self, meshDirectory, landmarkDirectory, outputDirectory, referenceFramePath, progressCallback=None, workers=1, parallelSubjects=False, useWarpCache=False, verifyOutput=False, useResultCache=False, traceOutputPath=None, resultCacheSizeGB=16):
+    # One process of a distributed DeCAL run. Any number of processes, on any
+    # hosts sharing outputDirectory, run this at once against the frame written
+    # by freezeDeCALFrame: each subject is claimed through the work queue's lock
+    # files before its mesh is hashed and it is computed, so no process reads
+    # the meshes of subjects others take. Claims of a process that died are
+    # taken over once stale. The atlas points, calibration and correspondence
+    # store, which need the whole sample, are left to finalizeDeCAL.
+    frame = self._readReferenceFrame(referenceFramePath)
+    landmarks, meshPaths, meshMatrices = self._loadDeCALSubjects(meshDirectory, landmarkDirectory, outputDirectory, progressCallback)
+    self._correspondDeCALSubjects(frame, landmarks, meshPaths, meshMatrices, outputDirectory, progressCallback, workers, parallelSubjects,
+      useWarpCache, verifyOutput, useResultCache, resultCacheSizeGB, traceOutputPath=traceOutputPath,
+      queue=WorkQueue(os.path.join(outputDirectory, ".decal_queue")))
+
+  def _loadDeCALSubjects(self, meshDirectory, landmarkDirectory, outputDirectory, progressCallback=None):
+    # The subjects of a DeCAL run: their landmarks (all loaded -- they are small
+    # and Procrustes needs the whole sample), mesh paths and the alignment to
+    # apply when each mesh is read (None for meshes runAlign wrote). Meshes are
+    # in the same sorted order as the landmarks, so the i-th mesh matches the
+    # i-th landmark block; they are read one at a time as they are computed, to
+    # keep memory flat on large datasets.
     self.outputDirectory = outputDirectory
-    # Landmarks are small, so load them all -- Procrustes needs the whole sample.
-    landmarkNames, landmarks = self.importLandmarks(landmarkDirectory, progressCallback)
-    # Mesh files in the same sorted order importMeshes/importLandmarks use, so the
-    # i-th mesh matches the i-th landmark block. Meshes are loaded one at a time in
-    # the loop below (not all up front) to keep memory flat on large datasets.
-    meshFiles = sorted(f for f in os.listdir(meshDirectory) if f.endswith(tuple(modelExt)))
-    self.modelNames = [os.path.splitext(f)[0] for f in meshFiles]
-    # meanShape, meanWarpedBase and the subsampling index are all independent of the
-    # per-subject correspondence, so compute them once up front. This lets each
-    # subject be computed, written and discarded inside the loop instead of building
-    # every corresponding mesh in memory and writing them all at the end.
-    meanShape, alignedPoints = self.procrustesImposition(landmarks, False)
+    landmarks = self.importLandmarks(landmarkDirectory, progressCallback)[1]
+    meshSources = alignment.meshSources(meshDirectory, ['ply', 'stl', 'vtp', 'vtk'])
+    self.modelNames = [name for name, _, _ in meshSources]
+    meshPaths = [path for _, path, _ in meshSources]
+    meshMatrices = [matrix for _, _, matrix in meshSources]
+    return landmarks, meshPaths, meshMatrices
+
+  def _buildReferenceFrame(self, baseNode, baseLMPath, landmarks, spacingTolerance, useFastCorrespondence, useNumpyTPS, useHybridCorrespondence, selectedPointIndices=None):
+    # The reference frame (see referenceFrame.ReferenceFrame) of a DeCAL run
+    # over landmarks: meanShape, meanWarpedBase and the output points are all
+    # independent of the per-subject correspondence, so they are computed once
+    # up front. Also returns the full-resolution meanWarpedBase polydata.
+    baseLandmarks = self.fiducialNodeToPolyData(baseLMPath, False).GetPoints()
+    meanShape = self.procrustesImposition(landmarks, False)[0]
     meanWarpedBase = self._warpBaseMesh(baseNode.GetPolyData(), baseLandmarks, meanShape)
     indexArrayName = "indexArray"
     self.addIndexArray(baseNode, indexArrayName)
-    templateModel = self.downsampleModel(baseNode, spacingPercentage)
+    templateModel = self.downsampleModel(baseNode, spacingTolerance/100)
     templateIndex = templateModel.GetPointData().GetArray(indexArrayName)
     if not templateIndex:
-      print("No index found")
-      return None
-    sampleNumber = alignedPoints.GetNumberOfBlocks()
-    pointCount = templateIndex.GetNumberOfValues()
+      raise ValueError("The subsampled template has no index of atlas points")
+    # The written points are the downsampled template (labelled by their template
+    # position), optionally restricted to selectedPointIndices, a subset of those
+    # template positions (e.g. the points selected in the pointSelection node).
+    templateIndexArray = vtk_np.vtk_to_numpy(templateIndex)
+    outputLabels = np.arange(templateIndex.GetNumberOfValues())
+    if selectedPointIndices is not None:
+      outputLabels = np.unique(np.asarray(selectedPointIndices, dtype=int))
+      if len(outputLabels) == 0 or outputLabels[0] < 0 or outputLabels[-1] >= len(templateIndexArray):
+        raise ValueError(f"The point selection does not match the subsampled template ({len(templateIndexArray)} points). "
+          "Select points on the atlas point set from a DeCAL run with the same point density.")
+    outputIndex = templateIndexArray[outputLabels]
+    meanShapeXYZ = vtk_np.vtk_to_numpy(meanShape.GetData())
+    atlasLandmarkXYZ = vtk_np.vtk_to_numpy(baseLandmarks.GetData())
+    settings = {"useFastCorrespondence": bool(useFastCorrespondence), "useNumpyTPS": bool(useNumpyTPS),
+                "spacingTolerance": float(spacingTolerance)}
+    # only recorded when set, so the keys of fast and exact runs are unchanged
+    if useHybridCorrespondence:
+      settings["useHybridCorrespondence"] = True
+    runKey = resultCache.runKey(baseNode.GetPolyData(), atlasLandmarkXYZ, meanShapeXYZ, outputIndex, settings)
+    frame = referenceFrame.ReferenceFrame(meanShapeXYZ, atlasLandmarkXYZ,
+      vtk_np.vtk_to_numpy(meanWarpedBase.GetPoints().GetData())[outputIndex],
+      vtk_np.vtk_to_numpy(baseNode.GetPolyData().GetPoints().GetData())[outputIndex],
+      outputIndex, outputLabels, settings, runKey)
+    return frame, meanWarpedBase
+
+  def _readReferenceFrame(self, referenceFramePath):
+    frame = referenceFrame.readReferenceFrame(referenceFramePath)
+    if frame.settings["useFastCorrespondence"] and not self._ensureScipy():
+      raise ValueError("The reference frame was computed with fast correspondence, which requires scipy.")
+    return frame
+
+  def _correspondenceInputs(self, frame, meanWarpedBase=None):
+    # The mean shape, the base queried for each subject and the index of the
+    # output points in it (None when the base holds only the output points).
+    # meanWarpedBase: the full-resolution base, queried whole and subset after.
+    if meanWarpedBase is not None:
+      return correspondence.pointsFromArray(frame.meanShape), meanWarpedBase, frame.outputIndex
+    correspondenceBase = vtk.vtkPolyData()
+    correspondenceBase.SetPoints(correspondence.pointsFromArray(frame.meanWarpedBase))
+    return correspondence.pointsFromArray(frame.meanShape), correspondenceBase, None
+
+  def _correspondDeCALSubjects(self, frame, landmarks, meshPaths, meshMatrices, outputDirectory, progressCallback=None, workers=1, parallelSubjects=False, useWarpCache=False, verifyOutput=False, useResultCache=False, resultCacheSizeGB=16, correspondenceStorePath=None, traceOutputPath=None, queue=None, meanWarpedBase=None):
+    # Compute, in frame, every subject of landmarks/meshPaths that outputDirectory
+    # does not hold yet, and write each as soon as it is computed, so a crash
+    # keeps every file already written. Resuming, the result cache, the
+    # correspondence store and the work queue of a distributed run are all
+    # handled per subject by subjectTracker.SubjectTracker. Options:
+    #   useResultCache       every computed subject is also kept under its key
+    #                        in Slicer's cache folder (up to resultCacheSizeGB),
+    #                        so a run into another output folder reuses exactly
+    #                        the subjects whose inputs are unchanged
+    #   useWarpCache         subjects warped onto the same mean shape by an
+    #                        earlier run are reused from the on-disk warp cache
+    #   correspondenceStorePath  every subject's fixed and semi-landmarks also go
+    #                        into one HDF5 file (see correspondenceStore)
+    #   traceOutputPath      every subject's time in each stage (mesh load,
+    #                        forward TPS, locator build, query, inverse TPS,
+    #                        write), including the stages run by worker
+    #                        processes, is written there as a Chrome trace (or as
+    #                        JSON lines for a .jsonl path)
+    #   queue                workQueue.WorkQueue of a distributed run
+    # Cache hit counts and stage totals are reported in resultCacheSummary,
+    # warpCacheSummary and traceSummary.
+    self.warpCacheSummary = None
+    self.resultCacheSummary = None
+    self.traceSummary = None
+    self.calibrationSummary = None
+    useFastCorrespondence = frame.settings["useFastCorrespondence"]
+    useHybridCorrespondence = frame.settings.get("useHybridCorrespondence", False)
+    useNumpyTPS = frame.settings["useNumpyTPS"]
+    meanShape, correspondenceBase, correspondenceIndex = self._correspondenceInputs(frame, meanWarpedBase)
+    sampleNumber = landmarks.GetNumberOfBlocks()
     print("sample number:", sampleNumber)
-    # The resume-by-file-existence below only checks point count, which is identical
-    # for the exact and fast correspondence methods, so resuming into a folder that
-    # already holds results from a different method (or point density) would silently
-    # blend them. Record this run's method + point count once (in the parent run
-    # folder, which no landmark loader reads) and refuse to reuse a folder whose
-    # recorded settings differ, so mismatches fail loudly instead of mixing methods.
-    # The normal workflow writes each run to its own timestamped folder, so this only
-    # trips on deliberate folder reuse.
-    import json
-    runInfo = {"useFastCorrespondence": bool(useFastCorrespondence), "pointCount": int(pointCount)}
-    runInfoPath = os.path.join(os.path.dirname(os.path.normpath(outputDirectory)), ".decal_run_info")
-    if os.path.exists(runInfoPath):
-      try:
-        with open(runInfoPath) as runInfoFile:
-          existingRunInfo = json.load(runInfoFile)
-      except Exception:
-        existingRunInfo = None
-      if existingRunInfo != runInfo:
-        raise ValueError(
-          "The output folder already holds DeCAL results computed with different settings "
-          "(%s vs requested %s). Use a fresh output folder so exact and fast correspondences "
-          "are never mixed in one result." % (existingRunInfo, runInfo))
-    else:
-      try:
-        with open(runInfoPath, "w") as runInfoFile:
-          json.dump(runInfo, runInfoFile)
-      except OSError:
-        pass  # marker is best-effort; do not fail the run if it cannot be written
-    # Write each subject's downsampled correspondence as soon as it is computed. A
-    # crash then keeps every file already written, and re-running skips subjects
-    # whose output already exists (resume). Batch the scene state and pause
-    # rendering so the per-point AddControlPoint calls and the on-demand model
+    landmarkXYZ = [vtk_np.vtk_to_numpy(landmarks.GetBlock(i).GetPoints().GetData()) for i in range(sampleNumber)]
+    correspondenceCache = self._createResultCache(resultCacheSizeGB) if useResultCache else None
+    # Subject-pool mode runs whole subjects (mesh load, forward TPS, query,
+    # inverse TPS) in worker processes and writes their results here as they
+    # finish. Otherwise subjects run in this process and only the exact query is
+    # spread over a pool of worker processes that lives for the whole loop (the
+    # fast query is already vectorized and multithreaded).
+    useSubjectPool = parallelSubjects and parallel.resolveWorkerCount(workers) > 1
+    exactEngine = None if (useFastCorrespondence or useSubjectPool) else self._createExactEngine(workers)
+    inverseSpline, inverseCoefficients = self._inverseSplines(meanShape, landmarks, useNumpyTPS and not useSubjectPool)
+    warpCache = self._createWarpCache() if useWarpCache else None
+    trace = profiling.StageTrace(self.modelNames) if traceOutputPath else None
+    previousTrace = profiling.setActiveTrace(trace)
+    store = None
+    tracker = None
+    # Batch the scene state and pause rendering so the on-demand model
     # loads/removes do not fire per-item scene updates or renders.
-    basePointNode = None
     slicer.app.pauseRender()
     slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
     try:
+      if correspondenceStorePath:
+        store = self._openCorrespondenceStore(correspondenceStorePath, frame.atlasLandmarks, frame.atlasPoints, frame.outputLabels,
+          frame.runKey, frame.settings)
+      tracker = SubjectTracker(outputDirectory, frame.runKey, self.modelNames, meshPaths, landmarkXYZ, meshMatrices, frame.outputLabels,
+        verifyOutput=verifyOutput, cache=correspondenceCache, store=store, queue=queue)
+      pendingSubjects = []
       for i in range(sampleNumber):
         if progressCallback:
-          progressCallback(i + 1, sampleNumber, "Computing dense correspondence")
-        outputLMPath = os.path.join(outputDirectory, self.modelNames[i] + ".mrk.json")
-        if os.path.exists(outputLMPath) and self._existingLandmarkFileIsComplete(outputLMPath, pointCount):
-          print("Skipping " + self.modelNames[i] + ": complete output already present (resume)")
+          progressCallback(i + 1, sampleNumber, "Computing dense correspondence" if not useSubjectPool else "Checking cached results")
+        if not tracker.isPending(i):
+          continue
+        if useSubjectPool:
+          pendingSubjects.append(i)
+          continue
+        if not tracker.claim(i):
           continue
-        subjectModelNode = slicer.util.loadModel(os.path.join(meshDirectory, meshFiles[i]))
-        correspondingMesh = self.denseSurfaceCorrespondencePair(
-          subjectModelNode.GetPolyData(), landmarks.GetBlock(i).GetPoints(),
-          meanWarpedBase, meanShape, i, useFast=useFastCorrespondence)
-        alignedPointNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', "alignedPoints")
-        for j in range(pointCount):
-          baseIndex = templateIndex.GetValue(j)
-          alignedPointNode.AddControlPoint(correspondingMesh.GetPoint(baseIndex), str(j))
-        slicer.util.saveNode(alignedPointNode, outputLMPath)
-        self._removeNodeFully(alignedPointNode)
-        self._removeNodeFully(subjectModelNode)
-      # atlas (base) correspondence -- independent of the subjects
-      basePointNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', "atlasLandmarks")
-      for j in range(pointCount):
-        baseIndex = templateIndex.GetValue(j)
-        basePointNode.AddControlPoint(baseNode.GetPolyData().GetPoint(baseIndex), str(j))
-      baseLMPath = os.path.join(outputDirectory, "atlas.mrk.json")
-      slicer.util.saveNode(basePointNode, baseLMPath)
+        with profiling.subject(i):
+          # the mesh is passed as a path: it is only read if the warp is not cached
+          correspondingMesh = self.denseSurfaceCorrespondencePair(
+            meshPaths[i] if meshMatrices[i] is None else alignment.readAlignedMesh(meshPaths[i], meshMatrices[i]), landmarks.GetBlock(i).GetPoints(),
+            correspondenceBase, meanShape, i, useFast=useFastCorrespondence, exactEngine=exactEngine,
+            inverseSpline=inverseSpline, inverseCoefficients=inverseCoefficients[i] if inverseSpline is not None else None,
+            warpCache=warpCache, hybrid=useHybridCorrespondence)
+          correspondingXYZ = vtk_np.vtk_to_numpy(correspondingMesh.GetPoints().GetData())
+          if correspondenceIndex is not None:
+            correspondingXYZ = correspondingXYZ[correspondenceIndex]
+          tracker.finish(i, correspondingXYZ)
+      if pendingSubjects:
+        # Largest meshes first, so the slowest subjects do not start last. Workers
+        # return only the points that are written. Subjects are claimed only as
+        # they are handed to the pool, so the other processes of a distributed
+        # run can take the rest meanwhile.
+        pendingSubjects.sort(key=lambda i: os.path.getsize(meshPaths[i]), reverse=True)
+        jobs = ((i, meshPaths[i], landmarkXYZ[i], meshMatrices[i]) for i in pendingSubjects if tracker.claim(i))
+        completedOffset = sampleNumber - len(pendingSubjects)
+        with correspondence.SubjectCorrespondencePool(correspondenceBase, meanShape, workers, useFastCorrespondence,
+          outputIndex=correspondenceIndex, pythonExecutable=self._workerPythonExecutable(), useNumpyTPS=useNumpyTPS,
+          warpCache=warpCache, hybrid=useHybridCorrespondence) as pool:
+          for completedCount, (i, correspondingXYZ) in enumerate(pool.imapUnordered(jobs), start=completedOffset + 1):
+            if progressCallback:
+              progressCallback(completedCount, sampleNumber, "Computing dense correspondence")
+            with profiling.subject(i):
+              tracker.finish(i, correspondingXYZ)
+        if warpCache is not None:
+          warpCache.hits += pool.cacheHits
+          warpCache.misses += pool.cacheMisses
+      if correspondenceCache is not None:
+        correspondenceCache.evict()
+        self.resultCacheSummary = correspondenceCache.summary()
+        logging.info(self.resultCacheSummary)
+      if warpCache is not None:
+        self.warpCacheSummary = warpCache.summary()
+        logging.info(self.warpCacheSummary)
+      if trace is not None:
+        self.traceSummary = trace.summary()
+        logging.info(self.traceSummary)
     finally:
+      if exactEngine is not None:
+        exactEngine.close()
+      if tracker is not None:
+        tracker.close()
+      elif store is not None:
+        store.close()
+      profiling.setActiveTrace(previousTrace)
+      if trace is not None:
+        # also written when the run fails, to show where it spent its time
+        trace.write(traceOutputPath)
       slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
       slicer.app.resumeRender()
+
+  def _finishDeCAL(self, frame, landmarks, meshPaths, meshMatrices, outputDirectory, progressCallback=None, workers=1, calibrateFastCorrespondence=False, calibrationCount=20, calibrationSizeDirectory=None, meanWarpedBase=None):
+    # The steps of a DeCAL run that need the whole sample once every subject is
+    # written. Calibrated fast mode: estimate the fast (or hybrid) method's
+    # measurement error on a few subjects recomputed with the exact method and
+    # write corrected dispersion statistics next to the output (see
+    # _calibrateFastCorrespondence). Then the atlas (base) correspondence,
+    # independent of the subjects, is written; the returned node is loaded back
+    # from the written file, a single parse rather than one AddControlPoint call
+    # per point.
+    if calibrateFastCorrespondence:
+      if frame.settings["useFastCorrespondence"]:
+        meanShape, correspondenceBase, correspondenceIndex = self._correspondenceInputs(frame, meanWarpedBase)
+        self.calibrationSummary = self._calibrateFastCorrespondence(
+          meshPaths, landmarks,
+          [os.path.join(outputDirectory, name + ".mrk.json") for name in self.modelNames],
+          correspondenceBase, meanShape, correspondenceIndex, os.path.join(os.path.dirname(os.path.abspath(outputDirectory)), "fastCalibration"),
+          calibrationCount, calibrationSizeDirectory, workers, frame.settings["useNumpyTPS"], progressCallback, meshMatrices)
+        logging.info(self.calibrationSummary)
+      else:
+        logging.info("Fast correspondence calibration skipped: the run did not use the fast method")
+    baseLMPath = os.path.join(outputDirectory, "atlas.mrk.json")
+    self._saveDenseLandmarks(frame.atlasPoints, baseLMPath, frame.outputLabels)
+    basePointNode = slicer.util.loadMarkups(baseLMPath)
+    basePointNode.SetName("atlasLandmarks")
     return basePointNode
 
+  def finalizeDeCAL(self, meshDirectory, outputDirectory, referenceFramePath, landmarkDirectory=None, correspondenceStorePath=None):
+    # Last step of a distributed DeCAL run: once the work queue has every subject
+    # in meshDirectory done, write the atlas points, as runDeCAL does at the end
+    # of a single-process run, and with correspondenceStorePath the store of the
+    # whole sample from the written point lists and the landmarks in
+    # landmarkDirectory (the aligned landmarks the run used). Raises ValueError
+    # while subjects are outstanding. Returns the path of the written atlas
+    # point list.
+    if correspondenceStorePath:
+      self._ensureH5py()
+    frame = referenceFrame.readReferenceFrame(referenceFramePath)
+    modelNames = [name for name, _, _ in alignment.meshSources(meshDirectory, ('ply', 'stl', 'vtp', 'vtk'))]
+    queue = WorkQueue(os.path.join(outputDirectory, ".decal_queue"))
+    outstanding = [name for name in modelNames if not queue.isDone(name)]
+    if outstanding:
+      raise ValueError(f"{len(outstanding)} of {len(modelNames)} subjects are not finished yet, e.g. {outstanding[0]}")
+    baseLMPath = os.path.join(outputDirectory, "atlas.mrk.json")
+    self._saveDenseLandmarks(frame.atlasPoints, baseLMPath, frame.outputLabels)
+    if correspondenceStorePath:
+      # subjects pair with the landmark files by sorted position, as in runDeCAL
+      landmarkSet = self.readLandmarkSet(landmarkDirectory)
+      journal = OutputJournal(outputDirectory)
+      store = self._openCorrespondenceStore(correspondenceStorePath, frame.atlasLandmarks, frame.atlasPoints,
+        frame.outputLabels, frame.runKey, frame.settings)
+      try:
+        for i, name in enumerate(modelNames):
+          key = journal.entries[name]["key"]
+          if not store.contains(name, key):
+            store.write(name, key, np.concatenate((landmarkSet.subject(i),
+              markupsIO.readMarkupsPoints(os.path.join(outputDirectory, name + ".mrk.json")))))
+      finally:
+        store.close()
+    return baseLMPath
+
+  def runMethodComparison(self, baseNode, baseLMNode, meshDirectory, landmarkDirectory, outputDirectory, spacingTolerance, subjectCount=20, subjectIDs=None, progressCallback=None, workers=1, parallelSubjects=False, useNumpyTPS=False, useHybridCorrespondence=False):
+    # Check on a subset of the data whether the fast correspondence method is
+    # accurate enough before using it at full scale. The subset is aligned to
+    # the atlas, put into correspondence with the exact and with the fast method
+    # (each timed, with the result cache off) and mapped back to the original
+    # frames; the fixed plus semi-landmarks of the two methods are then compared
+    # as in docs/KD-fast-correspondence-eval.md (see methodComparison).
+    # subjectIDs (mesh file names without extension) selects the subjects,
+    # otherwise subjectCount subjects spread evenly over the sorted input are
+    # used. The subset's files, the outputs of both methods, the CSV tables and,
+    # with matplotlib, the figures are written to outputDirectory. With
+    # useHybridCorrespondence the hybrid method takes the place of the fast one.
+    # Returns the methodComparison.MethodComparison.
+    if not self._ensureScipy():
+      raise ValueError("The fast correspondence method requires scipy, which could not be installed.")
+    modelExt = ('ply', 'stl', 'vtp', 'vtk')
+    landmarkFileIndex = self.buildLandmarkFileIndex(landmarkDirectory)
+    meshFiles = sorted(f for f in os.listdir(meshDirectory) if f.endswith(modelExt) and not f.startswith(".")
+                       and os.path.splitext(f)[0] in landmarkFileIndex)
+    if subjectIDs:
+      subjectIDs = set(subjectIDs)
+      meshFiles = [f for f in meshFiles if os.path.splitext(f)[0] in subjectIDs]
+    elif len(meshFiles) > subjectCount:
+      meshFiles = [meshFiles[i] for i in np.unique(np.linspace(0, len(meshFiles) - 1, subjectCount).round().astype(int))]
+    if len(meshFiles) < 3:
+      raise ValueError("The method comparison needs at least three specimens with both a mesh and a landmark file")
+    folders = {role: os.path.join(outputDirectory, role) for role in ("originalModels", "originalLMs", "alignedModels", "alignedLMs", "alignmentTransforms")}
+    for folder in folders.values():
+      os.makedirs(folder, exist_ok=True)
+    subjectIDs = [os.path.splitext(f)[0] for f in meshFiles]
+    for meshFile, subjectID in zip(meshFiles, subjectIDs):
+      shutil.copy2(os.path.join(meshDirectory, meshFile), folders['originalModels'])
+      shutil.copy2(os.path.join(landmarkDirectory, landmarkFileIndex[subjectID]), folders['originalLMs'])
+    self.runAlign(baseNode, baseLMNode, folders['originalModels'], folders['originalLMs'], folders['alignedModels'], folders['alignedLMs'],
+      True, transformDirectory=folders['alignmentTransforms'], progressCallback=progressCallback, workers=workers if parallelSubjects else 1)
+    fixedLandmarks = [markupsIO.readMarkupsPoints(os.path.join(folders['originalLMs'], landmarkFileIndex[subjectID])) for subjectID in subjectIDs]
+    shapes = {}
+    seconds = {}
+    for method, useFast in (("exact", False), ("fast", True)):
+      # start from an empty folder: a resumed run would skip the computation
+      semiLMDirectory = os.path.join(outputDirectory, f"DeCALOutput_{method}")
+      shutil.rmtree(semiLMDirectory, ignore_errors=True)
+      os.makedirs(semiLMDirectory)
+      start = time.perf_counter()
+      self.runDeCAL(baseNode, baseLMNode, folders['alignedModels'], folders['alignedLMs'], semiLMDirectory, spacingTolerance, progressCallback,
+        useFastCorrespondence=useFast, useHybridCorrespondence=useFast and useHybridCorrespondence, workers=workers,
+        parallelSubjects=parallelSubjects, useNumpyTPS=useNumpyTPS, useResultCache=False)
+      seconds[method] = time.perf_counter() - start
+      originalFrameDirectory = semiLMDirectory + "_originalFrame"
+      self.runBackTransformLandmarks(semiLMDirectory, folders['alignmentTransforms'], originalFrameDirectory)
+      shapes[method] = [np.concatenate((fixedXYZ, markupsIO.readMarkupsPoints(os.path.join(originalFrameDirectory, subjectID + "_align.mrk.json"))))
+                        for subjectID, fixedXYZ in zip(subjectIDs, fixedLandmarks)]
+    comparison = methodComparison.MethodComparison(subjectIDs, shapes["exact"], shapes["fast"], seconds["exact"], seconds["fast"])
+    comparison.writeTables(outputDirectory)
+    try:
+      comparison.writeFigures(outputDirectory)
+    except ImportError:
+      try:
+        slicer.util.pip_install('matplotlib')
+        comparison.writeFigures(outputDirectory)
+      except Exception:
+        logging.warning("The comparison figures need matplotlib, which could not be installed; only the tables were written.")
+    logging.info(comparison.describe())
+    return comparison
+
+  def _calibrateFastCorrespondence(self, meshPaths, landmarks, outputLMPaths, correspondenceBase, meanShape, correspondenceIndex, calibrationDirectory, calibrationCount=20, sizeLandmarkDirectory=None, workers=1, useNumpyTPS=False, progressCallback=None, meshMatrices=None):
+    # Measurement-error calibration of a fast or hybrid DeCAL run (section 4 of
+    # docs/KD-fast-correspondence-eval.md). Snapping to vertices adds small
+    # isotropic noise, so PD^2(fast) ~ PD^2(exact) + sigma^2; for a hybrid run
+    # the estimate measures whatever difference from the exact method is left. calibrationCount
+    # subjects stratified by centroid size are recomputed with the exact method
+    # on worker processes, and sigma^2 is the mean squared Procrustes distance
+    # between their exact and fast point sets (fixed plus semi-landmarks, as in
+    # the merged output). Centroid sizes come from the landmarks in
+    # sizeLandmarkDirectory, matched by subject name, if given (pass the
+    # original landmarks when the input was aligned with scale removed), and
+    # otherwise from the input landmarks. The estimate and the sample's
+    # Procrustes variance and distances before and after correction are written
+    # to calibrationDirectory (see methodComparison.writeCalibration). Returns a
+    # one-line summary.
+    fixedLandmarks = [vtk_np.vtk_to_numpy(landmarks.GetBlock(i).GetPoints().GetData()) for i in range(landmarks.GetNumberOfBlocks())]
+    sizes = procrustes.centroidSizes(np.asarray(fixedLandmarks))
+    if sizeLandmarkDirectory:
+      landmarkFileIndex = self.buildLandmarkFileIndex(sizeLandmarkDirectory)
+      for i, name in enumerate(self.modelNames):
+        subjectID = name[:-len("_align")] if name.endswith("_align") else name
+        if subjectID in landmarkFileIndex:
+          sizes[i] = procrustes.centroidSizes(markupsIO.readMarkupsPoints(os.path.join(sizeLandmarkDirectory, landmarkFileIndex[subjectID])))
+    calibrationIndices = methodComparison.stratifiedBySize(sizes, calibrationCount)
+    exactXYZ = {}
+    jobs = ((i, meshPaths[i], fixedLandmarks[i], meshMatrices[i] if meshMatrices else None) for i in calibrationIndices)
+    with correspondence.SubjectCorrespondencePool(correspondenceBase, meanShape, workers, False, outputIndex=correspondenceIndex,
+      pythonExecutable=self._workerPythonExecutable(), useNumpyTPS=useNumpyTPS) as pool:
+      for completedCount, (i, correspondingXYZ) in enumerate(pool.imapUnordered(jobs), start=1):
+        if progressCallback:
+          progressCallback(completedCount, len(calibrationIndices), "Calibrating fast correspondence")
+        exactXYZ[i] = correspondingXYZ
+    fastShapes = np.asarray([np.concatenate((fixedLandmarks[i], markupsIO.readMarkupsPoints(outputLMPaths[i]))) for i in range(len(fixedLandmarks))])
+    exactShapes = np.asarray([np.concatenate((fixedLandmarks[i], exactXYZ[i])) for i in calibrationIndices])
+    pairedDistances = methodComparison.pairedProcrustesDistances(exactShapes, fastShapes[calibrationIndices])
+    dispersion = methodComparison.correctedDispersion(fastShapes, float(np.mean(pairedDistances ** 2)))
+    summary = methodComparison.writeCalibration(calibrationDirectory, self.modelNames, calibrationIndices, sizes[calibrationIndices],
+      pairedDistances, dispersion)
+    return (f"fast correspondence calibration on {len(calibrationIndices)} subjects: sigma^2 = {summary['sigma2']:.3g}, "
+            f"Procrustes variance {summary['procrustesVariance']:.4g} -> {summary['correctedProcrustesVariance']:.4g} corrected "
+            f"(saved to {calibrationDirectory})")
+
+  def _openCorrespondenceStore(self, path, atlasLandmarkXYZ, atlasPointXYZ, outputLabels, runKey, settings):
+    # The correspondence store of a DeCAL run (see correspondenceStore); h5py
+    # must be available (see _ensureH5py).
+    from DeCALib.correspondenceStore import FIXED, SEMI, CorrespondenceStore
+    fixedCount = len(atlasLandmarkXYZ)
+    return CorrespondenceStore.openForWriting(path, np.concatenate((atlasLandmarkXYZ, atlasPointXYZ)),
+      np.repeat([FIXED, SEMI], [fixedCount, len(atlasPointXYZ)]),
+      np.concatenate((np.arange(1, fixedCount + 1), outputLabels)), runKey, settings)
+
+  def _ensureH5py(self):
+    # h5py is needed by the correspondence store; install it on first use. Raises
+    # ValueError if it cannot be made available, before the run computes anything.
+    try:
+      import h5py
+    except ImportError:
+      try:
+        slicer.util.pip_install('h5py')
+        import h5py
+      except Exception:
+        raise ValueError("The correspondence store needs h5py, which could not be imported or installed.")
+
+  def _saveDenseLandmarks(self, pointsXYZ, outputLMPath, labels=None):
+    # Save an (N, 3) array of DeCAL points as a markups file, labelled with their
+    # template positions (0..N-1 unless labels are given). Written directly from
+    # the array in one pass; no markups node is built.
+    with profiling.stage("write"):
+      markupsIO.writeMarkups(outputLMPath, pointsXYZ, labels)
+
   def runMergeLandmarks(self, fixedLMDirectory, semiLMDirectory, outputDirectory, atlasFixedLMPath=None):
     # Merge each subject's fixed landmarks (used to establish correspondence) with
     # the DeCAL-generated semi-landmarks, and also merge the atlas itself (its fixed
@@ -1251,57 +2128,52 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     # matched by the landmark file's basename (optionally with transformSuffix
     # removed, e.g. "_merged"). Files with no matching transform - notably the
     # atlas point set, which is already the reference frame - are skipped.
+    # Transforms come from the folder's transform table, or from the one .h5
+    # file per subject that runs before the table wrote.
     # Returns the number of files written.
     if not os.path.isdir(landmarkDirectory):
       return 0
     os.makedirs(outputDirectory, exist_ok=True)
+    transformTable = alignment.TransformTable.read(transformDirectory) if os.path.isdir(transformDirectory) else alignment.TransformTable()
     writtenCount = 0
-    # each file loads/saves markups and transform nodes; batching the scene state
-    # and pausing rendering around the loop suppresses per-node scene updates (same
-    # optimization as runMergeLandmarks). EndState/resumeRender must always run.
-    slicer.app.pauseRender()
-    slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
-    try:
-      for lmFileName in sorted(os.listdir(landmarkDirectory)):
-        if lmFileName.startswith(".") or not lmFileName.endswith((".fcsv", ".json")):
-          continue
-        base = Path(lmFileName)
-        while base.suffix in {'.fcsv', '.mrk', '.json'}:
-          base = base.with_suffix('')
-        transformKey = str(base)
-        if transformSuffix and transformKey.endswith(transformSuffix):
-          transformKey = transformKey[:-len(transformSuffix)]
-        transformPath = os.path.join(transformDirectory, transformKey + ".h5")
-        if not os.path.exists(transformPath):
+    for lmFileName in sorted(os.listdir(landmarkDirectory)):
+      if lmFileName.startswith(".") or not lmFileName.endswith((".fcsv", ".json")):
+        continue
+      base = Path(lmFileName)
+      while base.suffix in {'.fcsv', '.mrk', '.json'}:
+        base = base.with_suffix('')
+      transformKey = str(base)
+      if transformSuffix and transformKey.endswith(transformSuffix):
+        transformKey = transformKey[:-len(transformSuffix)]
+      try:
+        forwardMatrix = transformTable.matrix(transformKey[:-len("_align")]) if transformKey.endswith("_align") else None
+        if forwardMatrix is None:
+          forwardMatrix = self._loadLinearTransformMatrix(os.path.join(transformDirectory, transformKey + ".h5"))
+        if forwardMatrix is None:
           # expected for the atlas point set (no per-subject alignment); log for others
           logging.info(f"DeCAL back-transform: no alignment transform for {lmFileName}, skipping")
           continue
-        lmNode = xfNode = inverseNode = None
-        try:
-          lmNode = slicer.util.loadMarkups(os.path.join(landmarkDirectory, lmFileName))
-          xfNode = slicer.util.loadTransform(transformPath)
-          forwardMatrix = vtk.vtkMatrix4x4()
-          if not xfNode.GetMatrixTransformToParent(forwardMatrix):
-            raise ValueError("alignment transform is not linear")
-          inverseMatrix = vtk.vtkMatrix4x4()
-          vtk.vtkMatrix4x4.Invert(forwardMatrix, inverseMatrix)
-          inverseNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "DeCALInverseTransform")
-          inverseNode.SetMatrixTransformToParent(inverseMatrix)
-          lmNode.SetAndObserveTransformNodeID(inverseNode.GetID())
-          slicer.vtkSlicerTransformLogic().hardenTransform(lmNode)
-          slicer.util.saveNode(lmNode, os.path.join(outputDirectory, lmFileName))
-          writtenCount += 1
-        except Exception as e:
-          logging.warning(f"DeCAL back-transform: skipping {lmFileName} ({e})")
-        finally:
-          for node in (lmNode, xfNode, inverseNode):
-            if node is not None:
-              slicer.mrmlScene.RemoveNode(node)
-    finally:
-      slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
-      slicer.app.resumeRender()
+        pointsXYZ, labels, descriptions = markupsIO.readMarkups(os.path.join(landmarkDirectory, lmFileName))
+        markupsIO.writeMarkups(os.path.join(outputDirectory, lmFileName),
+          alignment.applyMatrix(np.linalg.inv(forwardMatrix), pointsXYZ), labels, descriptions)
+        writtenCount += 1
+      except Exception as e:
+        logging.warning(f"DeCAL back-transform: skipping {lmFileName} ({e})")
     return writtenCount
 
+  def _loadLinearTransformMatrix(self, transformPath):
+    # 4x4 matrix of a linear transform file, or None if there is no such file.
+    if not os.path.exists(transformPath):
+      return None
+    xfNode = slicer.util.loadTransform(transformPath)
+    try:
+      matrix = vtk.vtkMatrix4x4()
+      if not xfNode.GetMatrixTransformToParent(matrix):
+        raise ValueError("alignment transform is not linear")
+      return np.array([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+    finally:
+      slicer.mrmlScene.RemoveNode(xfNode)
+
   def downsampleModel(self, model, spacingPercentage):
     points=model.GetPolyData()
     cleanFilter=vtk.vtkCleanPolyData()
@@ -1327,116 +2199,39 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     normals.Update()
     inputModel.SetAndObservePolyData(normals.GetOutput())
 
-  def runMirroring(self, meshDirectory, lmDirectory, mirrorMeshDirectory, mirrorLMDirectory, mirrorAxis, mirrorIndexText, slmDirectory=None, outputSLMDirectory=None, mirrorSLMIndexText=None):
-    mirrorMatrix = vtk.vtkMatrix4x4()
-    mirrorMatrix.SetElement(0, 0, mirrorAxis[0])
-    mirrorMatrix.SetElement(1, 1, mirrorAxis[1])
-    mirrorMatrix.SetElement(2, 2, mirrorAxis[2])
-    lmFileList = os.listdir(lmDirectory)
-    point=[0,0,0]
+  def runMirroring(self, meshDirectory, lmDirectory, mirrorMeshDirectory, mirrorLMDirectory, mirrorAxis, mirrorIndexText, slmDirectory=None, outputSLMDirectory=None, mirrorSLMIndexText=None, progressCallback=None, workers=1):
+    # Write a mirrored copy of every subject (see alignment.writeMirroredSubject),
+    # reading and writing the files without the scene, up to workers subjects at
+    # a time (0: all cores; 1: in this process), as runAlign does.
     #get order of mirrored sets
-    if len(mirrorIndexText) != 0:
-      mirrorIndexList=mirrorIndexText.split(",")
-      mirrorIndexList=[int(x) for x in mirrorIndexList]
-      mirrorIndex=np.asarray(mirrorIndexList)
-    else:
-      print("Error: no landmark index for mirrored mesh")
-    semilandmarkOption = bool(slmDirectory and outputSLMDirectory and (len(mirrorSLMIndexText) != 0))
-    if semilandmarkOption:
-      mirrorSLMIndexList=mirrorSLMIndexText.split(",")
-      mirrorSLMIndexList=[int(x) for x in mirrorSLMIndexList]
-      mirrorSLMIndex=np.asarray(mirrorSLMIndexList)
+    if len(mirrorIndexText) == 0:
+      raise ValueError("Error: no landmark index for mirrored mesh")
+    mirrorIndex = np.asarray([int(x) for x in mirrorIndexText.split(",")])
+    semilandmarkOption = bool(slmDirectory and outputSLMDirectory and mirrorSLMIndexText)
+    mirrorSLMIndex = np.asarray([int(x) for x in mirrorSLMIndexText.split(",")]) if semilandmarkOption else None
+    landmarkFileIndex = self.buildLandmarkFileIndex(lmDirectory)
     # Fail fast if mesh/landmark filenames do not line up (same exact-base-name
     # matching as runAlign); otherwise every subject is silently skipped.
-    self.checkMeshLandmarkMatch(meshDirectory, lmDirectory)
-    for meshFileName in os.listdir(meshDirectory):
-      if(not meshFileName.startswith(".")):
-        meshFilePath = os.path.join(meshDirectory, meshFileName)
-        currentMeshNode = slicer.util.loadModel(meshFilePath)
-        subjectID = os.path.splitext(meshFileName)[0]
-        currentLMNode = self.getLandmarkFileByID(lmDirectory, subjectID)
-        if currentLMNode:
-          lmFilePath = os.path.join(lmDirectory, subjectID)
-          targetPoints = vtk.vtkPoints()
-          for i in range(currentLMNode.GetNumberOfControlPoints()):
-            point = currentLMNode.GetNthControlPointPosition(i)
-            targetPoints.InsertNextPoint(point)
-          mirrorTransform = vtk.vtkTransform()
-          mirrorTransform.SetMatrix(mirrorMatrix)
-          mirrorTransformNode=slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode","Mirror")
-          mirrorTransformNode.SetAndObserveTransformToParent(mirrorTransform)
-          # apply transform to the current surface mesh and landmarks
-          currentMeshNode.SetAndObserveTransformNodeID(mirrorTransformNode.GetID())
-          currentLMNode.SetAndObserveTransformNodeID(mirrorTransformNode.GetID())
-          slicer.vtkSlicerTransformLogic().hardenTransform(currentMeshNode)
-          slicer.vtkSlicerTransformLogic().hardenTransform(currentLMNode)
-          # apply rigid transformation
-          sourcePoints = vtk.vtkPoints()
-          mirrorLMNode =slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode",subjectID)
-          ##
-          ## MODIFICATION CHECK: This block needs to be robust to index errors
-          ## The new validation in generateMirrorMapString should prevent out-of-bounds
-          ## errors here, as long as all landmark files have the *same* number of points.
-          ##
-          try:
-            for i in range(currentLMNode.GetNumberOfControlPoints()):
-              mirror_idx = mirrorIndex[i]
-              point = currentLMNode.GetNthControlPointPosition(mirror_idx)
-              mirrorLMNode.AddControlPoint(point, str(i))
-              sourcePoints.InsertNextPoint(point)
-          except IndexError:
-            # This would happen if the map string has a higher index than points available.
-            # The validation should catch this, but good to be aware.
-            slicer.mrmlScene.RemoveNode(currentLMNode)
-            slicer.mrmlScene.RemoveNode(currentMeshNode)
-            slicer.mrmlScene.RemoveNode(mirrorTransformNode)
-            slicer.mrmlScene.RemoveNode(mirrorLMNode)
-            raise ValueError(f"Symmetry map error for subject {subjectID}: The generated map has an index ({mirror_idx if 'mirror_idx' in locals() else 'unknown'}) that is out of bounds for the landmark file (total points: {currentLMNode.GetNumberOfControlPoints()}).")
-          
-          rigidTransform = vtk.vtkLandmarkTransform()
-          rigidTransform.SetSourceLandmarks(sourcePoints)
-          rigidTransform.SetTargetLandmarks(targetPoints)
-          rigidTransform.SetModeToRigidBody()
-          rigidTransformNode=slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode","Rigid")
-          rigidTransformNode.SetAndObserveTransformToParent(rigidTransform)
-          # compute normals
-          self.computeNormals(currentMeshNode)
-          currentMeshNode.SetAndObserveTransformNodeID(rigidTransformNode.GetID())
-          mirrorLMNode.SetAndObserveTransformNodeID(rigidTransformNode.GetID())
-          slicer.vtkSlicerTransformLogic().hardenTransform(currentMeshNode)
-          slicer.vtkSlicerTransformLogic().hardenTransform(mirrorLMNode)
-          # optional semi-landmark alignment
-          if semilandmarkOption:
-            currentSLMNode = self.getLandmarkFileByID(slmDirectory, subjectID)
-            mirrorSLMNode =slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode",subjectID)
-            for i in range(currentSLMNode.GetNumberOfControlPoints()):
-              point = currentSLMNode.GetNthControlPointPosition(mirrorSLMIndex[i])
-              mirrorSLMNode.AddControlPoint(point, str(i))
-            if currentSLMNode :
-              currentSLMNode.SetAndObserveTransformNodeID(mirrorTransformNode.GetID())
-              slicer.vtkSlicerTransformLogic().hardenTransform(currentSLMNode)
-              currentSLMNode.SetAndObserveTransformNodeID(rigidTransformNode.GetID())
-              slicer.vtkSlicerTransformLogic().hardenTransform(currentSLMNode)
-              outputSLMName = subjectID + '_mirror.mrk.json'
-              outputSLMPath = os.path.join(outputSLMDirectory, outputSLMName)
-              slicer.util.saveNode(mirrorSLMNode, outputSLMPath)
-              slicer.mrmlScene.RemoveNode(currentSLMNode)
-              slicer.mrmlScene.RemoveNode(mirrorSLMNode)
-          # save output files
-          outputMeshName = subjectID + '_mirror.ply'
-          outputMeshPath = os.path.join(mirrorMeshDirectory, outputMeshName)
-          slicer.util.saveNode(currentMeshNode, outputMeshPath)
-          outputLMName = subjectID + '_mirror.mrk.json'
-          outputLMPath = os.path.join(mirrorLMDirectory, outputLMName)
-          slicer.util.saveNode(mirrorLMNode, outputLMPath)
-          # clean up
-          slicer.mrmlScene.RemoveNode(currentLMNode)
-          slicer.mrmlScene.RemoveNode(currentMeshNode)
-          slicer.mrmlScene.RemoveNode(mirrorTransformNode)
-          slicer.mrmlScene.RemoveNode(rigidTransformNode)
-          slicer.mrmlScene.RemoveNode(mirrorLMNode)
-
-  def runDCAlign(self, baseMeshPath, baseLMPath, meshDirectory, landmarkDirectory, outputDirectory, optionErrorOutput, progressCallback=None):
+    self.checkMeshLandmarkMatch(meshDirectory, lmDirectory, landmarkFileIndex)
+    semiLandmarkFileIndex = self.buildLandmarkFileIndex(slmDirectory) if semilandmarkOption else {}
+    jobs = []
+    for subjectID, meshPath, meshMatrix in alignment.meshSources(meshDirectory):
+      semiLandmarkFileName = semiLandmarkFileIndex.get(subjectID)
+      jobs.append((subjectID, meshPath, os.path.join(lmDirectory, landmarkFileIndex[subjectID]),
+        mirrorAxis, mirrorIndex, os.path.join(mirrorMeshDirectory, subjectID + '_mirror.ply'),
+        os.path.join(mirrorLMDirectory, subjectID + '_mirror.mrk.json'),
+        os.path.join(slmDirectory, semiLandmarkFileName) if semiLandmarkFileName else None, mirrorSLMIndex,
+        os.path.join(outputSLMDirectory, subjectID + '_mirror.mrk.json') if semiLandmarkFileName else None, meshMatrix))
+    results = parallel.mapUnordered(alignment.writeMirroredSubject, jobs, workers, self._workerPythonExecutable() if workers != 1 else None)
+    for subjectCount, (index, _, error) in enumerate(results, start=1):
+      if progressCallback:
+        progressCallback(subjectCount, len(jobs), "Mirroring")
+      if isinstance(error, ValueError):
+        raise error
+      if error is not None:
+        raise RuntimeError(f"Could not mirror subject {jobs[index][0]}: {error}") from error
+
+  def runDCAlign(self, baseMeshPath, baseLMPath, meshDirectory, landmarkDirectory, outputDirectory, optionErrorOutput, progressCallback=None, workers=1, parallelSubjects=False, useNumpyTPS=False):
     if optionErrorOutput:
       self.errorCheckPath = os.path.join(outputDirectory, "errorChecking")
       if not os.path.exists(self.errorCheckPath):
@@ -1445,16 +2240,38 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     baseMesh = baseNode.GetPolyData()
     baseLandmarks=self.fiducialNodeToPolyData(baseLMPath).GetPoints()
     modelExt=['ply','stl','vtp']
-    self.modelNames, models = self.importMeshes(meshDirectory, modelExt, progressCallback)
+    # Meshes are streamed one subject at a time (see _streamDenseCorrespondence),
+    # in the same sorted order importMeshes uses. Each subject's magnitudes are
+    # checkpointed as soon as they are computed, so an interrupted run re-run into
+    # the same output folder only computes the subjects that are missing.
+    meshSources = alignment.meshSources(meshDirectory, modelExt)
+    self.modelNames = [name for name, _, _ in meshSources]
+    meshPaths = [path for _, path, _ in meshSources]
+    meshMatrices = [matrix for _, _, matrix in meshSources]
     landmarkNames,landmarks = self.importLandmarks(landmarkDirectory, progressCallback)
-    denseCorrespondenceGroup = self.denseCorrespondenceBaseMesh(landmarks, models, baseMesh, baseLandmarks, progressCallback)
-    self.addMagnitudeFeature(denseCorrespondenceGroup, self.modelNames, baseMesh)
+    basePoints = vtk_np.vtk_to_numpy(baseMesh.GetPoints().GetData()).astype(np.float64)
+    checkpointDirectory = self._checkpointDirectory(outputDirectory, {
+      "baseMesh": os.path.abspath(baseMeshPath), "basePointCount": len(basePoints),
+      "baseLandmarks": os.path.abspath(baseLMPath), "useNumpyTPS": bool(useNumpyTPS)})
+    statsArray = np.zeros((len(basePoints), len(meshPaths)))
+    pendingSubjects = []
+    for i, modelName in enumerate(self.modelNames):
+      magnitudes = self._loadCheckpoint(checkpointDirectory, modelName, len(basePoints))
+      if magnitudes is None:
+        pendingSubjects.append(i)
+      else:
+        statsArray[:, i] = magnitudes
+    for i, (correspondingXYZ,) in self._streamDenseCorrespondence([(meshPaths, landmarks, meshMatrices)], baseMesh, baseLandmarks, pendingSubjects,
+      progressCallback, workers, parallelSubjects, useNumpyTPS):
+      statsArray[:, i] = self.pointDistances(basePoints, correspondingXYZ)
+      self._saveCheckpoint(checkpointDirectory, self.modelNames[i], statsArray[:, i])
+    self.addMagnitudeArrays(baseMesh, statsArray, self.modelNames)
     # save results to output directory
     outputModelName = 'decaResultModel.vtp'
     outputModelPath = os.path.join(outputDirectory, outputModelName)
     slicer.util.saveNode(baseNode, outputModelPath)
 
-  def runDCAlignSymmetric(self, baseMeshPath, baseLMPath, meshDir, landmarkDir, mirrorMeshDir, mirrorLandmarkDir, outputDir, optionErrorOutput, progressCallback=None):
+  def runDCAlignSymmetric(self, baseMeshPath, baseLMPath, meshDir, landmarkDir, mirrorMeshDir, mirrorLandmarkDir, outputDir, optionErrorOutput, progressCallback=None, workers=1, parallelSubjects=False, useNumpyTPS=False):
     if optionErrorOutput:
       self.errorCheckPath = os.path.join(outputDir, "errorChecking")
       if not os.path.exists(self.errorCheckPath):
@@ -1463,23 +2280,46 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     baseMesh = baseNode.GetPolyData()
     baseLandmarks=self.fiducialNodeToPolyData(baseLMPath).GetPoints()
     modelExt=['ply','stl','vtp']
-    self.modelNames, models = self.importMeshes(meshDir, modelExt, progressCallback)
+    # Each subject and its mirror are streamed as a pair (see runDCAlign), and the
+    # left-right distances are checkpointed per subject as soon as both are done.
+    meshSources = alignment.meshSources(meshDir, modelExt)
+    mirrorMeshFiles = [f for f in sorted(os.listdir(mirrorMeshDir)) if f.endswith(tuple(modelExt))]
+    if len(meshSources) != len(mirrorMeshFiles):
+      raise ValueError(f"Found {len(meshSources)} meshes but {len(mirrorMeshFiles)} mirrored meshes")
+    self.modelNames = [name for name, _, _ in meshSources]
+    meshPaths = [path for _, path, _ in meshSources]
+    meshMatrices = [matrix for _, _, matrix in meshSources]
+    mirrorMeshPaths = [os.path.join(mirrorMeshDir, f) for f in mirrorMeshFiles]
     landmarkNames, landmarks = self.importLandmarks(landmarkDir, progressCallback)
-    modelMirrorNames, mirrorModels = self.importMeshes(mirrorMeshDir, modelExt, progressCallback)
     mirrorLandmarkNames, mirrorLandmarks = self.importLandmarks(mirrorLandmarkDir, progressCallback)
-    denseCorrespondenceGroup = self.denseCorrespondenceBaseMesh(landmarks, models, baseMesh, baseLandmarks, progressCallback)
-    denseCorrespondenceGroupMirror = self.denseCorrespondenceBaseMesh(mirrorLandmarks, mirrorModels, baseMesh, baseLandmarks, progressCallback)
-    self.addMagnitudeFeatureSymmetry(denseCorrespondenceGroup, denseCorrespondenceGroupMirror, self.modelNames, baseMesh)
+    pointCount = baseMesh.GetNumberOfPoints()
+    checkpointDirectory = self._checkpointDirectory(outputDir, {
+      "symmetry": True, "baseMesh": os.path.abspath(baseMeshPath), "basePointCount": pointCount,
+      "baseLandmarks": os.path.abspath(baseLMPath), "useNumpyTPS": bool(useNumpyTPS)})
+    statsArray = np.zeros((pointCount, len(meshPaths)))
+    pendingSubjects = []
+    for i, modelName in enumerate(self.modelNames):
+      magnitudes = self._loadCheckpoint(checkpointDirectory, modelName, pointCount)
+      if magnitudes is None:
+        pendingSubjects.append(i)
+      else:
+        statsArray[:, i] = magnitudes
+    for i, (correspondingXYZ, mirrorXYZ) in self._streamDenseCorrespondence([(meshPaths, landmarks, meshMatrices), (mirrorMeshPaths, mirrorLandmarks, None)],
+      baseMesh, baseLandmarks, pendingSubjects, progressCallback, workers, parallelSubjects, useNumpyTPS):
+      statsArray[:, i] = self.pointDistances(correspondingXYZ, mirrorXYZ)
+      self._saveCheckpoint(checkpointDirectory, self.modelNames[i], statsArray[:, i])
+    self.addMagnitudeArrays(baseMesh, statsArray, self.modelNames)
     # save results to output directory
     outputModelName = 'decaSymmetryResultModel.vtp'
     outputModelPath = os.path.join(outputDir, outputModelName)
     slicer.util.saveNode(baseNode, outputModelPath)
 
-  def runMean(self, landmarkDirectory, meshDirectory, log=None, progressCallback=None):
+  def runMean(self, landmarkDirectory, meshDirectory, log=None, progressCallback=None, workers=1, parallelSubjects=False, useNumpyTPS=False):
     modelExt=['ply','stl','vtp','vtk']
     self.modelNames, models = self.importMeshes(meshDirectory, modelExt, progressCallback)
     landmarkNames, landmarks = self.importLandmarks(landmarkDirectory, progressCallback)
-    [denseCorrespondenceGroup, closestToMeanIndex] = self.denseCorrespondence(landmarks, models, progressCallback=progressCallback)
+    [denseCorrespondenceGroup, closestToMeanIndex] = self.denseCorrespondence(landmarks, models, progressCallback=progressCallback, workers=workers, parallelSubjects=parallelSubjects,
+      useNumpyTPS=useNumpyTPS)
     if log:
       log.appendPlainText(f"Sample selected for base model calculation: {self.modelNames[closestToMeanIndex]}")
     # compute mean model
@@ -1492,6 +2332,79 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     averageLandmarkNode.GetDisplayNode().SetPointLabelsVisibility(False)
     return averageModelNode, averageLandmarkNode
 
+  def runAtlas(self, meshDirectory, lmDirectory, removeScaleOption, log=None, progressCallback=None, workers=1, parallelSubjects=False, useNumpyTPS=False):
+    # Build the atlas (runAlign followed by runMean) without writing aligned
+    # copies of the sample to disk or holding every mesh in memory. Landmarks are
+    # small, so they are all read and aligned up front: each subject is aligned to
+    # the subject closest to the landmark mean (rigid, or similarity when
+    # removeScaleOption is set), and Procrustes on the aligned landmarks gives the
+    # mean shape and base mesh. Meshes are then loaded, aligned and corresponded
+    # one subject at a time and added to a running sum of corresponding points,
+    # so peak memory is about one subject per worker rather than the whole sample.
+    modelExt = ('ply', 'stl', 'vtp', 'vtk')
+    landmarkFileIndex = self.buildLandmarkFileIndex(lmDirectory)
+    self.checkMeshLandmarkMatch(meshDirectory, lmDirectory, landmarkFileIndex)
+    meshFiles = sorted(f for f in os.listdir(meshDirectory)
+                       if f.endswith(modelExt) and os.path.splitext(f)[0] in landmarkFileIndex)
+    if not meshFiles:
+      raise ValueError(f"No meshes with matching landmark files found in {meshDirectory}")
+    self.modelNames = [os.path.splitext(f)[0] for f in meshFiles]
+    meshPaths = [os.path.join(meshDirectory, f) for f in meshFiles]
+    landmarkSet = markupsIO.readLandmarkFiles([os.path.join(lmDirectory, landmarkFileIndex[name]) for name in self.modelNames],
+      self.modelNames, progressCallback=progressCallback)
+    originalLandmarks = landmarkSet.tensor
+    # alignment to the sample closest to the mean, as runAlign does
+    alignBaseIndex = self.procrustesAnalysis(originalLandmarks, False).closestToMeanIndex()
+    if log:
+      log.appendPlainText(f"Sample selected for rigid alignment: {self.modelNames[alignBaseIndex]}")
+    rotations, translations = procrustes.landmarkTransforms(originalLandmarks, originalLandmarks[alignBaseIndex], scaling=removeScaleOption)
+    alignedLandmarks = procrustes.applyTransforms(rotations, translations, originalLandmarks).astype(np.float32)
+    alignMatrices = np.tile(np.eye(4), (len(meshFiles), 1, 1))
+    alignMatrices[:, :3, :3] = rotations
+    alignMatrices[:, :3, 3] = translations
+    # mean shape and base mesh, as denseCorrespondence does
+    if log:
+      log.appendPlainText(f"Generating the average template")
+    procrustesResult = self.procrustesAnalysis(alignedLandmarks, False)
+    meanShape = self.convertPointsToVTK(procrustesResult.meanShape).GetPoints()
+    baseIndex = procrustesResult.closestToMeanIndex()
+    if log:
+      log.appendPlainText(f"Sample selected for base model calculation: {self.modelNames[baseIndex]}")
+    baseMesh = correspondence.transformMesh(correspondence.readMesh(meshPaths[baseIndex]), alignMatrices[baseIndex])
+    meanWarpedBase = self._warpBaseMesh(baseMesh, correspondence.pointsFromArray(alignedLandmarks[baseIndex]), meanShape)
+    # stream the subjects into the running sum
+    sampleNumber = len(meshFiles)
+    pointSum = np.zeros((meanWarpedBase.GetNumberOfPoints(), 3))
+    if parallelSubjects and parallel.resolveWorkerCount(workers) > 1:
+      # workers load and align their own meshes; largest meshes first
+      order = sorted(range(sampleNumber), key=lambda i: os.path.getsize(meshPaths[i]), reverse=True)
+      jobs = ((i, meshPaths[i], alignedLandmarks[i], alignMatrices[i]) for i in order)
+      with correspondence.SubjectCorrespondencePool(meanWarpedBase, meanShape, workers,
+        pythonExecutable=self._workerPythonExecutable(), useNumpyTPS=useNumpyTPS) as pool:
+        for completedCount, (i, correspondingXYZ) in enumerate(pool.imapUnordered(jobs), start=1):
+          if progressCallback:
+            progressCallback(completedCount, sampleNumber, "Computing dense correspondence")
+          pointSum += correspondingXYZ
+    else:
+      inverseSpline = tps.ThinPlateSpline(vtk_np.vtk_to_numpy(meanShape.GetData())) if useNumpyTPS else None
+      with self._createExactEngine(workers) as exactEngine:
+        for i in range(sampleNumber):
+          if progressCallback:
+            progressCallback(i + 1, sampleNumber, "Computing dense correspondence")
+          subjectMesh = correspondence.transformMesh(correspondence.readMesh(meshPaths[i]), alignMatrices[i])
+          correspondingMesh = self.denseSurfaceCorrespondencePair(subjectMesh, correspondence.pointsFromArray(alignedLandmarks[i]),
+            meanWarpedBase, meanShape, i, exactEngine=exactEngine, inverseSpline=inverseSpline)
+          pointSum += vtk_np.vtk_to_numpy(correspondingMesh.GetPoints().GetData())
+    averagePolyData = vtk.vtkPolyData()
+    averagePolyData.SetPoints(self.convertPointsToVTK(pointSum / sampleNumber).GetPoints())
+    averagePolyData.SetPolys(meanWarpedBase.GetPolys())
+    averageModelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', 'Atlas Model')
+    averageModelNode.CreateDefaultDisplayNodes()
+    averageModelNode.SetAndObservePolyData(averagePolyData)
+    averageLandmarkNode = self.numpyToFiducialNode(alignedLandmarks.astype(np.float64).mean(axis=0), "Atlas Landmarks")
+    averageLandmarkNode.GetDisplayNode().SetPointLabelsVisibility(False)
+    return averageModelNode, averageLandmarkNode
+
   def buildLandmarkFileIndex(self, directory):
     # Map subjectID -> landmark filename by stripping landmark suffixes. Built
     # once by callers that would otherwise call getLandmarkFileByID in a loop,
@@ -1534,16 +2447,16 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     # mismatch and rename the files. Callers already forward ValueError to the log.
     if landmarkFileIndex is None:
       landmarkFileIndex = self.buildLandmarkFileIndex(lmDirectory)
-    meshFileNames = [f for f in os.listdir(meshDirectory) if not f.startswith(".")]
-    unmatchedMeshes = sorted((f, os.path.splitext(f)[0]) for f in meshFileNames
-                             if os.path.splitext(f)[0] not in landmarkFileIndex)
+    meshSources = alignment.meshSources(meshDirectory)
+    unmatchedMeshes = sorted((os.path.basename(path) if matrix is None else name, name) for name, path, matrix in meshSources
+                             if name not in landmarkFileIndex)
     if not unmatchedMeshes:
       return
     exampleLimit = 5
     lmFileNames = sorted(f for f in os.listdir(lmDirectory) if not f.startswith("."))
     lines = [
       f"Could not match landmark files to meshes by filename: "
-      f"{len(unmatchedMeshes)} of {len(meshFileNames)} mesh(es) have no landmark file.",
+      f"{len(unmatchedMeshes)} of {len(meshSources)} mesh(es) have no landmark file.",
       "",
       "Each mesh is matched to the landmark file whose name, without the "
       ".fcsv/.mrk/.json suffix, is identical to the mesh name without its extension.",
@@ -1594,17 +2507,23 @@ class DeCALogic(ScriptedLoadableModuleLogic):
       if associatedNode is not None:
         slicer.mrmlScene.RemoveNode(associatedNode)
 
-  def runAlign(self, baseMeshNode, baseLMNode, meshDirectory, lmDirectory, ouputMeshDirectory, outputLMDirectory, removeScaleOption, slmDirectory=False, outputSLMDirector=False, transformDirectory=None, progressCallback=None):
-    semilandmarkOption = bool(slmDirectory and outputSLMDirectory)
-    targetPoints = vtk.vtkPoints()
-    point=[0,0,0]
-    # Set up base points for transform
-    for i in range(baseLMNode.GetNumberOfControlPoints()):
-      point = baseLMNode.GetNthControlPointPosition(i)
-      targetPoints.InsertNextPoint(point)
-    # Transform each subject to base
+  def runAlign(self, baseMeshNode, baseLMNode, meshDirectory, lmDirectory, ouputMeshDirectory, outputLMDirectory, removeScaleOption, slmDirectory=False, outputSLMDirector=False, transformDirectory=None, progressCallback=None, skipExisting=False, workers=1, writeMeshes=True):
+    # Rigid (similarity with removeScaleOption) alignment of every subject to the
+    # base landmarks. The transforms of all subjects are solved in one batched
+    # call on the stacked landmarks (alignment.alignmentMatrices) and applied to
+    # the mesh and landmark point arrays directly, without loading anything into
+    # the scene. With transformDirectory, the matrices are kept in its transform
+    # table so downstream output can be mapped back to each subject's original
+    # coordinate frame (see runBackTransformLandmarks). Subjects are read and
+    # written by up to workers processes at a time (0: all cores; 1: in this
+    # process), which mostly waits on storage; the output does not depend on it.
+    # With writeMeshes=False the aligned meshes are not written: the mesh
+    # manifest of ouputMeshDirectory lists each subject's original mesh and
+    # matrix instead, and the correspondence steps align the meshes in memory as
+    # they read them (see alignment.meshSources). Landmarks are always written.
+    semilandmarkOption = bool(slmDirectory and outputSLMDirector)
+    targetXYZ = np.array([baseLMNode.GetNthControlPointPosition(i) for i in range(baseLMNode.GetNumberOfControlPoints())])
     subjectFileNames = [f for f in os.listdir(meshDirectory) if not f.startswith(".")]
-    subjectTotal = len(subjectFileNames)
     # Index the landmark directory once instead of re-listing it per subject
     # (avoids O(N^2) directory scans on large datasets / network storage).
     landmarkFileIndex = self.buildLandmarkFileIndex(lmDirectory)
@@ -1612,89 +2531,55 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     # rather than silently skipping every subject and leaving an empty output dir
     # that looks like a successful run.
     self.checkMeshLandmarkMatch(meshDirectory, lmDirectory, landmarkFileIndex)
-    # Pause view rendering for the whole batch. Otherwise each per-subject
-    # progressCallback -> slicer.app.processEvents() (and the model loader itself)
-    # renders the freshly loaded mesh; that render is slow -- especially with
-    # software OpenGL over a remote display -- and dominates alignment time. The
-    # progress bar still updates because it is a Qt widget, not a rendered view.
-    slicer.app.pauseRender()
-    try:
-      for subjectCount, meshFileName in enumerate(subjectFileNames, start=1):
-        if progressCallback:
-          progressCallback(subjectCount, subjectTotal, "Rigid alignment")
-        if(not meshFileName.startswith(".")):
-          meshFilePath = os.path.join(meshDirectory, meshFileName)
-          subjectID = os.path.splitext(meshFileName)[0]
-          currentLMNode = self.getLandmarkFileByID(lmDirectory, subjectID, landmarkFileIndex)
-          if currentLMNode :
-            try:
-              currentMeshNode = slicer.util.loadModel(meshFilePath)
-            except:
-              self._removeNodeFully(currentLMNode)
-              continue
-            if currentLMNode.GetNumberOfControlPoints() != baseLMNode.GetNumberOfControlPoints():
-              raise ValueError(f"Landmark points mismatch: subject has {currentLMNode.GetNumberOfControlPoints()} points, "
-                f"atlas has {baseLMNode.GetNumberOfControlPoints()} points")
-            # set up transform between base lms and current lms
-            sourcePoints = vtk.vtkPoints()
-            for i in range(currentLMNode.GetNumberOfControlPoints()):
-              point = currentLMNode.GetNthControlPointPosition(i)
-              sourcePoints.InsertNextPoint(point)
-              transform = vtk.vtkLandmarkTransform()
-              transform.SetSourceLandmarks(sourcePoints)
-              transform.SetTargetLandmarks(targetPoints)
-            if not removeScaleOption:
-              transform.SetModeToRigidBody()
-            else:
-              transform.SetModeToSimilarity()
-            transformNode=slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode","Alignment")
-            transformNode.SetAndObserveTransformToParent(transform)
-            # apply transform to the current surface mesh and landmarks
-            currentMeshNode.SetAndObserveTransformNodeID(transformNode.GetID())
-            currentLMNode.SetAndObserveTransformNodeID(transformNode.GetID())
-            slicer.vtkSlicerTransformLogic().hardenTransform(currentMeshNode)
-            slicer.vtkSlicerTransformLogic().hardenTransform(currentLMNode)
-            # save output files
-            outputMeshName = subjectID + '_align.ply'
-            outputMeshPath = os.path.join(ouputMeshDirectory, outputMeshName)
-            slicer.util.saveNode(currentMeshNode, outputMeshPath)
-            outputLMName = subjectID + '_align.mrk.json'
-            outputLMPath = os.path.join(outputLMDirectory, outputLMName)
-            slicer.util.saveNode(currentLMNode, outputLMPath)
-            # persist the (linear) alignment transform so downstream output can be
-            # mapped back to this subject's original coordinate frame by inverting it.
-            # The transform is keyed by the aligned output basename (subjectID + '_align')
-            # so it matches the DeCAL output landmark filenames. See runBackTransformLandmarks.
-            if transformDirectory:
-              transform.Update()
-              alignMatrix = vtk.vtkMatrix4x4()
-              alignMatrix.DeepCopy(transform.GetMatrix())
-              alignXfNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", subjectID + "_alignTransform")
-              alignXfNode.SetMatrixTransformToParent(alignMatrix)
-              transformPath = os.path.join(transformDirectory, subjectID + "_align.h5")
-              slicer.util.saveNode(alignXfNode, transformPath)
-              self._removeNodeFully(alignXfNode)
-            # optional semi-landmark alignment
-            if semilandmarkOption :
-              currentSLMNode = self.getLandmarkFileByID(slmDirectory, subjectID)
-              if currentSLMNode :
-                currentSLMNode.SetAndObserveTransformNodeID(transformNode.GetID())
-                slicer.vtkSlicerTransformLogic().hardenTransform(currentSLMNode)
-                outputSLMName = subjectID + '_align.mrk.json'
-                outputSLMPath = os.path.join(outputSLMDirectory, outputSLMName)
-                slicer.util.saveNode(currentSLMNode, outputSLMPath)
-                self._removeNodeFully(currentSLMNode)
-            # clean up: remove the displayable nodes together with the display and
-            # storage nodes that loadModel/loadMarkups create, which otherwise
-            # orphan and accumulate across subjects.
-            try:
-              self._removeNodeFully(currentLMNode)
-              self._removeNodeFully(currentMeshNode)
-              self._removeNodeFully(transformNode)
-            except:
-              print(f"could not find nodes to remove for {subjectID}")
-    finally:
-      slicer.app.resumeRender()
+    semiLandmarkFileIndex = self.buildLandmarkFileIndex(slmDirectory) if semilandmarkOption else {}
+    alignedMeshNames = {name for name, _, _ in alignment.meshSources(ouputMeshDirectory)} if skipExisting else set()
+    subjects = []
+    for meshFileName in subjectFileNames:
+      subjectID = os.path.splitext(meshFileName)[0]
+      # skipExisting keeps subjects aligned by an earlier run (appending to a run)
+      if skipExisting and subjectID + '_align' in alignedMeshNames and \
+          os.path.exists(os.path.join(outputLMDirectory, subjectID + '_align.mrk.json')):
+        continue
+      landmarkXYZ, labels, descriptions = markupsIO.readMarkups(os.path.join(lmDirectory, landmarkFileIndex[subjectID]))
+      if len(landmarkXYZ) != len(targetXYZ):
+        raise ValueError(f"Landmark points mismatch: subject {subjectID} has {len(landmarkXYZ)} points, "
+          f"atlas has {len(targetXYZ)} points")
+      subjects.append((meshFileName, subjectID, landmarkXYZ, labels, descriptions))
+    if not subjects:
+      return
+    matrices = alignment.alignmentMatrices(np.stack([landmarkXYZ for _, _, landmarkXYZ, _, _ in subjects]), targetXYZ,
+      scaling=bool(removeScaleOption))
+    # stored before the outputs are written, so an interrupted run resumed with
+    # skipExisting still has the transforms of every subject it aligned
+    if transformDirectory:
+      os.makedirs(transformDirectory, exist_ok=True)
+      alignment.TransformTable([subjectID for _, subjectID, _, _, _ in subjects], matrices).write(transformDirectory)
+    alignedNames = [subjectID + '_align' for _, subjectID, _, _, _ in subjects]
+    if writeMeshes:
+      alignment.updateMeshManifest(ouputMeshDirectory, removeNames=alignedNames)
+    else:
+      alignment.updateMeshManifest(ouputMeshDirectory, {name: (os.path.join(meshDirectory, meshFileName), matrix)
+        for name, (meshFileName, _, _, _, _), matrix in zip(alignedNames, subjects, matrices)})
+      for name in alignedNames:
+        # an aligned mesh written by an earlier run would take precedence
+        stalePath = os.path.join(ouputMeshDirectory, name + '.ply')
+        if os.path.exists(stalePath):
+          os.remove(stalePath)
+    jobs = []
+    for (meshFileName, subjectID, landmarkXYZ, labels, descriptions), matrix in zip(subjects, matrices):
+      semiLandmarkFileName = semiLandmarkFileIndex.get(subjectID)
+      jobs.append((matrix, os.path.join(meshDirectory, meshFileName), os.path.join(ouputMeshDirectory, subjectID + '_align.ply') if writeMeshes else None,
+        (landmarkXYZ, labels, descriptions), os.path.join(outputLMDirectory, subjectID + '_align.mrk.json'),
+        os.path.join(slmDirectory, semiLandmarkFileName) if semiLandmarkFileName else None,
+        os.path.join(outputSLMDirector, subjectID + '_align.mrk.json') if semiLandmarkFileName else None))
+    # without meshes the jobs only write point lists, which is not worth a pool
+    workers = workers if writeMeshes else 1
+    results = parallel.mapUnordered(alignment.writeAlignedSubject, jobs, workers, self._workerPythonExecutable() if workers != 1 else None)
+    for subjectCount, (index, _, error) in enumerate(results, start=1):
+      if progressCallback:
+        progressCallback(subjectCount, len(jobs), "Rigid alignment")
+      if error is not None:
+        logging.warning(f"Alignment: could not align {subjects[index][0]}, skipping ({error})")
 
   def distanceMatrix(self, a):
     """
@@ -1746,32 +2631,28 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     return polydataPoints
 
   def importLandmarks(self, topDir, progressCallback=None):
-    fiducialGroup = vtk.vtkMultiBlockDataGroupFilter()
-    fileNameList = []
-    landmarkFiles = [f for f in sorted(os.listdir(topDir)) if f.endswith(".fcsv") or f.endswith(".json")]
-    fileTotal = len(landmarkFiles)
-    for fileCount, file in enumerate(landmarkFiles, start=1):
-      if progressCallback:
-        progressCallback(fileCount, fileTotal, "Loading landmarks")
-      fileNameList.append(file)
-      inputFilePath = os.path.join(topDir, file)
-      # may want to replace with vtk reader
-      polydataPoints = self.fiducialNodeToPolyData(inputFilePath)
-      fiducialGroup.AddInputData(polydataPoints)
-    fiducialGroup.Update()
-    return fileNameList, fiducialGroup.GetOutput()
+    # File names and a multiblock with one point block per file. The blocks are
+    # views of a single contiguous array read without the scene; use
+    # readLandmarkSet directly for the array itself.
+    landmarkSet = self.readLandmarkSet(topDir, progressCallback)
+    return landmarkSet.names, landmarkSet.toMultiBlock()
+
+  def readLandmarkSet(self, topDir, progressCallback=None):
+    return markupsIO.readLandmarkDirectory(topDir, progressCallback=progressCallback)
 
   def importMeshes(self, topDir, extensions, progressCallback=None):
       modelGroup = vtk.vtkMultiBlockDataGroupFilter()
       fileNameList = []
-      meshFiles = [f for f in sorted(os.listdir(topDir)) if f.endswith(tuple(extensions))]
-      fileTotal = len(meshFiles)
-      for fileCount, file in enumerate(meshFiles, start=1):
+      meshSources = alignment.meshSources(topDir, extensions)
+      fileTotal = len(meshSources)
+      for fileCount, (base, inputFilePath, meshMatrix) in enumerate(meshSources, start=1):
         if progressCallback:
           progressCallback(fileCount, fileTotal, "Loading meshes")
-        base, ext = os.path.splitext(file)
         fileNameList.append(base)
-        inputFilePath = os.path.join(topDir, file)
+        if meshMatrix is not None:
+          # listed in the folder's mesh manifest rather than written
+          modelGroup.AddInputData(alignment.readAlignedMesh(inputFilePath, meshMatrix))
+          continue
         # may want to replace with vtk reader
         modelNode = slicer.util.loadModel(inputFilePath)
         modelGroup.AddInputData(modelNode.GetPolyData())
@@ -1779,62 +2660,66 @@ class DeCALogic(ScriptedLoadableModuleLogic):
       modelGroup.Update()
       return fileNameList, modelGroup.GetOutput()
 
-  def procrustesImposition(self, originalLandmarks, sizeOption):
-    procrustesFilter = vtk.vtkProcrustesAlignmentFilter()
-    if(sizeOption):
-      procrustesFilter.GetLandmarkTransform().SetModeToRigidBody()
+  def landmarkTensor(self, landmarkGroup):
+    # (subjects, points, 3) array from a multiblock of landmark point sets
+    blocks = [vtk_np.vtk_to_numpy(landmarkGroup.GetBlock(i).GetPoints().GetData())
+              for i in range(landmarkGroup.GetNumberOfBlocks())]
+    if len({len(block) for block in blocks}) > 1:
+      raise ValueError("All landmark files must have the same number of points for Procrustes analysis")
+    return np.stack(blocks) if blocks else np.empty((0, 0, 3))
+
+  def procrustesAnalysis(self, landmarkTensor, sizeOption):
+    # Batched generalized Procrustes analysis of an (S, P, 3) landmark tensor.
+    # Same algorithm and modes as vtkProcrustesAlignmentFilter (similarity, or
+    # rigid body when sizeOption is set); also returns centroid sizes and the
+    # per-subject Procrustes distances.
+    return procrustes.generalizedProcrustes(landmarkTensor, scaling=not sizeOption)
 
-    procrustesFilter.SetInputData(originalLandmarks)
-    procrustesFilter.Update()
-    meanShape = procrustesFilter.GetMeanPoints()
-    return [meanShape, procrustesFilter.GetOutput()]
+  def procrustesImposition(self, originalLandmarks, sizeOption):
+    # [mean shape as vtkPoints, aligned landmarks as a multiblock], the layout of
+    # vtkProcrustesAlignmentFilter's outputs
+    result = self.procrustesAnalysis(self.landmarkTensor(originalLandmarks), sizeOption)
+    return [self.convertPointsToVTK(result.meanShape).GetPoints(), self.tensorToMultiBlock(result.aligned)]
+
+  def tensorToMultiBlock(self, pointsTensor):
+    multiBlock = vtk.vtkMultiBlockDataSet()
+    multiBlock.SetNumberOfBlocks(len(pointsTensor))
+    for i, pointsXYZ in enumerate(pointsTensor):
+      multiBlock.SetBlock(i, self.convertPointsToVTK(np.ascontiguousarray(pointsXYZ)))
+    return multiBlock
 
   def getClosestToMeanIndex(self, meanShape, alignedPoints):
-    import operator
+    # Subject with the smallest Procrustes distance (sum of point-to-point
+    # distances) to the mean shape
     sampleNumber = alignedPoints.GetNumberOfBlocks()
     if sampleNumber == 0:
       raise ValueError("No landmark data available for Procrustes analysis")
-    procrustesDistances = []
-    for i in range(sampleNumber):
-      alignedShape = alignedPoints.GetBlock(i)
-      meanPoint = [0,0,0]
-      alignedPoint = [0,0,0]
-      distance = 0
-      for j in range(meanShape.GetNumberOfPoints()):
-        meanShape.GetPoint(j,meanPoint)
-        alignedShape.GetPoint(j,alignedPoint)
-        distance += np.sqrt(vtk.vtkMath.Distance2BetweenPoints(meanPoint,alignedPoint))
-      procrustesDistances.append(distance)
-    min_index, min_value = min(enumerate(procrustesDistances), key=operator.itemgetter(1))
-    return min_index
+    residuals = self.landmarkTensor(alignedPoints) - vtk_np.vtk_to_numpy(meanShape.GetData())
+    return int(np.argmin(np.sqrt(np.einsum("spi,spi->sp", residuals, residuals)).sum(axis=1)))
 
   def getClosestToMeanPath(self, landmarkDirectory):
-    lmNames, landmarks = self.importLandmarks(landmarkDirectory)
+    landmarkSet = self.readLandmarkSet(landmarkDirectory)
+    lmNames = landmarkSet.names
     if not lmNames:
       raise ValueError(f"No landmark files found in directory: {landmarkDirectory}")
-    meanShape, alignedLandmarks = self.procrustesImposition(landmarks, False)
-    closestToMeanIndex = self.getClosestToMeanIndex(meanShape, alignedLandmarks)
+    closestToMeanIndex = self.procrustesAnalysis(landmarkSet.tensor, False).closestToMeanIndex()
     if closestToMeanIndex >= len(lmNames):
       raise ValueError(f"Index mismatch: computed index {closestToMeanIndex} but only {len(lmNames)} landmarks available")
     return lmNames[closestToMeanIndex]
 
-  def denseCorrespondence(self, originalLandmarks, originalMeshes, writeErrorOption=False, progressCallback=None):
-    meanShape, alignedPoints = self.procrustesImposition(originalLandmarks, False)
-    sampleNumber = alignedPoints.GetNumberOfBlocks()
+  def denseCorrespondence(self, originalLandmarks, originalMeshes, writeErrorOption=False, progressCallback=None, workers=1, parallelSubjects=False, useNumpyTPS=False):
+    procrustesResult = self.procrustesAnalysis(self.landmarkTensor(originalLandmarks), False)
+    meanShape = self.convertPointsToVTK(procrustesResult.meanShape).GetPoints()
     denseCorrespondenceGroup = vtk.vtkMultiBlockDataGroupFilter()
     # get base mesh as the closest to the mean shape
-    baseIndex = self.getClosestToMeanIndex(meanShape, alignedPoints)
+    baseIndex = procrustesResult.closestToMeanIndex()
     baseMesh = originalMeshes.GetBlock(baseIndex)
     baseLandmarks = originalLandmarks.GetBlock(baseIndex).GetPoints()
     # The base mesh warped onto the mean shape is identical for every sample, so
     # compute it once here instead of re-running the TPS solve + warp per sample.
     meanWarpedBase = self._warpBaseMesh(baseMesh, baseLandmarks, meanShape)
-    for i in range(sampleNumber):
-      if progressCallback:
-        progressCallback(i + 1, sampleNumber, "Computing dense correspondence")
-      correspondingMesh = self.denseSurfaceCorrespondencePair(originalMeshes.GetBlock(i),
-      originalLandmarks.GetBlock(i).GetPoints(), meanWarpedBase, meanShape, i)
-      denseCorrespondenceGroup.AddInputData(correspondingMesh)
+    self._correspondGroup(denseCorrespondenceGroup, originalLandmarks, originalMeshes, meanWarpedBase, meanShape,
+      progressCallback, workers, parallelSubjects, useNumpyTPS)
 
     denseCorrespondenceGroup.Update()
     return denseCorrespondenceGroup.GetOutput(), baseIndex
@@ -1875,7 +2760,7 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     denseCorrespondenceGroup.Update()
     return denseCorrespondenceGroup.GetOutput()
 
-  def denseCorrespondenceBaseMesh(self, originalLandmarks, originalMeshes, baseMesh, baseLandmarks, progressCallback=None):
+  def denseCorrespondenceBaseMesh(self, originalLandmarks, originalMeshes, baseMesh, baseLandmarks, progressCallback=None, workers=1, parallelSubjects=False, useNumpyTPS=False):
     meanShape, alignedPoints = self.procrustesImposition(originalLandmarks, False)
     sampleNumber = alignedPoints.GetNumberOfBlocks()
     print("procrustes aligned samples: ", sampleNumber)
@@ -1883,93 +2768,185 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     # The base mesh warped onto the mean shape is identical for every sample, so
     # compute it once here instead of re-running the TPS solve + warp per sample.
     meanWarpedBase = self._warpBaseMesh(baseMesh, baseLandmarks, meanShape)
-    for i in range(sampleNumber):
-      if progressCallback:
-        progressCallback(i + 1, sampleNumber, "Computing dense correspondence")
-      correspondingMesh = self.denseSurfaceCorrespondencePair(originalMeshes.GetBlock(i),
-      originalLandmarks.GetBlock(i).GetPoints(), meanWarpedBase, meanShape, i)
-      denseCorrespondenceGroup.AddInputData(correspondingMesh)
+    self._correspondGroup(denseCorrespondenceGroup, originalLandmarks, originalMeshes, meanWarpedBase, meanShape,
+      progressCallback, workers, parallelSubjects, useNumpyTPS)
     denseCorrespondenceGroup.Update()
     return denseCorrespondenceGroup.GetOutput()
 
+  def _streamDenseCorrespondence(self, sides, baseMesh, baseLandmarks, subjectIndices, progressCallback=None, workers=1, parallelSubjects=False, useNumpyTPS=False):
+    # Streaming form of denseCorrespondenceBaseMesh for meshes on disk. sides is
+    # a list of (meshPaths, originalLandmarks, meshMatrices) sample sets with
+    # matching subjects, where meshMatrices (or None) aligns meshes that were not
+    # written (see alignment.meshSources)
+    # (one set, or a sample and its mirror for symmetry analysis); each set gets
+    # its own Procrustes mean shape, as denseCorrespondenceBaseMesh gives it, and
+    # the base mesh is loaded once for all of them. Yields (i, [correspondingXYZ
+    # per side]) for each subject in subjectIndices, running a subject's sides
+    # back to back, so only about one subject per side is in memory instead of
+    # the whole sample. The mean shapes use every subject's landmarks, so a subset
+    # (e.g. the subjects left to do when resuming) gives the same correspondences
+    # as the full run. With the subject pool, subjects arrive in completion order.
+    meanShapes = [self.procrustesImposition(originalLandmarks, False)[0] for meshPaths, originalLandmarks, _ in sides]
+    meanWarpedBases = [self._warpBaseMesh(baseMesh, baseLandmarks, meanShape) for meanShape in meanShapes]
+    sampleNumber = len(sides[0][0])
+    completedOffset = sampleNumber - len(subjectIndices)
+    if parallelSubjects and parallel.resolveWorkerCount(workers) > 1 and not hasattr(self, "errorCheckPath"):
+      order = sorted(subjectIndices, key=lambda i: sum(os.path.getsize(meshPaths[i]) for meshPaths, _, _ in sides), reverse=True)
+      jobs = (((i, side), meshPaths[i], vtk_np.vtk_to_numpy(originalLandmarks.GetBlock(i).GetPoints().GetData()),
+               meshMatrices[i] if meshMatrices else None, side)
+              for i in order for side, (meshPaths, originalLandmarks, meshMatrices) in enumerate(sides))
+      partial = {}
+      with correspondence.SubjectCorrespondencePool(meanWarpedBases, meanShapes, workers,
+        pythonExecutable=self._workerPythonExecutable(), useNumpyTPS=useNumpyTPS) as pool:
+        completedCount = completedOffset
+        for (i, side), correspondingXYZ in pool.imapUnordered(jobs):
+          partial.setdefault(i, [None] * len(sides))[side] = correspondingXYZ
+          if all(xyz is not None for xyz in partial[i]):
+            completedCount += 1
+            if progressCallback:
+              progressCallback(completedCount, sampleNumber, "Computing dense correspondence")
+            yield i, partial.pop(i)
+      return
+    inverseSplines = [self._inverseSplines(meanShape, originalLandmarks, useNumpyTPS)
+                      for meanShape, (meshPaths, originalLandmarks, _) in zip(meanShapes, sides)]
+    with self._createExactEngine(workers) as exactEngine:
+      for completedCount, i in enumerate(subjectIndices, start=completedOffset + 1):
+        if progressCallback:
+          progressCallback(completedCount, sampleNumber, "Computing dense correspondence")
+        correspondingXYZ = []
+        for (meshPaths, originalLandmarks, meshMatrices), meanWarpedBase, meanShape, (inverseSpline, inverseCoefficients) in zip(
+          sides, meanWarpedBases, meanShapes, inverseSplines):
+          correspondingMesh = self.denseSurfaceCorrespondencePair(
+            alignment.readAlignedMesh(meshPaths[i], meshMatrices[i] if meshMatrices else None),
+            originalLandmarks.GetBlock(i).GetPoints(), meanWarpedBase, meanShape, i, exactEngine=exactEngine,
+            inverseSpline=inverseSpline, inverseCoefficients=inverseCoefficients[i] if useNumpyTPS else None)
+          correspondingXYZ.append(vtk_np.vtk_to_numpy(correspondingMesh.GetPoints().GetData()))
+        yield i, correspondingXYZ
+
+  def _inverseSplines(self, meanShape, landmarkGroup, useNumpyTPS=False):
+    # For NumPy thin-plate splines: the inverse warp (mean shape -> subject) is
+    # factorized once, and every subject's coefficients come from one
+    # multi-right-hand-side solve. Returns (None, None) for VTK warps.
+    if not useNumpyTPS:
+      return None, None
+    inverseSpline = tps.ThinPlateSpline(vtk_np.vtk_to_numpy(meanShape.GetData()))
+    allLandmarks = np.stack([vtk_np.vtk_to_numpy(landmarkGroup.GetBlock(i).GetPoints().GetData())
+                             for i in range(landmarkGroup.GetNumberOfBlocks())])
+    return inverseSpline, inverseSpline.solve(allLandmarks)
+
   def _warpBaseMesh(self, baseMesh, baseLandmarks, meanShape):
     # TPS-warp the base mesh onto the mean shape. This depends only on the base
     # mesh / base landmarks / mean shape, which are all fixed across the per-sample
     # correspondence loop, so callers compute it once and pass the result into
     # denseSurfaceCorrespondencePair rather than recomputing it for every sample.
-    meanTransformBase = vtk.vtkThinPlateSplineTransform()
-    meanTransformBase.SetSourceLandmarks(baseLandmarks)
-    meanTransformBase.SetTargetLandmarks(meanShape)
-    meanTransformBase.SetBasisToR() # for 3D transform
-
-    meanTransformBaseFilter = vtk.vtkTransformPolyDataFilter()
-    meanTransformBaseFilter.SetInputData(baseMesh)
-    meanTransformBaseFilter.SetTransform(meanTransformBase)
-    meanTransformBaseFilter.Update()
-    return meanTransformBaseFilter.GetOutput()
-
-  def _closestPointsToMesh(self, queryPoints, targetMesh, useFast=False):
+    return correspondence.thinPlateSplineWarp(baseMesh, baseLandmarks, meanShape)
+
+  def _correspondGroup(self, denseCorrespondenceGroup, originalLandmarks, originalMeshes, meanWarpedBase, meanShape, progressCallback=None, workers=1, parallelSubjects=False, useNumpyTPS=False):
+    # Per-subject correspondence loop shared by denseCorrespondence (atlas build)
+    # and denseCorrespondenceBaseMesh (DeCA tab); adds one corresponding mesh per
+    # subject to denseCorrespondenceGroup, in subject order.
+    sampleNumber = originalLandmarks.GetNumberOfBlocks()
+    # Error-check output is written per subject from this process, so that mode
+    # always uses the in-process loop.
+    if parallelSubjects and parallel.resolveWorkerCount(workers) > 1 and not hasattr(self, "errorCheckPath"):
+      # Whole subjects run in worker processes, largest mesh first.
+      order = sorted(range(sampleNumber), key=lambda i: originalMeshes.GetBlock(i).GetNumberOfPoints(), reverse=True)
+      jobs = ((i, closestPoint.polyDataToArrays(originalMeshes.GetBlock(i)),
+               vtk_np.vtk_to_numpy(originalLandmarks.GetBlock(i).GetPoints().GetData())) for i in order)
+      correspondingXYZ = {}
+      with correspondence.SubjectCorrespondencePool(meanWarpedBase, meanShape, workers,
+        pythonExecutable=self._workerPythonExecutable(), useNumpyTPS=useNumpyTPS) as pool:
+        for completedCount, (i, xyz) in enumerate(pool.imapUnordered(jobs), start=1):
+          if progressCallback:
+            progressCallback(completedCount, sampleNumber, "Computing dense correspondence")
+          correspondingXYZ[i] = xyz
+      for i in range(sampleNumber):
+        correspondingMesh = vtk.vtkPolyData()
+        correspondingMesh.SetPoints(correspondence.pointsFromArray(correspondingXYZ[i]))
+        correspondingMesh.SetPolys(meanWarpedBase.GetPolys())
+        denseCorrespondenceGroup.AddInputData(correspondingMesh)
+      return
+    inverseSpline, inverseCoefficients = self._inverseSplines(meanShape, originalLandmarks, useNumpyTPS)
+    with self._createExactEngine(workers) as exactEngine:
+      for i in range(sampleNumber):
+        if progressCallback:
+          progressCallback(i + 1, sampleNumber, "Computing dense correspondence")
+        correspondingMesh = self.denseSurfaceCorrespondencePair(originalMeshes.GetBlock(i),
+        originalLandmarks.GetBlock(i).GetPoints(), meanWarpedBase, meanShape, i, exactEngine=exactEngine,
+        inverseSpline=inverseSpline, inverseCoefficients=inverseCoefficients[i] if useNumpyTPS else None)
+        denseCorrespondenceGroup.AddInputData(correspondingMesh)
+
+  def _closestPointsToMesh(self, queryPoints, targetMesh, useFast=False, exactEngine=None, kdTree=None, hybrid=False):
     # For each point in queryPoints (vtkPoints), return the corresponding point
     # relative to targetMesh (vtkPolyData) as a new vtkPoints, index-aligned.
     #
-    # Default (exact): closest point on the target *surface* via vtkCellLocator,
-    # looping per point in Python.
+    # Default (exact): closest point on the target *surface* via vtkCellLocator.
+    # With an exactEngine (see _createExactEngine) the whole query set is answered
+    # in one batched call split across worker processes; without one the same
+    # per-point loop runs in this process. Both give bit-for-bit identical points.
     # Fast (useFast=True): nearest target *vertex* via a single vectorized scipy
-    # cKDTree query. Much faster but approximate; see issue #15. If scipy cannot be
-    # imported or installed, this logs a warning and falls back to the exact path.
+    # cKDTree query (kdTree, if given, is a prebuilt tree of the target points).
+    # Much faster but approximate; see issue #15. With hybrid as well, each
+    # nearest vertex is projected onto its surrounding triangles and any other
+    # triangle that could hold a nearer point, which matches the exact path. If scipy cannot be imported or installed, this logs a
+    # warning and falls back to the exact path.
     if useFast:
-      cKDTree = None
+      useFast = self._ensureScipy()
+    return correspondence.correspondingPoints(queryPoints, targetMesh, useFast, exactEngine, kdTree=kdTree, hybrid=hybrid)
+
+  def _ensureScipy(self):
+    # scipy is needed by the fast correspondence method; install it on first use.
+    # Returns False (after logging a warning) if it cannot be made available.
+    try:
+      import scipy.spatial
+      return True
+    except ImportError:
       try:
-        from scipy.spatial import cKDTree
-      except ImportError:
-        try:
-          slicer.util.pip_install('scipy')
-          from scipy.spatial import cKDTree
-        except Exception:
-          logging.warning("Fast correspondence requires scipy, which could not be "
-                          "imported or installed; falling back to the exact method.")
-      if cKDTree is not None:
-        targetXYZ = vtk_np.vtk_to_numpy(targetMesh.GetPoints().GetData())
-        queryXYZ = vtk_np.vtk_to_numpy(queryPoints.GetData())
-        tree = cKDTree(targetXYZ)
-        try:
-          _, matchedIndices = tree.query(queryXYZ, k=1, workers=-1)
-        except TypeError:  # older scipy without the workers kwarg
-          _, matchedIndices = tree.query(queryXYZ, k=1)
-        matchedXYZ = np.ascontiguousarray(targetXYZ[matchedIndices])
-        correspondingPoints = vtk.vtkPoints()
-        correspondingPoints.SetData(vtk_np.numpy_to_vtk(matchedXYZ, deep=True))
-        return correspondingPoints
-
-    cellLocator = vtk.vtkCellLocator()
-    cellLocator.SetDataSet(targetMesh)
-    cellLocator.BuildLocator()
-    point = [0,0,0]
-    correspondingPoint = [0,0,0]
-    correspondingPoints = vtk.vtkPoints()
-    cellId = vtk.reference(0)
-    subId = vtk.reference(0)
-    distance = vtk.reference(0.0)
-    for i in range(queryPoints.GetNumberOfPoints()):
-      queryPoints.GetPoint(i, point)
-      cellLocator.FindClosestPoint(point, correspondingPoint, cellId, subId, distance)
-      correspondingPoints.InsertPoint(i, correspondingPoint)
-    return correspondingPoints
-
-  def denseSurfaceCorrespondencePair(self, originalMesh, originalLandmarks, meanWarpedBase, meanShape, iteration, useFast=False):
-    # TPS warp target mesh to meanshape. meanWarpedBase (the base mesh already
-    # warped onto the mean shape) is supplied by the caller, computed once via
-    # _warpBaseMesh since it is identical for every sample.
-    meanTransform = vtk.vtkThinPlateSplineTransform()
-    meanTransform.SetSourceLandmarks(originalLandmarks)
-    meanTransform.SetTargetLandmarks(meanShape)
-    meanTransform.SetBasisToR() # for 3D transform
-
-    meanTransformFilter = vtk.vtkTransformPolyDataFilter()
-    meanTransformFilter.SetInputData(originalMesh)
-    meanTransformFilter.SetTransform(meanTransform)
-    meanTransformFilter.Update()
-    meanWarpedMesh = meanTransformFilter.GetOutput()
+        slicer.util.pip_install('scipy')
+        import scipy.spatial
+        return True
+      except Exception:
+        logging.warning("Fast correspondence requires scipy, which could not be "
+                        "imported or installed; falling back to the exact method.")
+        return False
+
+  def _createExactEngine(self, workers=1):
+    # Batched exact closest-point engine for a whole per-subject loop. Use it as a
+    # context manager (or close() it) so its worker processes are shut down.
+    return closestPoint.ExactClosestPointEngine(workers, pythonExecutable=self._workerPythonExecutable())
+
+  def _createResultCache(self, sizeGB=16):
+    return resultCache.CorrespondenceResultCache(os.path.join(slicer.app.cachePath, "DeCA", "correspondences"), sizeGB * 1024 ** 3)
+
+  def clearResultCache(self):
+    self._createResultCache().clear()
+
+  def _createWarpCache(self):
+    # Warped subject meshes persist in Slicer's cache folder between runs and
+    # sessions; the least recently used ones are removed past the size limit.
+    return WarpedMeshCache(os.path.join(slicer.app.cachePath, "DeCA", "warpedMeshes"))
+
+  def _workerPythonExecutable(self):
+    # Worker processes must run in Slicer's bundled Python interpreter
+    # (PythonSlicer), not in the Slicer application that sys.executable points to.
+    executableName = "PythonSlicer.exe" if os.name == "nt" else "PythonSlicer"
+    candidate = os.path.join(slicer.app.slicerHome, "bin", executableName)
+    if os.path.exists(candidate):
+      return candidate
+    return shutil.which("PythonSlicer")
+
+  def denseSurfaceCorrespondencePair(self, originalMesh, originalLandmarks, meanWarpedBase, meanShape, iteration, useFast=False, exactEngine=None, inverseSpline=None, inverseCoefficients=None, warpCache=None, hybrid=False):
+    # TPS warp target mesh (vtkPolyData or model file path) to meanshape.
+    # meanWarpedBase (the base mesh already warped onto the mean shape) is
+    # supplied by the caller, computed once via _warpBaseMesh since it is
+    # identical for every sample. Passing an inverseSpline (see _inverseSplines)
+    # selects the NumPy thin-plate splines. With a warpCache (see
+    # _createWarpCache) the warped mesh comes from earlier runs when the subject
+    # and mean shape are unchanged.
+    if useFast:
+      useFast = self._ensureScipy()
+    meanWarpedMesh, kdTree = correspondence.warpSubjectToMean(originalMesh, originalLandmarks, meanShape,
+      inverseSpline is not None, warpCache=warpCache, withKDTree=useFast)
 
     # write ouput
     if hasattr(self,"errorCheckPath"):
@@ -1988,25 +2965,11 @@ class DeCALogic(ScriptedLoadableModuleLogic):
       plyWriterBase.Write()
 
     # Dense correspondence
-    correspondingPoints = self._closestPointsToMesh(meanWarpedBase.GetPoints(), meanWarpedMesh, useFast=useFast)
+    correspondingPoints = self._closestPointsToMesh(meanWarpedBase.GetPoints(), meanWarpedMesh, useFast=useFast, exactEngine=exactEngine, kdTree=kdTree, hybrid=hybrid)
 
-    #Copy points into mesh with base connectivity
-    correspondingMesh = vtk.vtkPolyData()
-    correspondingMesh.SetPoints(correspondingPoints)
-    correspondingMesh.SetPolys(meanWarpedBase.GetPolys())
-
-    # Apply inverse warping
-    inverseTransform = vtk.vtkThinPlateSplineTransform()
-    inverseTransform.SetSourceLandmarks(meanShape)
-    inverseTransform.SetTargetLandmarks(originalLandmarks)
-    inverseTransform.SetBasisToR() # for 3D transform
-
-    inverseTransformFilter = vtk.vtkTransformPolyDataFilter()
-    inverseTransformFilter.SetInputData(correspondingMesh)
-    inverseTransformFilter.SetTransform(inverseTransform)
-    inverseTransformFilter.Update()
-
-    return inverseTransformFilter.GetOutput()
+    # Copy points into mesh with base connectivity and apply inverse warping
+    return correspondence.inverseWarpCorrespondence(correspondingPoints, meanWarpedBase, meanShape, originalLandmarks,
+      inverseSpline, inverseCoefficients)
 
   def convertPointsToVTK(self, points):
     array_vtk = vtk_np.numpy_to_vtk(points, deep=True, array_type=vtk.VTK_FLOAT)
@@ -2036,74 +2999,150 @@ class DeCALogic(ScriptedLoadableModuleLogic):
     averageModel.SetPolys(baseMesh.GetPolys())
     return averageModel
 
-  def addMagnitudeFeature(self, denseCorrespondenceGroup, modelNameArray, model):
-    sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
-    pointNumber = denseCorrespondenceGroup.GetBlock(0).GetNumberOfPoints()
-    statsArray = np.zeros((pointNumber, sampleNumber))
-    magnitudeMean = vtk.vtkDoubleArray()
-    magnitudeMean.SetNumberOfComponents(1)
+  def pointDistances(self, pointsA, pointsB):
+    # Row-wise Euclidean distances between two (N, 3) point arrays, evaluated in
+    # double precision in the same order as vtkMath.Distance2BetweenPoints.
+    difference = np.asarray(pointsA, dtype=np.float64) - np.asarray(pointsB, dtype=np.float64)
+    return np.sqrt((difference[:, 0] * difference[:, 0] + difference[:, 1] * difference[:, 1]) + difference[:, 2] * difference[:, 2])
+
+  def addMagnitudeArrays(self, model, statsArray, modelNameArray):
+    # Add one magnitude array per subject (the columns of the points x subjects
+    # statsArray) and the per-point "Magnitude Mean" and "Magnitude SD" to model.
+    for i, modelName in enumerate(modelNameArray):
+      magnitudes = vtk_np.numpy_to_vtk(np.ascontiguousarray(statsArray[:, i]), deep=True)
+      magnitudes.SetName(modelName)
+      model.GetPointData().AddArray(magnitudes)
+    magnitudeMean = vtk_np.numpy_to_vtk(statsArray.mean(axis=1), deep=True)
     magnitudeMean.SetName("Magnitude Mean")
-    magnitudeSD = vtk.vtkDoubleArray()
-    magnitudeSD.SetNumberOfComponents(1)
+    magnitudeSD = vtk_np.numpy_to_vtk(statsArray.std(axis=1), deep=True)
     magnitudeSD.SetName("Magnitude SD")
+    model.GetPointData().AddArray(magnitudeMean)
+    model.GetPointData().AddArray(magnitudeSD)
 
-     # get distance arrays
-    for i in range(sampleNumber):
-      alignedMesh = denseCorrespondenceGroup.GetBlock(i)
-      magnitudes = vtk.vtkDoubleArray()
-      magnitudes.SetNumberOfComponents(1)
-      magnitudes.SetName(modelNameArray[i])
-      for j in range(pointNumber):
-        modelPoint = model.GetPoint(j)
-        targetPoint = alignedMesh.GetPoint(j)
-        distance = np.sqrt(vtk.vtkMath.Distance2BetweenPoints(modelPoint,targetPoint))
-        magnitudes.InsertNextValue(distance)
-        statsArray[j,i]=distance
+  def _checkpointDirectory(self, outputDirectory, runInfo):
+    # Folder of per-subject checkpoints for a resumable run. The settings they
+    # were computed with are recorded once; a folder holding checkpoints from
+    # different settings is refused rather than silently mixed into the result.
+    import json
+    checkpointDirectory = os.path.join(outputDirectory, "decaCheckpoints")
+    os.makedirs(checkpointDirectory, exist_ok=True)
+    runInfoPath = os.path.join(checkpointDirectory, ".deca_run_info")
+    if os.path.exists(runInfoPath):
+      try:
+        with open(runInfoPath) as runInfoFile:
+          existingRunInfo = json.load(runInfoFile)
+      except Exception:
+        existingRunInfo = None
+      if existingRunInfo != runInfo:
+        raise ValueError(
+          "The output folder already holds DeCA checkpoints computed with different settings "
+          "(%s vs requested %s). Use a fresh output folder." % (existingRunInfo, runInfo))
+    else:
+      with open(runInfoPath, "w") as runInfoFile:
+        json.dump(runInfo, runInfoFile)
+    return checkpointDirectory
 
-      model.GetPointData().AddArray(magnitudes)
+  def _loadCheckpoint(self, checkpointDirectory, name, pointCount):
+    # A subject's checkpointed array, or None if it is missing or incomplete.
+    try:
+      values = np.load(os.path.join(checkpointDirectory, name + ".npy"))
+    except (OSError, ValueError):
+      return None
+    return values if len(values) == pointCount else None
 
-    for i in range(pointNumber):
-      pointMean = statsArray[i,:].mean()
-      magnitudeMean.InsertNextValue(pointMean)
-      pointSD = statsArray[i,:].std()
-      magnitudeSD.InsertNextValue(pointSD)
+  def _saveCheckpoint(self, checkpointDirectory, name, values):
+    # Written under a temporary name and renamed, so a crash mid-write never
+    # leaves a truncated checkpoint behind.
+    checkpointPath = os.path.join(checkpointDirectory, name + ".npy")
+    with open(checkpointPath + ".tmp", "wb") as checkpointFile:
+      np.save(checkpointFile, np.asarray(values))
+    os.replace(checkpointPath + ".tmp", checkpointPath)
 
-    model.GetPointData().AddArray(magnitudeMean)
-    model.GetPointData().AddArray(magnitudeSD)
+  def addMagnitudeFeature(self, denseCorrespondenceGroup, modelNameArray, model):
+    sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
+    modelPoints = vtk_np.vtk_to_numpy(model.GetPoints().GetData())
+    statsArray = np.zeros((len(modelPoints), sampleNumber))
+    for i in range(sampleNumber):
+      alignedPoints = vtk_np.vtk_to_numpy(denseCorrespondenceGroup.GetBlock(i).GetPoints().GetData())
+      statsArray[:, i] = self.pointDistances(modelPoints, alignedPoints)
+    self.addMagnitudeArrays(model, statsArray, modelNameArray)
 
   def addMagnitudeFeatureSymmetry(self, denseCorrespondenceGroup, denseCorrespondenceGroupMirror, modelNameArray, model):
     sampleNumber = denseCorrespondenceGroup.GetNumberOfBlocks()
-    pointNumber = denseCorrespondenceGroup.GetBlock(0).GetNumberOfPoints()
-    statsArray = np.zeros((pointNumber, sampleNumber))
-    magnitudeMean = vtk.vtkDoubleArray()
-    magnitudeMean.SetNumberOfComponents(1)
-    magnitudeMean.SetName("Magnitude Mean")
-    magnitudeSD = vtk.vtkDoubleArray()
-    magnitudeSD.SetNumberOfComponents(1)
-    magnitudeSD.SetName("Magnitude SD")
-
-     # get distance arrays
+    statsArray = np.zeros((model.GetNumberOfPoints(), sampleNumber))
     for i in range(sampleNumber):
-      alignedMesh = denseCorrespondenceGroup.GetBlock(i)
-      mirrorMesh = denseCorrespondenceGroupMirror.GetBlock(i)
-      magnitudes = vtk.vtkDoubleArray()
-      magnitudes.SetNumberOfComponents(1)
-      magnitudes.SetName(modelNameArray[i])
-      for j in range(pointNumber):
-        modelPoint = model.GetPoint(j)
-        targetPoint1 = alignedMesh.GetPoint(j)
-        targetPoint2 = mirrorMesh.GetPoint(j)
-        distance = np.sqrt(vtk.vtkMath.Distance2BetweenPoints(targetPoint1,targetPoint2))
-        magnitudes.InsertNextValue(distance)
-        statsArray[j,i]=distance
+      alignedPoints = vtk_np.vtk_to_numpy(denseCorrespondenceGroup.GetBlock(i).GetPoints().GetData())
+      mirrorPoints = vtk_np.vtk_to_numpy(denseCorrespondenceGroupMirror.GetBlock(i).GetPoints().GetData())
+      statsArray[:, i] = self.pointDistances(alignedPoints, mirrorPoints)
+    self.addMagnitudeArrays(model, statsArray, modelNameArray)
 
-      model.GetPointData().AddArray(magnitudes)
 
-    for i in range(pointNumber):
-      pointMean = statsArray[i,:].mean()
-      magnitudeMean.InsertNextValue(pointMean)
-      pointSD = statsArray[i,:].std()
-      magnitudeSD.InsertNextValue(pointSD)
+#
+# Headless batch entry
+#
+
+class _BatchLog:
+  # Stands in for the widget log (QPlainTextEdit) in batch runs.
+  def appendPlainText(self, text):
+    print(text, flush=True)
 
-    model.GetPointData().AddArray(magnitudeMean)
-    model.GetPointData().AddArray(magnitudeSD)
\ No newline at end of file
+
+_batchProgressRate = profiling.ProgressRate(minInterval=0)
+
+
+def _batchProgressCallback(current, total, message):
+  # Print about every 5% of each stage rather than every subject, with the
+  # stage's throughput and ETA.
+  _batchProgressRate.update(current, total, message)
+  if current == total or current % max(1, total // 20) == 0:
+    rateText = _batchProgressRate.describe(current, total)
+    print(f"{message}: {current}/{total}" + (f" ({rateText})" if rateText else ""), flush=True)
+
+
+def loadBatchConfig(path):
+  # A batch configuration is a JSON object or, if PyYAML is installed, a YAML
+  # mapping, with the keys documented in DeCALogic.runBatch.
+  with open(path, "r", encoding="utf-8") as configFile:
+    if os.path.splitext(path)[1].lower() in (".yml", ".yaml"):
+      try:
+        import yaml
+      except ImportError:
+        raise ValueError("YAML configurations need PyYAML (pip_install('pyyaml')); use JSON otherwise")
+      return yaml.safe_load(configFile)
+    import json
+    return json.load(configFile)
+
+
+def main(argv):
+  # Slicer --no-main-window --python-script DeCA.py run.json [more.json ...]
+  # Runs each configuration in turn without building the module widget; returns
+  # the number of failed runs.
+  failures = 0
+  logic = DeCALogic()
+  for configPath in argv:
+    print(f"DeCA batch: {configPath}", flush=True)
+    try:
+      logic.runBatch(loadBatchConfig(configPath), progressCallback=_batchProgressCallback)
+    except (OSError, ValueError, KeyError) as errorText:
+      print(f"DeCA batch failed for {configPath}: {errorText}", flush=True)
+      failures += 1
+    except Exception:
+      # anything else (a worker crash, a config value of the wrong type) is a
+      # failed run too, but one worth its traceback; the other configs still run
+      print(f"DeCA batch failed for {configPath}:", flush=True)
+      traceback.print_exc()
+      sys.stderr.flush()
+      failures += 1
+    slicer.mrmlScene.Clear(0)
+  return failures
+
+
+if __name__ == "__main__":
+  # Always exit, so a --no-main-window Slicer never outlives a failed batch.
+  exitCode = 1
+  try:
+    exitCode = min(main(sys.argv[1:]), 1)
+  except Exception:
+    traceback.print_exc()
+  finally:
+    slicer.util.exit(exitCode)
@@ -0,0 +1,5 @@
+# Scene-free helpers used by the DeCA module logic.
+#
+# Everything in this package depends only on numpy and vtk (never on slicer, qt
+# or the MRML scene), so it can be imported by worker processes started from
+# DeCALogic as well as by the module itself.
@@ -0,0 +1,223 @@
+import json
+import os
+import uuid
+
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+from DeCALib import correspondence, markupsIO, procrustes
+
+# All alignment transforms of a run, in one file in the transform folder.
+TRANSFORM_TABLE = "alignmentTransforms.npz"
+
+# Aligned meshes that were not written (runAlign with writeMeshes=False): the
+# aligned-models folder lists them here as their source file and alignment.
+MESH_MANIFEST = "alignedMeshes.json"
+
+
+def alignmentMatrices(sourceShapes, targetShape, scaling=False):
+  # 4x4 matrices taking each of the (S, P, 3) landmark shapes onto the (P, 3)
+  # target landmarks, solved for all subjects in one batched Kabsch/Umeyama call
+  # (see procrustes.landmarkTransforms): rigid, or similarity with scaling, as
+  # vtkLandmarkTransform computes them one subject at a time. Returns (S, 4, 4).
+  rotations, translations = procrustes.landmarkTransforms(sourceShapes, targetShape, scaling)
+  matrices = np.zeros((len(rotations), 4, 4))
+  matrices[:, :3, :3] = rotations
+  matrices[:, :3, 3] = translations
+  matrices[:, 3, 3] = 1.0
+  return matrices
+
+
+def applyMatrix(matrix, pointsXYZ):
+  # (N, 3) points mapped by a 4x4 linear transform, in float64.
+  matrix = np.asarray(matrix, dtype=np.float64)
+  return np.asarray(pointsXYZ, dtype=np.float64) @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def alignMesh(mesh, matrix):
+  # Map mesh (vtkPolyData) by a 4x4 alignment matrix in place, on its point
+  # array; normals are rotated along, other point data is kept as is.
+  points = vtk_np.vtk_to_numpy(mesh.GetPoints().GetData())
+  points[:] = applyMatrix(matrix, points)
+  mesh.GetPoints().Modified()
+  normalArray = mesh.GetPointData().GetNormals()
+  if normalArray is not None:
+    normals = vtk_np.vtk_to_numpy(normalArray)
+    rotated = normals @ np.asarray(matrix, dtype=np.float64)[:3, :3].T
+    lengths = np.linalg.norm(rotated, axis=1, keepdims=True)
+    normals[:] = rotated / np.where(lengths > 0, lengths, 1.0)
+    normalArray.Modified()
+  return mesh
+
+
+def writeAlignedSubject(matrix, meshPath, outputMeshPath, landmarks, outputLandmarkPath, semiLandmarkPath=None, outputSemiLandmarkPath=None):
+  # Write one subject aligned by matrix: its mesh (unless outputMeshPath is
+  # None), its landmarks (given as the (pointsXYZ, labels, descriptions) already
+  # read for the batched solve) and optionally its semi-landmarks. Scene-free, so
+  # runAlign can run it for many subjects at once in worker processes.
+  if outputMeshPath is not None:
+    mesh = correspondence.readMesh(meshPath)
+    correspondence.writeMesh(outputMeshPath, alignMesh(mesh, matrix))
+  pointsXYZ, labels, descriptions = landmarks
+  markupsIO.writeMarkups(outputLandmarkPath, applyMatrix(matrix, pointsXYZ), labels, descriptions)
+  if semiLandmarkPath:
+    pointsXYZ, labels, descriptions = markupsIO.readMarkups(semiLandmarkPath)
+    markupsIO.writeMarkups(outputSemiLandmarkPath, applyMatrix(matrix, pointsXYZ), labels, descriptions)
+
+
+def _mirroredPoints(pointsXYZ, mirrorAxis, mirrorIndex, subjectID):
+  # Point i of the mirrored set is the reflection of point mirrorIndex[i], so
+  # left and right landmarks swap labels.
+  mirrorIndex = np.asarray(mirrorIndex, dtype=int)[:len(pointsXYZ)]
+  outOfBounds = [index for index in mirrorIndex if not 0 <= index < len(pointsXYZ)]
+  if len(mirrorIndex) < len(pointsXYZ) or outOfBounds:
+    raise ValueError(f"Symmetry map error for subject {subjectID}: The generated map has an index "
+      f"({outOfBounds[0] if outOfBounds else 'unknown'}) that is out of bounds for the landmark file (total points: {len(pointsXYZ)}).")
+  return (np.asarray(pointsXYZ, dtype=np.float64) * mirrorAxis)[mirrorIndex]
+
+
+def writeMirroredSubject(subjectID, meshPath, landmarkPath, mirrorAxis, mirrorIndex, outputMeshPath, outputLandmarkPath,
+    semiLandmarkPath=None, semiMirrorIndex=None, outputSemiLandmarkPath=None, meshMatrix=None):
+  # Write the mirrored copy of one subject: mesh and landmarks reflected by the
+  # diagonal mirrorAxis (e.g. (-1, 1, 1)), landmarks relabelled to their mirror
+  # counterparts (see _mirroredPoints), normals recomputed on the reflected
+  # surface, and everything moved back onto the original landmarks by a rigid
+  # fit so the copy overlays the subject. meshMatrix aligns a mesh listed in a
+  # mesh manifest (see meshSources). Scene-free, like writeAlignedSubject.
+  mirrorAxis = np.asarray(mirrorAxis, dtype=np.float64)
+  landmarkXYZ = markupsIO.readMarkupsPoints(landmarkPath)
+  mirroredXYZ = _mirroredPoints(landmarkXYZ, mirrorAxis, mirrorIndex, subjectID)
+  matrix = alignmentMatrices(mirroredXYZ[None], landmarkXYZ)[0]
+  mesh = readAlignedMesh(meshPath, meshMatrix)
+  points = vtk_np.vtk_to_numpy(mesh.GetPoints().GetData())
+  points *= mirrorAxis.astype(points.dtype)
+  mesh.GetPoints().Modified()
+  normals = vtk.vtkPolyDataNormals()
+  normals.SetInputData(mesh)
+  normals.SetAutoOrientNormals(True)
+  normals.Update()
+  correspondence.writeMesh(outputMeshPath, alignMesh(normals.GetOutput(), matrix))
+  markupsIO.writeMarkups(outputLandmarkPath, applyMatrix(matrix, mirroredXYZ))
+  if semiLandmarkPath:
+    semiLandmarkXYZ = markupsIO.readMarkupsPoints(semiLandmarkPath)
+    markupsIO.writeMarkups(outputSemiLandmarkPath, applyMatrix(matrix, _mirroredPoints(semiLandmarkXYZ, mirrorAxis, semiMirrorIndex, subjectID)))
+
+
+def readAlignedMesh(meshPath, meshMatrix=None):
+  # A mesh from meshSources: read, and mapped by its alignment if it has one.
+  mesh = correspondence.readMesh(meshPath)
+  return mesh if meshMatrix is None else alignMesh(mesh, meshMatrix)
+
+
+def _readMeshManifest(directory):
+  try:
+    with open(os.path.join(directory, MESH_MANIFEST), "r", encoding="utf-8") as manifestFile:
+      return json.load(manifestFile)
+  except FileNotFoundError:
+    return {}
+
+
+def updateMeshManifest(directory, entries=None, removeNames=()):
+  # Add entries {name: (sourcePath, 4x4 matrix)} to the mesh manifest of
+  # directory and drop removeNames (e.g. meshes that are now written), replacing
+  # the file atomically. The file is removed once it lists nothing.
+  manifest = _readMeshManifest(directory)
+  for name in removeNames:
+    manifest.pop(name, None)
+  for name, (sourcePath, matrix) in (entries or {}).items():
+    manifest[name] = {"source": os.path.abspath(sourcePath), "matrix": np.asarray(matrix, dtype=np.float64).tolist()}
+  path = os.path.join(directory, MESH_MANIFEST)
+  if not manifest:
+    if os.path.exists(path):
+      os.remove(path)
+    return
+  temporaryPath = f"{path}.{uuid.uuid4().hex}.tmp"
+  try:
+    with open(temporaryPath, "w", encoding="utf-8") as manifestFile:
+      json.dump(manifest, manifestFile, indent=1)
+    os.replace(temporaryPath, path)
+  finally:
+    if os.path.exists(temporaryPath):
+      os.remove(temporaryPath)
+
+
+def meshSources(directory, extensions=None):
+  # The meshes of an aligned-models folder as (name, path, matrix) tuples: the
+  # mesh files in it (matrix None), restricted to extensions if given, and the
+  # meshes its manifest lists (read from path and mapped by matrix, see
+  # readAlignedMesh). Sorted by file name, as the folder's files always were;
+  # an unwritten mesh sorts as the .ply file it stands for.
+  sources = {}
+  for fileName in os.listdir(directory):
+    if fileName.startswith(".") or fileName == MESH_MANIFEST or (extensions and not fileName.endswith(tuple(extensions))):
+      continue
+    sources[fileName] = (os.path.splitext(fileName)[0], os.path.join(directory, fileName), None)
+  writtenNames = {name for name, _, _ in sources.values()}
+  for name, entry in _readMeshManifest(directory).items():
+    if name not in writtenNames:
+      sources[name + ".ply"] = (name, entry["source"], np.array(entry["matrix"], dtype=np.float64))
+  return [sources[fileName] for fileName in sorted(sources)]
+
+
+class TransformTable:
+  # The alignment transforms of a run: one 4x4 matrix (RAS, mapping a subject's
+  # original frame onto the atlas) per subject ID, stored together as
+  # TRANSFORM_TABLE rather than as one transform file per subject. Writing
+  # merges with the table already in the folder, so a run that appends subjects
+  # keeps the transforms of the earlier ones.
+
+  def __init__(self, subjectIDs=(), matrices=None):
+    self.subjectIDs = list(subjectIDs)
+    self.matrices = np.zeros((0, 4, 4)) if matrices is None else np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    self._index = {subjectID: i for i, subjectID in enumerate(self.subjectIDs)}
+
+  def __len__(self):
+    return len(self.subjectIDs)
+
+  def __contains__(self, subjectID):
+    return subjectID in self._index
+
+  def matrix(self, subjectID):
+    # The subject's 4x4 matrix, or None if the table has none for it.
+    index = self._index.get(subjectID)
+    return None if index is None else self.matrices[index]
+
+  def update(self, subjectIDs, matrices):
+    # Add or replace the matrices of subjectIDs.
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    added = []
+    for subjectID, matrix in zip(subjectIDs, matrices):
+      index = self._index.get(subjectID)
+      if index is None:
+        self._index[subjectID] = len(self.subjectIDs) + len(added)
+        added.append((subjectID, matrix))
+      else:
+        self.matrices[index] = matrix
+    if added:
+      self.subjectIDs.extend(subjectID for subjectID, _ in added)
+      self.matrices = np.concatenate((self.matrices, np.array([matrix for _, matrix in added])))
+
+  @classmethod
+  def read(cls, directory):
+    # The table in directory; empty if there is none (e.g. a run from before
+    # the table, which has one .h5 file per subject instead).
+    path = os.path.join(directory, TRANSFORM_TABLE)
+    if not os.path.exists(path):
+      return cls()
+    with np.load(path) as table:
+      return cls(table["subjectIDs"].tolist(), table["matrices"])
+
+  def write(self, directory):
+    # Merge into the table in directory and replace it atomically.
+    table = self.read(directory)
+    table.update(self.subjectIDs, self.matrices)
+    path = os.path.join(directory, TRANSFORM_TABLE)
+    temporaryPath = f"{path}.{uuid.uuid4().hex}.tmp.npz"
+    try:
+      np.savez(temporaryPath, subjectIDs=np.array(table.subjectIDs, dtype=str), matrices=table.matrices)
+      os.replace(temporaryPath, path)
+    finally:
+      if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+    return table
@@ -0,0 +1,333 @@
+import logging
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+from DeCALib import parallel, profiling
+
+# Below this many query points the exact query runs in-process: shipping the
+# mesh to the workers would cost more than it saves.
+MINIMUM_PARALLEL_QUERY_COUNT = 5000
+
+_CELL_TYPES = ("verts", "lines", "polys", "strips")
+
+# Hybrid query: numbers of nearest triangles searched in turn for a closer
+# point than the one-ring's (see projectedNearestVertices), and query points
+# per batch.
+HYBRID_CANDIDATE_COUNTS = (32, 128)
+HYBRID_CHUNK_SIZE = 4096
+
+
+def polyDataToArrays(mesh):
+  # Flatten a vtkPolyData into plain numpy arrays (points plus the offsets and
+  # connectivity of each cell array) so it can be shared with other processes.
+  # The points keep their original dtype so a mesh rebuilt by arraysToPolyData
+  # gives bit-for-bit the same locator results as the original.
+  arrays = {"points": vtk_np.vtk_to_numpy(mesh.GetPoints().GetData())}
+  for cellType, cells in zip(_CELL_TYPES, (mesh.GetVerts(), mesh.GetLines(), mesh.GetPolys(), mesh.GetStrips())):
+    if cells is not None and cells.GetNumberOfCells() > 0:
+      arrays[cellType + "Offsets"] = vtk_np.vtk_to_numpy(cells.GetOffsetsArray())
+      arrays[cellType + "Connectivity"] = vtk_np.vtk_to_numpy(cells.GetConnectivityArray())
+  return arrays
+
+
+def arraysToPolyData(arrays, deep=True):
+  # Inverse of polyDataToArrays. By default the arrays are deep-copied into VTK,
+  # so the result stays valid after the source (e.g. a shared memory block) is
+  # closed. With deep=False the VTK arrays use the numpy buffers directly (and
+  # keep the numpy arrays alive), e.g. to wrap memory-mapped files without
+  # reading them.
+  mesh = vtk.vtkPolyData()
+  points = vtk.vtkPoints()
+  points.SetData(vtk_np.numpy_to_vtk(np.ascontiguousarray(arrays["points"]), deep=deep))
+  mesh.SetPoints(points)
+  setters = (mesh.SetVerts, mesh.SetLines, mesh.SetPolys, mesh.SetStrips)
+  for cellType, setter in zip(_CELL_TYPES, setters):
+    if cellType + "Offsets" in arrays:
+      cells = vtk.vtkCellArray()
+      cells.SetData(vtk_np.numpy_to_vtk(np.ascontiguousarray(arrays[cellType + "Offsets"]), deep=deep),
+                    vtk_np.numpy_to_vtk(np.ascontiguousarray(arrays[cellType + "Connectivity"]), deep=deep))
+      setter(cells)
+  return mesh
+
+
+def buildCellLocator(mesh):
+  with profiling.stage("locator build"):
+    cellLocator = vtk.vtkCellLocator()
+    cellLocator.SetDataSet(mesh)
+    cellLocator.BuildLocator()
+  return cellLocator
+
+
+def locatorClosestPoints(cellLocator, queryXYZ):
+  # Closest point on the located surface for each row of queryXYZ, as an (N, 3)
+  # float64 array. This is the canonical DeCA correspondence query; the parallel
+  # engine runs exactly this loop on contiguous slices of the queries, which is
+  # why its result is identical to the serial one.
+  closestXYZ = np.empty((len(queryXYZ), 3))
+  closestPoint = [0, 0, 0]
+  cellId = vtk.reference(0)
+  subId = vtk.reference(0)
+  distance = vtk.reference(0.0)
+  with profiling.stage("query"):
+    for i, point in enumerate(np.asarray(queryXYZ).tolist()):
+      cellLocator.FindClosestPoint(point, closestPoint, cellId, subId, distance)
+      closestXYZ[i] = closestPoint
+  return closestXYZ
+
+
+def closestPointsOnSurface(targetMesh, queryXYZ):
+  return locatorClosestPoints(buildCellLocator(targetMesh), queryXYZ)
+
+
+def buildKDTree(mesh):
+  # scipy cKDTree over the points of mesh (raises ImportError without scipy)
+  from scipy.spatial import cKDTree
+  with profiling.stage("locator build"):
+    return cKDTree(vtk_np.vtk_to_numpy(mesh.GetPoints().GetData()))
+
+
+def nearestVertices(targetMesh, queryXYZ, workers=-1, kdTree=None):
+  # Fast, approximate correspondence: the nearest target *vertex* for each query
+  # point, from one vectorized, multithreaded scipy cKDTree query. Returns an
+  # (N, 3) array in the dtype of the target points. Raises ImportError if scipy
+  # is not available; callers decide whether to install it or fall back. A
+  # prebuilt kdTree of the target points (e.g. from a cache) is used if given.
+  targetXYZ = vtk_np.vtk_to_numpy(targetMesh.GetPoints().GetData())
+  tree = kdTree if kdTree is not None else buildKDTree(targetMesh)
+  with profiling.stage("query"):
+    try:
+      _, matchedIndices = tree.query(queryXYZ, k=1, workers=workers)
+    except TypeError:  # older scipy without the workers kwarg
+      _, matchedIndices = tree.query(queryXYZ, k=1)
+  return np.ascontiguousarray(targetXYZ[matchedIndices])
+
+
+def meshTriangles(mesh):
+  # (T, 3) vertex indices of the triangles of mesh. Polygons and strips are
+  # triangulated first if the mesh has any other cells.
+  polys = mesh.GetPolys()
+  if mesh.GetNumberOfStrips() == 0 and polys is not None and polys.GetNumberOfCells() > 0:
+    offsets = vtk_np.vtk_to_numpy(polys.GetOffsetsArray())
+    if np.all(np.diff(offsets) == 3):
+      return vtk_np.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3).astype(np.int64)
+  triangulate = vtk.vtkTriangleFilter()
+  triangulate.SetInputData(mesh)
+  triangulate.PassVertsOff()
+  triangulate.PassLinesOff()
+  triangulate.Update()
+  triangles = triangulate.GetOutput().GetPolys()
+  if triangles.GetNumberOfCells() == 0:
+    return np.empty((0, 3), dtype=np.int64)
+  return vtk_np.vtk_to_numpy(triangles.GetConnectivityArray()).reshape(-1, 3).astype(np.int64)
+
+
+def closestPointsOnTriangles(points, a, b, c):
+  # Closest point on triangle (a, b, c) to each point, all (M, 3), vectorized
+  # over the rows (the region tests of Ericson, Real-Time Collision Detection,
+  # 5.1.5). Returns the closest points and the barycentric weight of a.
+  ab = b - a
+  ac = c - a
+  def dot(u, v):
+    return np.einsum("mi,mi->m", u, v)
+  ap = points - a
+  d1, d2 = dot(ab, ap), dot(ac, ap)
+  bp = points - b
+  d3, d4 = dot(ab, bp), dot(ac, bp)
+  cp = points - c
+  d5, d6 = dot(ab, cp), dot(ac, cp)
+  va = d3 * d6 - d5 * d4
+  vb = d5 * d2 - d1 * d6
+  vc = d1 * d4 - d3 * d2
+  with np.errstate(divide="ignore", invalid="ignore"):
+    edgeAB = d1 / (d1 - d3)
+    edgeAC = d2 / (d2 - d6)
+    edgeBC = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+    inside = 1 / (va + vb + vc)
+  # weights (of b, of c) for each Voronoi region, in the order of the tests
+  regions = [
+    (d1 <= 0) & (d2 <= 0),
+    (d3 >= 0) & (d4 <= d3),
+    (vc <= 0) & (d1 >= 0) & (d3 <= 0),
+    (d6 >= 0) & (d5 <= d6),
+    (vb <= 0) & (d2 >= 0) & (d6 <= 0),
+    (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0),
+    ]
+  zeros = np.zeros(len(points))
+  weightB = np.select(regions, [zeros, zeros + 1, edgeAB, zeros, zeros, 1 - edgeBC], vb * inside)
+  weightC = np.select(regions, [zeros, zeros, zeros, zeros + 1, edgeAC, edgeBC], vc * inside)
+  weightA = 1 - weightB - weightC
+  closest = a * weightA[:, None] + b * weightB[:, None] + c * weightC[:, None]
+  return closest, weightA
+
+
+def vertexTriangleRings(triangles, vertexCount):
+  # The triangles around every vertex (its one-ring) in CSR form: the ring of
+  # vertex v is rings[starts[v]:starts[v + 1]], each row a triangle's vertices
+  # rotated so that v comes first.
+  corners = np.concatenate([np.roll(triangles, -k, axis=1) for k in range(3)])
+  corners = corners[np.argsort(corners[:, 0], kind="stable")]
+  starts = np.zeros(vertexCount + 1, dtype=np.int64)
+  np.cumsum(np.bincount(corners[:, 0], minlength=vertexCount), out=starts[1:])
+  return corners, starts
+
+
+def projectedNearestVertices(targetMesh, queryXYZ, workers=-1, kdTree=None, exactQuery=None):
+  # Hybrid correspondence, "snap then project": the nearest target vertex of
+  # every query point from one vectorized k-d tree query (as nearestVertices),
+  # then the closest point on the triangles around that vertex. Its distance d
+  # bounds the distance to the surface, and a triangle can only hold a closer
+  # point if the query point is within d + r of its center, r being the radius
+  # of the triangle around its center. Those triangles are looked up among the
+  # HYBRID_CANDIDATE_COUNTS nearest triangle centers in turn, and the closest
+  # point on any of them replaces the one-ring result, so the result is the
+  # exact closest point on the surface. Points for which even the largest count
+  # could miss a triangle (or whose vertex has no triangles) get the full exact
+  # query, exactQuery(targetMesh, queryXYZ) (closestPointsOnSurface by
+  # default). Returns an (N, 3) float64 array, equal to the exact query up to
+  # rounding (and the choice among equally near points), and the number of
+  # points that needed the exact query.
+  from scipy.spatial import cKDTree
+  queryXYZ = np.asarray(queryXYZ, dtype=np.float64)
+  targetXYZ = vtk_np.vtk_to_numpy(targetMesh.GetPoints().GetData()).astype(np.float64)
+  tree = kdTree if kdTree is not None else buildKDTree(targetMesh)
+  def treeQuery(tree, pointsXYZ, k):
+    try:
+      return tree.query(pointsXYZ, k=k, workers=workers)
+    except TypeError:  # older scipy without the workers kwarg
+      return tree.query(pointsXYZ, k=k)
+  with profiling.stage("query"):
+    triangles = meshTriangles(targetMesh)
+    _, nearest = treeQuery(tree, queryXYZ, 1)
+    rings, starts = vertexTriangleRings(triangles, len(targetXYZ))
+    closestXYZ = targetXYZ[nearest]
+    ringSizes = starts[nearest + 1] - starts[nearest]
+    # every (query point, ring triangle) pair, grouped by query point
+    pairQuery = np.repeat(np.arange(len(queryXYZ)), ringSizes)
+    groupStarts = np.cumsum(ringSizes) - ringSizes
+    pairRing = starts[nearest][pairQuery] + np.arange(len(pairQuery)) - groupStarts[pairQuery]
+    bound = np.full(len(queryXYZ), np.inf)
+    _nearestProjections(queryXYZ, pairQuery, targetXYZ[rings[pairRing]], closestXYZ, bound)
+    needsExact = ~np.isfinite(bound)
+    if len(triangles):
+      corners = targetXYZ[triangles]
+      centers = corners.mean(axis=1)
+      radii = np.sqrt(np.einsum("tki,tki->tk", corners - centers[:, None], corners - centers[:, None]).max(axis=1))
+      maximumRadius = radii.max()
+      centerTree = cKDTree(centers)
+      # a small margin for rounding, so the certificate never drops a triangle
+      reach = bound + 1e-9 * (bound + maximumRadius) + 1e-12
+      pending = np.flatnonzero(~needsExact)
+      for candidateCount in HYBRID_CANDIDATE_COUNTS:
+        candidateCount = min(candidateCount, len(triangles))
+        missed = []
+        for chunkStart in range(0, len(pending), HYBRID_CHUNK_SIZE):
+          chunk = pending[chunkStart:chunkStart + HYBRID_CHUNK_SIZE]
+          centerDistances, candidates = treeQuery(centerTree, queryXYZ[chunk], candidateCount)
+          centerDistances = centerDistances.reshape(len(chunk), -1)
+          candidates = candidates.reshape(len(chunk), -1)
+          # any triangle beyond the candidates has its center at least as far
+          # as the last of them
+          chunkMissed = np.zeros(len(chunk), dtype=bool)
+          if candidateCount < len(triangles):
+            chunkMissed = centerDistances[:, -1] - maximumRadius <= reach[chunk]
+          pairRow, pairColumn = np.nonzero((centerDistances - radii[candidates] <= reach[chunk, None]) & ~chunkMissed[:, None])
+          _nearestProjections(queryXYZ, chunk[pairRow], corners[candidates[pairRow, pairColumn]], closestXYZ, bound)
+          missed.append(chunk[chunkMissed])
+        pending = np.concatenate(missed) if missed else pending[:0]
+      needsExact[pending] = True
+  exactCount = int(needsExact.sum())
+  if exactCount:
+    closestXYZ[needsExact] = (exactQuery or closestPointsOnSurface)(targetMesh, queryXYZ[needsExact])
+  return closestXYZ, exactCount
+
+
+def _nearestProjections(queryXYZ, pairQuery, pairCorners, closestXYZ, distances):
+  # Project the query point of each pair onto the pair's (3, 3) triangle corners
+  # and, where the result is nearer than distances, update closestXYZ and
+  # distances in place.
+  if len(pairQuery) == 0:
+    return
+  pairClosest, _ = closestPointsOnTriangles(queryXYZ[pairQuery], pairCorners[:, 0], pairCorners[:, 1], pairCorners[:, 2])
+  offsets = pairClosest - queryXYZ[pairQuery]
+  pairDistances = np.sqrt(np.einsum("mi,mi->m", offsets, offsets))
+  pairDistances[~np.isfinite(pairDistances)] = np.inf  # degenerate triangles
+  # the nearest pair of each query point comes first in its group
+  order = np.lexsort((pairDistances, pairQuery))
+  queries, first = np.unique(pairQuery[order], return_index=True)
+  best = order[first]
+  nearer = pairDistances[best] < distances[queries]
+  distances[queries[nearer]] = pairDistances[best[nearer]]
+  closestXYZ[queries[nearer]] = pairClosest[best[nearer]]
+
+
+# Per-worker cache of the most recent target mesh locator, keyed by the shared
+# memory block it was read from, so a worker that receives several slices of
+# the same query builds the locator only once.
+_workerLocator = (None, None)
+
+
+def _closestPointsSliceWorker(descriptor, start, stop):
+  global _workerLocator
+  shm, arrays = parallel.attachSharedArrays(descriptor)
+  try:
+    if _workerLocator[0] != descriptor[0]:
+      meshArrays = {key: value for key, value in arrays.items() if key != "query"}
+      _workerLocator = (descriptor[0], buildCellLocator(arraysToPolyData(meshArrays)))
+    queryXYZ = np.array(arrays["query"][start:stop])
+  finally:
+    del arrays
+    shm.close()
+  return locatorClosestPoints(_workerLocator[1], queryXYZ)
+
+
+class ExactClosestPointEngine:
+  # Batched, multi-process version of closestPointsOnSurface. The target mesh and
+  # the query points are placed in shared memory once per query, the queries are
+  # split into one contiguous slice per worker, and each worker answers its slice
+  # with its own vtkCellLocator. The results are bit-for-bit identical to the
+  # serial per-point loop.
+  #
+  # The worker pool is started on first use and kept for the lifetime of the
+  # engine, so use it as a context manager around a whole per-subject loop. If
+  # the pool cannot be started or breaks, the engine logs a warning and falls
+  # back to the serial query for the rest of its lifetime.
+  def __init__(self, workers=None, pythonExecutable=None):
+    self.workers = parallel.resolveWorkerCount(workers)
+    self.pythonExecutable = pythonExecutable
+    self._pool = None
+    self._poolFailed = False
+
+  def query(self, targetMesh, queryXYZ):
+    queryXYZ = np.asarray(queryXYZ)
+    if self.workers < 2 or self._poolFailed or len(queryXYZ) < MINIMUM_PARALLEL_QUERY_COUNT:
+      return closestPointsOnSurface(targetMesh, queryXYZ)
+    try:
+      if self._pool is None:
+        self._pool = parallel.createProcessPool(self.workers, self.pythonExecutable)
+      meshArrays = polyDataToArrays(targetMesh)
+      meshArrays["query"] = queryXYZ
+      bounds = np.linspace(0, len(queryXYZ), self.workers + 1).astype(int)
+      # the workers build their locators, so this is all one "query" stage
+      with profiling.stage("query"), parallel.SharedArrays(meshArrays) as sharedArrays:
+        futures = [self._pool.submit(_closestPointsSliceWorker, sharedArrays.descriptor, start, stop)
+                   for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        return np.concatenate([future.result() for future in futures])
+    except (BrokenProcessPool, OSError) as e:
+      logging.warning(f"Parallel closest-point query failed ({e}); continuing with the serial exact query.")
+      self._poolFailed = True
+      self.close()
+      return closestPointsOnSurface(targetMesh, queryXYZ)
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.shutdown(wait=True, cancel_futures=True)
+      self._pool = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
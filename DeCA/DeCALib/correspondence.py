@@ -0,0 +1,386 @@
+import contextlib
+import itertools
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+from DeCALib import closestPoint, parallel, profiling, tps
+from DeCALib.warpCache import WarpedMeshCache
+
+
+def readMesh(path):
+  # Scene-free model reader that returns the same RAS geometry as
+  # slicer.util.loadModel: files carry their coordinate system in a "SPACE=..."
+  # header comment (or field data array for .vtp), and files without one are
+  # taken to be LPS, as Slicer does.
+  extension = os.path.splitext(path)[1].lower()
+  readers = {".ply": vtk.vtkPLYReader, ".stl": vtk.vtkSTLReader, ".vtp": vtk.vtkXMLPolyDataReader,
+             ".vtk": vtk.vtkPolyDataReader, ".obj": vtk.vtkOBJReader}
+  if extension not in readers:
+    raise ValueError(f"Unsupported model file type: {path}")
+  reader = readers[extension]()
+  reader.SetFileName(path)
+  with profiling.stage("mesh load"):
+    reader.Update()
+  mesh = reader.GetOutput()
+  if mesh is None or mesh.GetNumberOfPoints() == 0:
+    raise ValueError(f"Could not read model: {path}")
+  if _meshCoordinateSystem(path, mesh) == "LPS":
+    _flipLPSRAS(mesh)
+  return mesh
+
+
+def _flipLPSRAS(mesh, copyArrays=False):
+  # Convert mesh between LPS and RAS in place: negate x and y of the points and
+  # of the normals and vectors of the point and cell data, as the LPS/RAS
+  # transform Slicer applies when loading and saving models does (colors and
+  # other arrays are left alone). With copyArrays the flipped arrays replace
+  # copies, so a shallow copy can be flipped without changing the mesh it
+  # shares its arrays with.
+  points = vtk_np.vtk_to_numpy(mesh.GetPoints().GetData())
+  if copyArrays:
+    mesh.SetPoints(pointsFromArray(points * np.array([-1, -1, 1], dtype=points.dtype)))
+  else:
+    points[:, :2] *= -1
+    mesh.GetPoints().Modified()
+  for data in (mesh.GetPointData(), mesh.GetCellData()):
+    flipped = []
+    for array, setter in ((data.GetNormals(), data.SetNormals), (data.GetVectors(), data.SetVectors)):
+      if array is None or array.GetNumberOfComponents() != 3 or any(array is other for other in flipped):
+        continue
+      flipped.append(array)
+      if copyArrays:
+        copy = array.NewInstance()
+        copy.DeepCopy(array)
+        setter(copy)
+        array = copy
+      vtk_np.vtk_to_numpy(array)[:, :2] *= -1
+      array.Modified()
+
+
+def _meshCoordinateSystem(path, mesh):
+  spaceArray = mesh.GetFieldData().GetAbstractArray("SPACE")
+  if spaceArray is not None and spaceArray.GetNumberOfValues() > 0:
+    return "RAS" if str(spaceArray.GetValue(0)).upper() == "RAS" else "LPS"
+  with open(path, "rb") as meshFile:
+    header = meshFile.read(4096)
+  return "RAS" if b"SPACE=RAS" in header else "LPS"
+
+
+def writeMesh(path, mesh):
+  # Counterpart of readMesh: write a mesh given in RAS to a model file in LPS,
+  # marked "SPACE=LPS" as slicer.util.saveNode writes it, so Slicer and readMesh
+  # load it back unchanged. The input mesh is not modified.
+  extension = os.path.splitext(path)[1].lower()
+  writers = {".ply": vtk.vtkPLYWriter, ".stl": vtk.vtkSTLWriter, ".vtp": vtk.vtkXMLPolyDataWriter, ".vtk": vtk.vtkPolyDataWriter}
+  if extension not in writers:
+    raise ValueError(f"Unsupported model file type: {path}")
+  lpsMesh = vtk.vtkPolyData()
+  lpsMesh.ShallowCopy(mesh)
+  _flipLPSRAS(lpsMesh, copyArrays=True)
+  writer = writers[extension]()
+  if extension == ".ply":
+    writer.AddComment("SPACE=LPS")
+  elif extension in (".stl", ".vtk"):
+    writer.SetHeader("SPACE=LPS")
+  else:
+    space = vtk.vtkStringArray()
+    space.SetName("SPACE")
+    space.InsertNextValue("LPS")
+    lpsMesh.GetFieldData().AddArray(space)
+  writer.SetFileName(path)
+  writer.SetInputData(lpsMesh)
+  with profiling.stage("mesh write"):
+    if not writer.Write():
+      raise OSError(f"Could not write model: {path}")
+
+
+def thinPlateSplineWarp(mesh, sourceLandmarks, targetLandmarks):
+  # R-basis (3D) thin-plate spline warp of mesh taking sourceLandmarks onto
+  # targetLandmarks (both vtkPoints).
+  transform = vtk.vtkThinPlateSplineTransform()
+  transform.SetSourceLandmarks(sourceLandmarks)
+  transform.SetTargetLandmarks(targetLandmarks)
+  transform.SetBasisToR() # for 3D transform
+
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetInputData(mesh)
+  transformFilter.SetTransform(transform)
+  transformFilter.Update()
+  return transformFilter.GetOutput()
+
+
+def splineWarpMesh(mesh, spline, coefficients, threads=None):
+  # NumPy counterpart of thinPlateSplineWarp for a tps.ThinPlateSpline and its
+  # solved coefficients. Like vtkTransformPolyDataFilter, the output keeps the
+  # input connectivity and point precision.
+  meshXYZ = vtk_np.vtk_to_numpy(mesh.GetPoints().GetData())
+  warpedMesh = vtk.vtkPolyData()
+  warpedMesh.SetPoints(pointsFromArray(spline.evaluate(coefficients, meshXYZ, workers=threads).astype(meshXYZ.dtype)))
+  warpedMesh.SetVerts(mesh.GetVerts())
+  warpedMesh.SetLines(mesh.GetLines())
+  warpedMesh.SetPolys(mesh.GetPolys())
+  warpedMesh.SetStrips(mesh.GetStrips())
+  return warpedMesh
+
+
+def forwardWarp(originalMesh, originalLandmarks, meanShape, useNumpyTPS=False, threads=None):
+  # Warp a subject mesh onto the mean shape, with VTK or with the NumPy spline.
+  with profiling.stage("forward TPS"):
+    if not useNumpyTPS:
+      return thinPlateSplineWarp(originalMesh, originalLandmarks, meanShape)
+    spline = tps.ThinPlateSpline(vtk_np.vtk_to_numpy(originalLandmarks.GetData()))
+    return splineWarpMesh(originalMesh, spline, spline.solve(vtk_np.vtk_to_numpy(meanShape.GetData())), threads)
+
+
+def warpSubjectToMean(mesh, originalLandmarks, meanShape, useNumpyTPS=False, threads=None, warpCache=None, withKDTree=False):
+  # forwardWarp for a mesh given as a model file path or a vtkPolyData, through
+  # an optional warpCache.WarpedMeshCache: on a hit the warped mesh is loaded
+  # instead of reading and warping the subject. With withKDTree the k-d tree of
+  # its points is built too. Returns (meanWarpedMesh, kdTree or None).
+  cacheKey = None
+  meanWarpedMesh = None
+  if warpCache is not None:
+    cacheKey = warpCache.key(mesh, vtk_np.vtk_to_numpy(originalLandmarks.GetData()),
+      vtk_np.vtk_to_numpy(meanShape.GetData()), useNumpyTPS)
+    with profiling.stage("warp cache load"):
+      meanWarpedMesh = warpCache.load(cacheKey)
+  if meanWarpedMesh is None:
+    if isinstance(mesh, str):
+      mesh = readMesh(mesh)
+    meanWarpedMesh = forwardWarp(mesh, originalLandmarks, meanShape, useNumpyTPS, threads)
+    if warpCache is not None:
+      warpCache.store(cacheKey, meanWarpedMesh)
+  kdTree = closestPoint.buildKDTree(meanWarpedMesh) if withKDTree else None
+  return meanWarpedMesh, kdTree
+
+
+def correspondingPoints(queryPoints, targetMesh, useFast=False, exactEngine=None, kdTreeWorkers=-1, kdTree=None, hybrid=False):
+  # For each point in queryPoints (vtkPoints), the corresponding point on
+  # targetMesh as a new, index-aligned vtkPoints: the exact closest surface point
+  # by default, or the nearest vertex when useFast is set (falling back to the
+  # exact query if scipy is not available). useFast with hybrid projects each
+  # nearest vertex onto its surrounding triangles and any other triangle that
+  # could hold a nearer point (see closestPoint.projectedNearestVertices),
+  # which gives the exact result from vectorized queries.
+  queryXYZ = vtk_np.vtk_to_numpy(queryPoints.GetData())
+  matchedXYZ = None
+  if useFast:
+    try:
+      if hybrid:
+        exactQuery = exactEngine.query if exactEngine is not None else None
+        matchedXYZ, _ = closestPoint.projectedNearestVertices(targetMesh, queryXYZ, kdTreeWorkers, kdTree, exactQuery)
+        matchedXYZ = matchedXYZ.astype(np.float32)
+      else:
+        matchedXYZ = closestPoint.nearestVertices(targetMesh, queryXYZ, kdTreeWorkers, kdTree)
+    except ImportError:
+      logging.warning("Fast correspondence requires scipy, which could not be "
+                      "imported; falling back to the exact method.")
+  if matchedXYZ is None:
+    if exactEngine is not None:
+      matchedXYZ = exactEngine.query(targetMesh, queryXYZ)
+    else:
+      matchedXYZ = closestPoint.closestPointsOnSurface(targetMesh, queryXYZ)
+    # stored as float, the default vtkPoints type of the original per-point loop
+    matchedXYZ = matchedXYZ.astype(np.float32)
+  points = vtk.vtkPoints()
+  points.SetData(vtk_np.numpy_to_vtk(np.ascontiguousarray(matchedXYZ), deep=True))
+  return points
+
+
+def inverseWarpCorrespondence(matchedPoints, meanWarpedBase, meanShape, originalLandmarks, inverseSpline=None, inverseCoefficients=None, threads=None):
+  # Copy the matched points into a mesh with the base connectivity and warp it
+  # from the mean shape back onto the subject's landmarks. The source of this
+  # warp is always the mean shape, so callers that process many subjects pass
+  # one inverseSpline = tps.ThinPlateSpline(meanShape) for the whole run (and,
+  # optionally, this subject's row of inverseSpline.solve(allLandmarks)) to use
+  # the NumPy spline instead of VTK.
+  correspondingMesh = vtk.vtkPolyData()
+  correspondingMesh.SetPoints(matchedPoints)
+  correspondingMesh.SetPolys(meanWarpedBase.GetPolys())
+  with profiling.stage("inverse TPS"):
+    if inverseSpline is None:
+      return thinPlateSplineWarp(correspondingMesh, meanShape, originalLandmarks)
+    if inverseCoefficients is None:
+      inverseCoefficients = inverseSpline.solve(vtk_np.vtk_to_numpy(originalLandmarks.GetData()))
+    return splineWarpMesh(correspondingMesh, inverseSpline, inverseCoefficients, threads)
+
+
+def correspondSubject(originalMesh, originalLandmarks, meanWarpedBase, meanShape, useFast=False, exactEngine=None, threads=None, inverseSpline=None, inverseCoefficients=None, warpCache=None, hybrid=False):
+  # The whole per-subject DeCA correspondence: warp the subject onto the mean
+  # shape, find the subject point corresponding to every meanWarpedBase point,
+  # and warp those back into the subject's frame. Passing an inverseSpline
+  # selects the NumPy thin-plate splines for both warps. originalMesh may be a
+  # model file path; see warpSubjectToMean for warpCache and correspondingPoints
+  # for hybrid.
+  useNumpyTPS = inverseSpline is not None
+  meanWarpedMesh, kdTree = warpSubjectToMean(originalMesh, originalLandmarks, meanShape, useNumpyTPS, threads, warpCache, useFast)
+  matchedPoints = correspondingPoints(meanWarpedBase.GetPoints(), meanWarpedMesh, useFast, exactEngine, threads or -1, kdTree, hybrid)
+  return inverseWarpCorrespondence(matchedPoints, meanWarpedBase, meanShape, originalLandmarks,
+    inverseSpline, inverseCoefficients, threads)
+
+
+def pointSubset(mesh, index):
+  # A cell-free polydata holding only the points of mesh at index, in that order.
+  subset = vtk.vtkPolyData()
+  subset.SetPoints(pointsFromArray(vtk_np.vtk_to_numpy(mesh.GetPoints().GetData())[np.asarray(index)]))
+  return subset
+
+
+def transformMesh(mesh, matrix):
+  # Geometry-only copy of mesh with its points mapped by a 4x4 linear transform
+  # (e.g. a landmark alignment). Points are stored as float32, as a transformed
+  # mesh saved and reloaded would be.
+  arrays = closestPoint.polyDataToArrays(mesh)
+  matrix = np.asarray(matrix, dtype=np.float64)
+  arrays["points"] = (arrays["points"].astype(np.float64) @ matrix[:3, :3].T + matrix[:3, 3]).astype(np.float32)
+  return closestPoint.arraysToPolyData(arrays)
+
+
+def pointsFromArray(xyz):
+  points = vtk.vtkPoints()
+  points.SetData(vtk_np.numpy_to_vtk(np.ascontiguousarray(xyz), deep=True))
+  return points
+
+
+# State set up once per worker process by _initializeSubjectWorker.
+_workerState = {}
+
+
+def _initializeSubjectWorker(descriptor, useFast, threads, useNumpyTPS=False, warpCacheArguments=None, profile=False, hybrid=False):
+  vtk.vtkSMPTools.Initialize(threads)
+  vtk.vtkMultiThreader.SetGlobalMaximumNumberOfThreads(threads)
+  shm, arrays = parallel.attachSharedArrays(descriptor)
+  try:
+    frames = []
+    while f"{len(frames)}/meanShape" in arrays:
+      prefix = f"{len(frames)}/base:"
+      baseArrays = {key[len(prefix):]: value for key, value in arrays.items() if key.startswith(prefix)}
+      meanShape = pointsFromArray(arrays[f"{len(frames)}/meanShape"])
+      # the inverse spline's source is the mean shape, so factorize it once per worker
+      inverseSpline = tps.ThinPlateSpline(vtk_np.vtk_to_numpy(meanShape.GetData())) if useNumpyTPS else None
+      frames.append((closestPoint.arraysToPolyData(baseArrays), meanShape, inverseSpline))
+    _workerState["frames"] = frames
+    _workerState["outputIndex"] = np.array(arrays["outputIndex"]) if "outputIndex" in arrays else None
+  finally:
+    del arrays
+    shm.close()
+  _workerState["useFast"] = useFast
+  _workerState["hybrid"] = hybrid
+  _workerState["threads"] = threads
+  _workerState["warpCache"] = WarpedMeshCache(*warpCacheArguments) if warpCacheArguments else None
+  # the worker's stage timings go back to the parent with each result
+  _workerState["trace"] = profiling.StageTrace() if profile else None
+
+
+def _correspondSubjectWorker(key, mesh, landmarkXYZ, meshMatrix=None, frame=0):
+  # mesh is either a model file path or the polyDataToArrays form of a mesh,
+  # optionally mapped by a 4x4 meshMatrix (e.g. its alignment) before use. frame
+  # selects the (meanWarpedBase, meanShape) pair to correspond against. Also
+  # returns whether the warped mesh came from the cache (None without one) and
+  # the subject's stage timings (None unless profiling).
+  trace = _workerState["trace"]
+  with profiling.tracing(trace), profiling.subject(key):
+    result = _correspondSubject(key, mesh, landmarkXYZ, meshMatrix, frame)
+  return result + (trace.takeEvents() if trace is not None else None,)
+
+
+def _correspondSubject(key, mesh, landmarkXYZ, meshMatrix, frame):
+  if not isinstance(mesh, str):
+    mesh = closestPoint.arraysToPolyData(mesh)
+  if meshMatrix is not None:
+    mesh = transformMesh(readMesh(mesh) if isinstance(mesh, str) else mesh, meshMatrix)
+  meanWarpedBase, meanShape, inverseSpline = _workerState["frames"][frame]
+  cache = _workerState["warpCache"]
+  hitsBefore = cache.hits if cache is not None else 0
+  correspondingMesh = correspondSubject(mesh, pointsFromArray(landmarkXYZ), meanWarpedBase,
+    meanShape, _workerState["useFast"], threads=_workerState["threads"], inverseSpline=inverseSpline, warpCache=cache,
+    hybrid=_workerState["hybrid"])
+  correspondingXYZ = vtk_np.vtk_to_numpy(correspondingMesh.GetPoints().GetData())
+  if _workerState["outputIndex"] is not None:
+    correspondingXYZ = correspondingXYZ[_workerState["outputIndex"]]
+  return key, np.array(correspondingXYZ), (cache.hits > hitsBefore if cache is not None else None)
+
+
+class SubjectCorrespondencePool:
+  # Runs correspondSubject for many subjects on a pool of worker processes.
+  # meanWarpedBase and meanShape may also be equal-length lists of frames (e.g.
+  # the two sides of a symmetry analysis); each job then names its frame.
+  #
+  # The inputs shared by every subject (meanWarpedBase, meanShape and the
+  # optional outputIndex of points to return) are placed in shared memory once
+  # and read by each worker when it starts, so tasks only carry the subject's own
+  # mesh (a file path, or mesh arrays) and landmarks. Each worker is
+  # single-subject, so the cores are split between the workers and every
+  # worker's BLAS / VTK / k-d tree threads are limited to its share. With a
+  # warpCache the workers share its directory and size cap, and the pool's
+  # cacheHits / cacheMisses count their lookups. If a profiling trace is active
+  # when the pool is created, the workers' stage timings are added to it,
+  # under the job keys.
+  def __init__(self, meanWarpedBase, meanShape, workers=None, useFast=False, outputIndex=None, pythonExecutable=None, useNumpyTPS=False, warpCache=None, hybrid=False):
+    self.workers = parallel.resolveWorkerCount(workers)
+    self.cacheHits = 0
+    self.cacheMisses = 0
+    threads = parallel.threadsPerWorker(self.workers)
+    if not isinstance(meanWarpedBase, (list, tuple)):
+      meanWarpedBase, meanShape = [meanWarpedBase], [meanShape]
+    sharedInputs = {}
+    for frame, (frameBase, frameMeanShape) in enumerate(zip(meanWarpedBase, meanShape)):
+      sharedInputs.update({f"{frame}/base:{key}": value for key, value in closestPoint.polyDataToArrays(frameBase).items()})
+      sharedInputs[f"{frame}/meanShape"] = vtk_np.vtk_to_numpy(frameMeanShape.GetData())
+    if outputIndex is not None:
+      sharedInputs["outputIndex"] = np.asarray(outputIndex)
+    self._resources = contextlib.ExitStack()
+    self._sharedArrays = self._resources.enter_context(parallel.SharedArrays(sharedInputs))
+    self._resources.enter_context(parallel.workerThreadLimit(threads))
+    self._trace = profiling.activeTrace()
+    self._pool = parallel.createProcessPool(self.workers, pythonExecutable, _initializeSubjectWorker,
+      (self._sharedArrays.descriptor, bool(useFast), threads, bool(useNumpyTPS),
+       (warpCache.directory, warpCache.maxBytes) if warpCache is not None else None, self._trace is not None, bool(hybrid)))
+
+  def imapUnordered(self, jobs, maxPending=None):
+    # jobs: iterable of (key, mesh, landmarkXYZ[, meshMatrix[, frame]]), where
+    # mesh is a model file path or polyDataToArrays(mesh), meshMatrix an optional
+    # 4x4 transform applied to the mesh first (or None) and frame the index of
+    # the frame to use (default 0). Yields (key, correspondingXYZ) as
+    # subjects finish, in completion order. Jobs are submitted in the order given,
+    # so pass the largest meshes first to avoid a long straggler at the end. At
+    # most maxPending jobs (default twice the workers) are queued at a time, so a
+    # jobs generator that loads meshes only holds a few of them in memory.
+    maxPending = maxPending or 2 * self.workers
+    jobs = iter(jobs)
+    pending = set()
+    try:
+      while True:
+        for key, mesh, landmarkXYZ, *options in itertools.islice(jobs, maxPending - len(pending)):
+          pending.add(self._pool.submit(_correspondSubjectWorker, key, mesh, np.asarray(landmarkXYZ), *options))
+        if not pending:
+          return
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          key, correspondingXYZ, cacheHit, events = future.result()
+          if cacheHit is not None:
+            self.cacheHits += cacheHit
+            self.cacheMisses += not cacheHit
+          if events and self._trace is not None:
+            self._trace.extend(events)
+          yield key, correspondingXYZ
+    finally:
+      for future in pending:
+        future.cancel()
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.shutdown(wait=True, cancel_futures=True)
+      self._pool = None
+    self._resources.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -0,0 +1,147 @@
+import json
+import os
+
+import numpy as np
+
+# Layout version, recorded in every store.
+STORE_VERSION = 1
+
+# /provenance values
+FIXED = 0
+SEMI = 1
+
+# Points per chunk of /points (one subject per chunk): 48 KiB of float32 XYZ.
+POINT_CHUNK = 4096
+
+
+class CorrespondenceStore:
+  # The DeCAL correspondences of a whole sample in one HDF5 file, for shape
+  # analysis outside Slicer (h5py or PyTables in Python, rhdf5 or hdf5r in R)
+  # without parsing one point list per subject:
+  #   /points      (subjects, points, 3) float32: each subject's fixed landmarks
+  #                followed by its semi-landmarks, in the frame DeCAL ran in
+  #   /subjects    (subjects,) subject names, the rows of /points
+  #   /keys        (subjects,) result key of each row (see resultCache)
+  #   /atlas       (points, 3) the atlas fixed landmarks and semi-landmarks
+  #   /provenance  (points,) FIXED or SEMI for each point
+  #   /labels      (points,) landmark number of fixed points, template
+  #                position of semi-landmarks (as in the point list labels)
+  # and the attributes version, runKey and settings (JSON). /points is chunked
+  # by one subject and POINT_CHUNK points and gzip-compressed, so reading a
+  # subject or a point range decompresses only the chunks it covers. Rows are
+  # appended (or replaced) as subjects finish and flushed each time, so an
+  # interrupted run leaves every finished row readable. h5py is imported on
+  # use, so DeCALib works without it.
+  #
+  # Open for reading with CorrespondenceStore(path); create or resume one with
+  # CorrespondenceStore.openForWriting.
+
+  def __init__(self, path, mode="r"):
+    import h5py
+    self.path = path
+    self._file = h5py.File(path, mode)
+    self._points = self._file["points"]
+    self._subjects = self._file["subjects"]
+    self._keys = self._file["keys"]
+    self._index = {name: i for i, name in enumerate(self._subjects.asstr()[()])}
+
+  @classmethod
+  def openForWriting(cls, path, atlasPoints, provenance, labels, runKey, settings=None):
+    # The store at path opened for appending if it holds the same run (runKey)
+    # and points; otherwise (no file, another run, or a file an interrupted
+    # write left unreadable) a new, empty store replaces it.
+    import h5py
+    atlasPoints = np.asarray(atlasPoints, dtype=np.float64).reshape(-1, 3)
+    if os.path.exists(path):
+      try:
+        store = cls(path, "r+")
+        if store._file.attrs.get("runKey") == runKey and store._points.shape[1] == len(atlasPoints) \
+            and store._file.attrs.get("version") == STORE_VERSION:
+          return store
+        store.close()
+      except (OSError, KeyError):
+        pass
+      os.remove(path)
+    pointCount = len(atlasPoints)
+    with h5py.File(path, "w") as storeFile:
+      storeFile.attrs["version"] = STORE_VERSION
+      storeFile.attrs["runKey"] = runKey
+      storeFile.attrs["settings"] = json.dumps(settings or {}, sort_keys=True)
+      storeFile.create_dataset("points", shape=(0, pointCount, 3), maxshape=(None, pointCount, 3), dtype=np.float32,
+        chunks=(1, max(1, min(pointCount, POINT_CHUNK)), 3), compression="gzip", compression_opts=4, shuffle=True)
+      storeFile.create_dataset("subjects", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(256,))
+      storeFile.create_dataset("keys", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(256,))
+      storeFile.create_dataset("atlas", data=atlasPoints)
+      storeFile.create_dataset("provenance", data=np.asarray(provenance, dtype=np.uint8))
+      storeFile.create_dataset("labels", data=np.asarray(labels, dtype=np.int64))
+    return cls(path, "r+")
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return len(self._index)
+
+  @property
+  def subjectNames(self):
+    return list(self._index)
+
+  @property
+  def pointCount(self):
+    return self._points.shape[1]
+
+  @property
+  def settings(self):
+    return json.loads(self._file.attrs.get("settings", "{}"))
+
+  @property
+  def atlas(self):
+    return self._file["atlas"][()]
+
+  @property
+  def provenance(self):
+    return self._file["provenance"][()]
+
+  @property
+  def labels(self):
+    return self._file["labels"][()]
+
+  def contains(self, name, key=None):
+    # True if name has a row (computed with key, if given).
+    index = self._index.get(name)
+    return index is not None and (key is None or self._keys.asstr()[index] == key)
+
+  def write(self, name, key, pointsXYZ):
+    # Append name's row, or replace it if name already has one.
+    pointsXYZ = np.asarray(pointsXYZ, dtype=np.float32).reshape(-1, 3)
+    if len(pointsXYZ) != self.pointCount:
+      raise ValueError(f"{name} has {len(pointsXYZ)} points, the store holds {self.pointCount} per subject")
+    index = self._index.get(name)
+    if index is None:
+      index = len(self._index)
+      for dataset in (self._points, self._subjects, self._keys):
+        dataset.resize(index + 1, axis=0)
+      self._subjects[index] = name
+      self._index[name] = index
+    self._points[index] = pointsXYZ
+    self._keys[index] = key
+    self._file.flush()
+
+  def subject(self, name, points=slice(None)):
+    # (n, 3) points of one subject (by name or row), optionally a point range
+    # or selection; only the chunks holding them are read.
+    index = self._index[name] if isinstance(name, str) else int(name)
+    return self._points[index, points]
+
+  def read(self, subjects=slice(None), points=slice(None)):
+    # (subjects, points, 3) block of /points, by row slice (or increasing row
+    # list) and point slice; the whole array with the defaults.
+    return self._points[subjects, points]
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from DeCALib.warpCache import hashArray, hashFile
+
+JOURNAL_FILE = ".decal_journal"
+
+
+def fileChecksum(path):
+  digest = hashlib.sha256()
+  hashFile(digest, path)
+  return digest.hexdigest()
+
+
+def inputFingerprint(runKey, meshPath, landmarkXYZ, meshMatrix=None):
+  # Cheap stand-in for a subject's result key (see resultCache.subjectKey) that
+  # does not read the mesh: the run key, the mesh file's name, size and
+  # modification time, the landmarks and the mesh alignment. It changes whenever
+  # the result key can (and also when the mesh file is merely touched). The file
+  # name rather than its path is used, so hosts that mount a shared folder at
+  # different places agree on it.
+  status = os.stat(meshPath)
+  digest = hashlib.sha256(runKey.encode())
+  digest.update(f"{os.path.basename(meshPath)}:{status.st_size}:{status.st_mtime_ns}".encode())
+  hashArray(digest, landmarkXYZ)
+  if meshMatrix is not None:
+    hashArray(digest, np.asarray(meshMatrix, dtype=np.float64))
+  return digest.hexdigest()
+
+
+class OutputJournal:
+  # Append-only record of the subjects completed in an output folder, one JSON
+  # line per subject: {"name", "key", "fingerprint", "points", "sha256"}, where
+  # key is the subject's result cache key (see resultCache), fingerprint its
+  # inputFingerprint and sha256 the checksum of the written file. Resuming
+  # compares fingerprints (completedKey), so completed subjects are skipped
+  # without hashing their meshes. A line is appended (and synced) only after its output file
+  # has been renamed into place, so every recorded subject is complete; a line
+  # cut short by a crash is ignored when the journal is read back. Later lines
+  # for the same subject replace earlier ones.
+  #
+  # Processes sharing an output folder (see workQueue) each append to their own
+  # journal file, named after writerName, since appends from several hosts are
+  # not atomic on network filesystems; all journal files are read.
+
+  def __init__(self, directory, writerName=None):
+    self.path = os.path.join(directory, JOURNAL_FILE if writerName is None else f"{JOURNAL_FILE}.{writerName}")
+    self.entries = {}
+    self._endsMidLine = False
+    journalPaths = [os.path.join(directory, fileName) for fileName in sorted(os.listdir(directory))
+                    if fileName == JOURNAL_FILE or fileName.startswith(JOURNAL_FILE + ".")]
+    for journalPath in journalPaths:
+      try:
+        with open(journalPath, "r", encoding="utf-8") as journalFile:
+          for line in journalFile:
+            if journalPath == self.path:
+              self._endsMidLine = not line.endswith("\n")
+            try:
+              entry = json.loads(line)
+              self.entries[entry["name"]] = entry
+            except (ValueError, KeyError, TypeError):
+              continue
+      except OSError:
+        continue
+
+  def completedKey(self, name, fingerprint, outputPath):
+    # The result key name was completed with, if it was recorded with this input
+    # fingerprint and its output file is still there; otherwise None (entries
+    # without a fingerprint are then checked by key with isComplete).
+    entry = self.entries.get(name)
+    if entry is None or entry.get("fingerprint") != fingerprint or not os.path.exists(outputPath):
+      return None
+    return entry.get("key")
+
+  def isComplete(self, name, key, outputPath, verify=False):
+    # True if name was completed with the given key and its output file is still
+    # there; with verify, the file must also match the recorded checksum.
+    entry = self.entries.get(name)
+    if entry is None or entry.get("key") != key or not os.path.exists(outputPath):
+      return False
+    if verify:
+      try:
+        return fileChecksum(outputPath) == entry.get("sha256")
+      except OSError:
+        return False
+    return True
+
+  def record(self, name, key, pointCount, outputPath, fingerprint=None):
+    entry = {"name": name, "key": key, "fingerprint": fingerprint, "points": int(pointCount), "sha256": fileChecksum(outputPath)}
+    with open(self.path, "a", encoding="utf-8") as journalFile:
+      if self._endsMidLine:
+        journalFile.write("\n")  # end the line a crash cut short
+        self._endsMidLine = False
+      journalFile.write(json.dumps(entry) + "\n")
+      journalFile.flush()
+      os.fsync(journalFile.fileno())
+    self.entries[name] = entry
@@ -0,0 +1,243 @@
+import contextlib
+import csv
+import json
+import os
+import uuid
+
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+# Slicer stores markups in RAS but writes them to file in LPS by default.
+_RAS_TO_LPS = np.array([-1.0, -1.0, 1.0])
+
+MARKUPS_SCHEMA = "https://raw.githubusercontent.com/slicer/slicer/master/Modules/Loadable/Markups/Resources/Schema/markups-schema-v1.0.3.json#"
+
+# Orientation of an unrotated control point, as Slicer writes it in LPS.
+_LPS_ORIENTATION = "[-1.0, -0.0, -0.0, -0.0, -1.0, -0.0, 0.0, 0.0, 1.0]"
+
+
+def _bulkStrings(values, count, default):
+  # A list of count strings from None (use default(i)), a single string, or a
+  # sequence of per-point values.
+  if values is None:
+    return [default(i) for i in range(count)]
+  if isinstance(values, str):
+    return [values] * count
+  values = [str(value) for value in values]
+  if len(values) != count:
+    raise ValueError(f"Expected {count} values, got {len(values)}")
+  return values
+
+
+@contextlib.contextmanager
+def _atomicTextFile(path):
+  # Open a temporary file next to path for writing and rename it over path once
+  # it is complete, so a crash never leaves a half-written point list behind
+  # (readers only pick up .json/.fcsv names, never the temporary one).
+  temporaryPath = f"{path}.{uuid.uuid4().hex}.tmp"
+  try:
+    with open(temporaryPath, "w", encoding="utf-8") as textFile:
+      yield textFile
+      textFile.flush()
+      os.fsync(textFile.fileno())
+    os.replace(temporaryPath, path)
+  finally:
+    if os.path.exists(temporaryPath):
+      os.remove(temporaryPath)
+
+
+def writeMarkupsJson(path, pointsXYZ, labels=None, descriptions=None, coordinateSystem="LPS"):
+  # Write an (N, 3) array of RAS positions as a Slicer point list (.mrk.json)
+  # without creating a markups node. Points are labelled 0..N-1 unless labels are
+  # given; labels and descriptions may be a single string or one value per point.
+  # The file loads in Slicer exactly like one written by saveNode, and replaces
+  # any existing file at path atomically.
+  pointsXYZ = np.asarray(pointsXYZ, dtype=np.float64).reshape(-1, 3)
+  if coordinateSystem == "LPS":
+    pointsXYZ = pointsXYZ * _RAS_TO_LPS
+  pointCount = len(pointsXYZ)
+  labels = _bulkStrings(labels, pointCount, str)
+  descriptions = _bulkStrings(descriptions, pointCount, lambda i: "")
+  orientation = _LPS_ORIENTATION if coordinateSystem == "LPS" else "[1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0]"
+  # json.dumps on the strings handles quoting/escaping; repr of a float is the
+  # shortest text that reads back to the same double, as Slicer's writer does.
+  controlPointTemplate = ('{"id": "%d", "label": %s, "description": %s, "associatedNodeID": "", '
+    '"position": [%r, %r, %r], "orientation": ' + orientation + ', "selected": true, "locked": false, '
+    '"visibility": true, "positionStatus": "defined"}')
+  controlPoints = ",\n".join([controlPointTemplate % (i + 1, json.dumps(label), json.dumps(description), x, y, z)
+    for i, (label, description, (x, y, z)) in enumerate(zip(labels, descriptions, pointsXYZ.tolist()))])
+  header = {"type": "Fiducial", "coordinateSystem": coordinateSystem, "coordinateUnits": "mm", "locked": False,
+            "fixedNumberOfControlPoints": False, "labelFormat": "%N-%d", "lastUsedControlPointNumber": pointCount}
+  with _atomicTextFile(path) as markupsFile:
+    markupsFile.write('{"@schema": "%s",\n"markups": [{' % MARKUPS_SCHEMA)
+    markupsFile.write(json.dumps(header)[1:-1])
+    markupsFile.write(', "controlPoints": [\n')
+    markupsFile.write(controlPoints)
+    markupsFile.write('\n], "measurements": []}]}\n')
+
+
+def writeFcsv(path, pointsXYZ, labels=None, descriptions=None):
+  # .fcsv counterpart of writeMarkupsJson (Slicer's legacy CSV point list, LPS).
+  pointsXYZ = np.asarray(pointsXYZ, dtype=np.float64).reshape(-1, 3) * _RAS_TO_LPS
+  pointCount = len(pointsXYZ)
+  labels = [_fcsvEscape(label) for label in _bulkStrings(labels, pointCount, str)]
+  descriptions = [_fcsvEscape(description) for description in _bulkStrings(descriptions, pointCount, lambda i: "")]
+  rows = "\n".join(["%d,%r,%r,%r,0,0,0,1,1,1,0,%s,%s," % (i + 1, x, y, z, label, description)
+    for i, (label, description, (x, y, z)) in enumerate(zip(labels, descriptions, pointsXYZ.tolist()))])
+  with _atomicTextFile(path) as fcsvFile:
+    fcsvFile.write("# Markups fiducial file version = 5.0\n")
+    fcsvFile.write("# CoordinateSystem = LPS\n")
+    fcsvFile.write("# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n")
+    fcsvFile.write(rows)
+    if rows:
+      fcsvFile.write("\n")
+
+
+def _fcsvEscape(text):
+  # commas and quotes in a .fcsv field are written as a double-quoted field
+  if "," in text or '"' in text:
+    return '"' + text.replace('"', '""') + '"'
+  return text
+
+
+def writeMarkups(path, pointsXYZ, labels=None, descriptions=None):
+  # Write by file extension: .fcsv or (anything else) .mrk.json.
+  if os.path.splitext(path)[1].lower() == ".fcsv":
+    writeFcsv(path, pointsXYZ, labels, descriptions)
+  else:
+    writeMarkupsJson(path, pointsXYZ, labels, descriptions)
+
+
+def _isLPS(coordinateSystem):
+  # Slicer writes "LPS"/"RAS"; legacy .fcsv files use 1/0. Missing means RAS.
+  return str(coordinateSystem).strip().upper() in ("LPS", "1")
+
+
+def _readMarkupsJson(path):
+  with open(path, "r", encoding="utf-8") as markupsFile:
+    markups = json.load(markupsFile)["markups"][0]
+  controlPoints = markups.get("controlPoints", [])
+  pointsXYZ = np.array([point.get("position", (0.0, 0.0, 0.0)) for point in controlPoints], dtype=np.float64).reshape(-1, 3)
+  labels = [point.get("label", "") for point in controlPoints]
+  descriptions = [point.get("description", "") for point in controlPoints]
+  return pointsXYZ, labels, descriptions, _isLPS(markups.get("coordinateSystem", "RAS"))
+
+
+def _readFcsv(path):
+  coordinateSystem = "RAS"
+  columns = ["id", "x", "y", "z", "ow", "ox", "oy", "oz", "vis", "sel", "lock", "label", "desc", "associatedNodeID"]
+  rows = []
+  with open(path, "r", encoding="utf-8", newline="") as fcsvFile:
+    for row in csv.reader(fcsvFile):
+      if not row:
+        continue
+      if row[0].startswith("#"):
+        key, _, value = row[0][1:].partition("=")
+        key = key.strip()
+        if key == "CoordinateSystem":
+          coordinateSystem = value
+        elif key == "columns":
+          columns = [value.strip()] + [column.strip() for column in row[1:]]
+        continue
+      rows.append(row)
+  x, y, z = (columns.index(name) for name in ("x", "y", "z"))
+  label = columns.index("label") if "label" in columns else None
+  description = columns.index("desc") if "desc" in columns else None
+  pointsXYZ = np.array([(row[x], row[y], row[z]) for row in rows], dtype=np.float64).reshape(-1, 3)
+  labels = [row[label] if label is not None and label < len(row) else "" for row in rows]
+  descriptions = [row[description] if description is not None and description < len(row) else "" for row in rows]
+  return pointsXYZ, labels, descriptions, _isLPS(coordinateSystem)
+
+
+def readMarkups(path):
+  # Read the first point list in a .mrk.json or .fcsv file without loading it
+  # into the scene. Returns (pointsXYZ, labels, descriptions) with the (N, 3)
+  # float64 positions in RAS, as GetNthControlPointPosition would report them.
+  if os.path.splitext(path)[1].lower() == ".fcsv":
+    pointsXYZ, labels, descriptions, lps = _readFcsv(path)
+  else:
+    pointsXYZ, labels, descriptions, lps = _readMarkupsJson(path)
+  if lps:
+    pointsXYZ *= _RAS_TO_LPS
+  return pointsXYZ, labels, descriptions
+
+
+def readMarkupsPoints(path):
+  # Positions only, (N, 3) RAS.
+  return readMarkups(path)[0]
+
+
+def isLandmarkFile(fileName):
+  # The landmark files DeCA reads from a directory (hidden files excluded).
+  return not fileName.startswith(".") and fileName.endswith((".fcsv", ".json"))
+
+
+class LandmarkSet:
+  # Landmarks of a whole sample in one contiguous (total points, 3) array.
+  # names are the file names, counts the number of points in each file, and
+  # offsets where each subject starts in points. Positions are stored as float32,
+  # the precision of the vtkPoints the rest of DeCA has always worked on.
+
+  def __init__(self, names, points, counts):
+    self.names = list(names)
+    self.points = points
+    self.counts = np.asarray(counts, dtype=np.int64)
+    self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+
+  def __len__(self):
+    return len(self.names)
+
+  def isUniform(self):
+    return len(self.counts) > 0 and bool(np.all(self.counts == self.counts[0]))
+
+  def subject(self, i):
+    return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+  @property
+  def tensor(self):
+    # (subjects, points, 3) view; every subject must have the same point count.
+    if not self.isUniform():
+      raise ValueError("Landmark files have different numbers of points: " +
+        ", ".join(f"{name} ({count})" for name, count in zip(self.names, self.counts.tolist())))
+    return self.points.reshape(len(self.counts), int(self.counts[0]), 3)
+
+  def toMultiBlock(self):
+    # One vtkPolyData block per subject, in the layout importLandmarks has always
+    # returned. The blocks' points are views of self.points, not copies.
+    multiBlock = vtk.vtkMultiBlockDataSet()
+    multiBlock.SetNumberOfBlocks(len(self.names))
+    for i in range(len(self.names)):
+      points = vtk.vtkPoints()
+      points.SetData(vtk_np.numpy_to_vtk(self.subject(i), deep=False))
+      polyData = vtk.vtkPolyData()
+      polyData.SetPoints(points)
+      multiBlock.SetBlock(i, polyData)
+    return multiBlock
+
+
+def readLandmarkDirectory(directory, progressCallback=None):
+  # Read every landmark file in directory (sorted by name) into a LandmarkSet.
+  fileNames = [f for f in sorted(os.listdir(directory)) if isLandmarkFile(f)]
+  return readLandmarkFiles([os.path.join(directory, f) for f in fileNames], fileNames, progressCallback)
+
+
+def readLandmarkFiles(paths, names=None, progressCallback=None):
+  # Read the given landmark files, in order, into a LandmarkSet named by names
+  # (default: the file names); progressCallback(done, total, message) is called
+  # after each file. Parsing holds the GIL, so the files are read one at a time.
+  counts = []
+  subjectPoints = []
+  for fileCount, path in enumerate(paths, start=1):
+    try:
+      pointsXYZ = readMarkupsPoints(path)
+    except (OSError, ValueError, KeyError, IndexError) as e:
+      raise ValueError(f"Could not load landmarks: {path} ({e})") from e
+    subjectPoints.append(pointsXYZ)
+    counts.append(len(pointsXYZ))
+    if progressCallback:
+      progressCallback(fileCount, len(paths), "Loading landmarks")
+  points = np.concatenate(subjectPoints).astype(np.float32) if subjectPoints else np.empty((0, 3), dtype=np.float32)
+  if names is None:
+    names = [os.path.basename(path) for path in paths]
+  return LandmarkSet(names, points, counts)
@@ -0,0 +1,259 @@
+import csv
+import json
+import os
+
+import numpy as np
+
+from DeCALib import procrustes
+
+# GPA iterations for the comparison; far above what the shapes need to converge,
+# unlike the five of vtkProcrustesAlignmentFilter that the atlas build mirrors.
+MAX_GPA_ITERATIONS = 100
+
+PC_COUNT = 20
+
+
+def procrustesDistances(shapes):
+  # Full GPA with scaling (no sliding) of an (S, P, 3) tensor. Returns the
+  # aligned shapes, at unit centroid size, and each subject's partial Procrustes
+  # distance to the mean.
+  result = procrustes.generalizedProcrustes(shapes, True, MAX_GPA_ITERATIONS)
+  residuals = result.aligned - result.meanShape
+  return result.aligned, np.sqrt(np.einsum("spi,spi->s", residuals, residuals))
+
+
+def principalComponents(aligned, count=PC_COUNT):
+  # PCA of aligned (S, P, 3) shapes: (S, count) scores and the percentage of the
+  # total variance on each component.
+  flat = aligned.reshape(len(aligned), -1)
+  flat = flat - flat.mean(axis=0)
+  u, singularValues, _ = np.linalg.svd(flat, full_matrices=False)
+  count = min(count, len(aligned) - 1)
+  variance = singularValues ** 2
+  return u[:, :count] * singularValues[:count], 100 * variance[:count] / variance.sum()
+
+
+def correlation(a, b):
+  return float(np.corrcoef(a, b)[0, 1])
+
+
+def columnCorrelations(a, b):
+  # (k, k) Pearson correlations between the columns of a and those of b
+  za = (a - a.mean(axis=0)) / a.std(axis=0)
+  zb = (b - b.mean(axis=0)) / b.std(axis=0)
+  return za.T @ zb / len(a)
+
+
+def stratifiedBySize(sizes, count):
+  # Indices of count subjects spanning the range of sizes: the sorted subjects
+  # are split into count equal strata and the middle subject of each is taken.
+  order = np.argsort(sizes, kind="stable")
+  return sorted(int(stratum[len(stratum) // 2]) for stratum in np.array_split(order, min(count, len(order))) if len(stratum))
+
+
+def pairedProcrustesDistances(shapesA, shapesB):
+  # Partial Procrustes distance between the two versions A[i], B[i] of every
+  # subject: both scaled to unit centroid size, B rotated onto A.
+  def normalized(shapes):
+    centered = shapes - shapes.mean(axis=1, keepdims=True)
+    return centered / np.sqrt(np.einsum("spi,spi->s", centered, centered))[:, None, None]
+  shapesA = normalized(np.asarray(shapesA, dtype=np.float64))
+  shapesB = normalized(np.asarray(shapesB, dtype=np.float64))
+  rotations = np.empty((len(shapesA), 3, 3))
+  for i in range(len(shapesA)):
+    rotations[i] = procrustes.landmarkTransforms(shapesB[i][None], shapesA[i], scaling=False)[0][0]
+  differences = np.matmul(shapesB, np.transpose(rotations, (0, 2, 1))) - shapesA
+  return np.sqrt(np.einsum("spi,spi->s", differences, differences))
+
+
+def correctedDispersion(shapes, measurementVariance):
+  # Procrustes distances and variance of an (S, P, 3) sample before and after
+  # removing an isotropic measurement-error variance (sigma^2, the mean squared
+  # Procrustes distance between exact and fast versions of the same subjects):
+  # PD_corrected^2 = max(PD^2 - sigma^2, 0), and the Procrustes variance (mean
+  # squared distance to the mean) less sigma^2. Squared pairwise distances are
+  # inflated by 2 sigma^2.
+  _, distances = procrustesDistances(shapes)
+  variance = float(np.mean(distances ** 2))
+  return {"distances": distances, "correctedDistances": np.sqrt(np.maximum(distances ** 2 - measurementVariance, 0)),
+          "procrustesVariance": variance, "correctedProcrustesVariance": max(variance - measurementVariance, 0.0)}
+
+
+def writeCalibration(directory, names, calibrationIndices, calibrationSizes, pairedDistances, dispersion):
+  # Write the measurement-error calibration of a fast run: fastCalibration.json
+  # with sigma^2 (the mean squared exact-vs-fast Procrustes distance of the
+  # calibration subjects) and the Procrustes variance of the sample before and
+  # after correction, and fastCalibration_perSpecimen.csv with every subject's
+  # distance to the mean before and after. Returns the summary dict.
+  os.makedirs(directory, exist_ok=True)
+  measurementVariance = float(np.mean(np.asarray(pairedDistances) ** 2))
+  variance = dispersion["procrustesVariance"]
+  summary = {
+    "sigma2": measurementVariance,
+    "pairwiseSquaredDistanceCorrection": 2 * measurementVariance,
+    "procrustesVariance": variance,
+    "correctedProcrustesVariance": dispersion["correctedProcrustesVariance"],
+    "inflationPercent": 100 * (variance - dispersion["correctedProcrustesVariance"]) / dispersion["correctedProcrustesVariance"]
+                        if dispersion["correctedProcrustesVariance"] > 0 else None,
+    "subjects": len(names),
+    "calibrationSubjects": [{"specimen": names[i], "centroidSize": float(size), "procrustesDistanceExactVsFast": float(distance)}
+                            for i, size, distance in zip(calibrationIndices, calibrationSizes, pairedDistances)],
+    }
+  with open(os.path.join(directory, "fastCalibration.json"), "w", encoding="utf-8") as summaryFile:
+    json.dump(summary, summaryFile, indent=2)
+  calibrationSet = set(calibrationIndices)
+  with open(os.path.join(directory, "fastCalibration_perSpecimen.csv"), "w", newline="", encoding="utf-8") as csvFile:
+    writer = csv.writer(csvFile)
+    writer.writerow(["specimen", "PD_fast", "PD_corrected", "calibration"])
+    for i, (name, distance, corrected) in enumerate(zip(names, dispersion["distances"], dispersion["correctedDistances"])):
+      writer.writerow([name, distance, corrected, int(i in calibrationSet)])
+  return summary
+
+
+class MethodComparison:
+  # Agreement between the exact (A) and fast (B) correspondence of the same
+  # subjects, as in docs/KD-fast-correspondence-eval.md:
+  #   perSpecimen     PD (separate GPAs) and centroid size of every subject
+  #   pcCorrelations  PC score correlation of A and B (sign-corrected) with the
+  #                   variance explained and the best matching B component
+  #   jointDeltas     PD of A and B in one joint GPA, their difference and the
+  #                   Procrustes distance between the two versions of a subject
+  # The shapes are (S, P, 3) in the subjects' original frames.
+
+  def __init__(self, names, exactShapes, fastShapes, exactSeconds=None, fastSeconds=None):
+    exactShapes = np.asarray(exactShapes, dtype=np.float64)
+    fastShapes = np.asarray(fastShapes, dtype=np.float64)
+    if exactShapes.shape != fastShapes.shape or len(exactShapes) < 3:
+      raise ValueError("The comparison needs the same points for at least three subjects from both methods")
+    self.names = list(names)
+    self.exactSeconds = exactSeconds
+    self.fastSeconds = fastSeconds
+    subjectCount = len(exactShapes)
+
+    alignedA, self.distancesA = procrustesDistances(exactShapes)
+    alignedB, self.distancesB = procrustesDistances(fastShapes)
+    self.sizesA = procrustes.centroidSizes(exactShapes)
+    self.sizesB = procrustes.centroidSizes(fastShapes)
+
+    scoresA, self.varianceA = principalComponents(alignedA)
+    scoresB, self.varianceB = principalComponents(alignedB)
+    self.pcCorrelationMatrix = columnCorrelations(scoresA, scoresB)
+
+    jointAligned, jointDistances = procrustesDistances(np.concatenate((exactShapes, fastShapes)))
+    self.jointDistancesA = jointDistances[:subjectCount]
+    self.jointDistancesB = jointDistances[subjectCount:]
+    differences = jointAligned[subjectCount:] - jointAligned[:subjectCount]
+    self.pairwiseDistances = np.sqrt(np.einsum("spi,spi->s", differences, differences))
+
+  def perSpecimenRows(self):
+    return [{"specimen": name, "PD_A": pdA, "PD_B": pdB, "CS_A": csA, "CS_B": csB} for name, pdA, pdB, csA, csB
+            in zip(self.names, self.distancesA, self.distancesB, self.sizesA, self.sizesB)]
+
+  def pcCorrelationRows(self):
+    rows = []
+    for pc in range(len(self.pcCorrelationMatrix)):
+      bestMatch = int(np.argmax(np.abs(self.pcCorrelationMatrix[pc])))
+      rows.append({"PC": pc + 1, "abs_r_diag": abs(self.pcCorrelationMatrix[pc, pc]), "signed_r": self.pcCorrelationMatrix[pc, pc],
+                   "varpct_A": self.varianceA[pc], "varpct_B": self.varianceB[pc], "best_match_B_PC": bestMatch + 1,
+                   "best_abs_r": abs(self.pcCorrelationMatrix[pc, bestMatch])})
+    return rows
+
+  def jointDeltaRows(self):
+    return [{"specimen": name, "PD_A_joint": pdA, "PD_B_joint": pdB, "delta_PDB_minus_PDA": pdB - pdA, "pairwise_ProcD_A_vs_B": pairwise}
+            for name, pdA, pdB, pairwise in zip(self.names, self.jointDistancesA, self.jointDistancesB, self.pairwiseDistances)]
+
+  def summary(self):
+    # the headline numbers of the evaluation, as a dict
+    deltas = self.jointDistancesB - self.jointDistancesA
+    diagonal = np.abs(np.diag(self.pcCorrelationMatrix))
+    summary = {
+      "subjects": len(self.names),
+      "r_PD": correlation(self.distancesA, self.distancesB),
+      "r_CS": correlation(self.sizesA, self.sizesB),
+      "min_abs_r_PC": float(diagonal.min()),
+      "pc_axis_swaps": int(sum(np.argmax(np.abs(row)) != pc for pc, row in enumerate(self.pcCorrelationMatrix))),
+      "mean_delta_PD": float(deltas.mean()),
+      "delta_PD_percent": float(100 * deltas.mean() / self.jointDistancesA.mean()),
+      "mean_pairwise_ProcD": float(self.pairwiseDistances.mean()),
+      }
+    if self.exactSeconds and self.fastSeconds:
+      summary.update({"exact_seconds": self.exactSeconds, "fast_seconds": self.fastSeconds,
+                      "speedup": self.exactSeconds / self.fastSeconds})
+    return summary
+
+  def describe(self):
+    summary = self.summary()
+    text = (f"{summary['subjects']} subjects: r(PD) = {summary['r_PD']:.5f}, r(CS) = {summary['r_CS']:.6f}, "
+            f"PC1-{len(self.pcCorrelationMatrix)} |r| >= {summary['min_abs_r_PC']:.3f} with {summary['pc_axis_swaps']} axis swaps, "
+            f"PD {summary['delta_PD_percent']:+.1f}% with the fast method")
+    if "speedup" in summary:
+      text += f"; correspondence {summary['exact_seconds']:.1f} s exact, {summary['fast_seconds']:.1f} s fast ({summary['speedup']:.1f}x)"
+    return text
+
+  def writeTables(self, directory):
+    # The CSVs of docs/data plus runtime.csv and summary.csv; returns their paths.
+    tables = {"analysis1_per_specimen.csv": self.perSpecimenRows(), "analysis1_pc_correlations.csv": self.pcCorrelationRows(),
+              "analysis2_joint_deltas.csv": self.jointDeltaRows(), "summary.csv": [{"metric": key, "value": value} for key, value in self.summary().items()]}
+    if self.exactSeconds and self.fastSeconds:
+      subjectCount = len(self.names)
+      tables["runtime.csv"] = [{"method": method, "seconds": seconds, "seconds_per_subject": seconds / subjectCount}
+                               for method, seconds in (("exact", self.exactSeconds), ("fast", self.fastSeconds))]
+    paths = []
+    for fileName, rows in tables.items():
+      path = os.path.join(directory, fileName)
+      with open(path, "w", newline="", encoding="utf-8") as csvFile:
+        writer = csv.DictWriter(csvFile, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+      paths.append(path)
+    return paths
+
+  def writeFigures(self, directory):
+    # The figures of the evaluation document (raises ImportError without
+    # matplotlib); returns their paths.
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    paths = []
+
+    def save(figure, fileName):
+      path = os.path.join(directory, fileName)
+      figure.tight_layout()
+      figure.savefig(path, dpi=150)
+      plt.close(figure)
+      paths.append(path)
+
+    figure, axes = plt.subplots(1, 2, figsize=(10, 4.5))
+    for axis, a, b, label in ((axes[0], self.distancesA, self.distancesB, "Procrustes distance to mean"),
+                              (axes[1], self.sizesA, self.sizesB, "Centroid size")):
+      axis.scatter(a, b, s=10)
+      limits = [min(a.min(), b.min()), max(a.max(), b.max())]
+      axis.plot(limits, limits, color="gray", linewidth=1)
+      axis.set_xlabel(f"{label}, exact")
+      axis.set_ylabel(f"{label}, fast")
+      axis.set_title(f"r = {correlation(a, b):.5f}")
+    save(figure, "fig1_pd_cs_scatter.png")
+
+    figure, axis = plt.subplots(figsize=(8, 4))
+    components = np.arange(1, len(self.pcCorrelationMatrix) + 1)
+    axis.bar(components, np.abs(np.diag(self.pcCorrelationMatrix)))
+    axis.set_ylim(min(0.9, np.abs(np.diag(self.pcCorrelationMatrix)).min() - 0.01), 1.0)
+    axis.set_xticks(components)
+    axis.set_xlabel("PC")
+    axis.set_ylabel("|r| exact vs fast scores")
+    save(figure, "fig2_pc_correlations.png")
+
+    figure, axes = plt.subplots(1, 2, figsize=(10, 4))
+    axes[0].hist(self.jointDistancesB - self.jointDistancesA, bins=30)
+    axes[0].set_xlabel("PD(fast) - PD(exact), joint GPA")
+    axes[1].hist(self.pairwiseDistances, bins=30)
+    axes[1].set_xlabel("Procrustes distance, exact vs fast")
+    save(figure, "fig3_delta_hist.png")
+
+    if self.exactSeconds and self.fastSeconds:
+      figure, axis = plt.subplots(figsize=(5, 4))
+      axis.bar(["exact", "fast"], [self.exactSeconds, self.fastSeconds])
+      axis.set_ylabel("Dense correspondence (s)")
+      axis.set_title(f"{self.exactSeconds / self.fastSeconds:.1f}x faster")
+      save(figure, "fig4_runtime.png")
+    return paths
@@ -0,0 +1,131 @@
+import contextlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def resolveWorkerCount(workers):
+  # None or a value <= 0 means "use every core"; an explicit count is capped at
+  # the number of cores so a stale setting cannot oversubscribe a smaller machine.
+  cpuCount = os.cpu_count() or 1
+  if not workers or workers <= 0:
+    return cpuCount
+  return max(1, min(int(workers), cpuCount))
+
+
+def threadsPerWorker(workers):
+  # Split the cores evenly between worker processes so that N workers, each with
+  # its own BLAS / VTK SMP / k-d tree thread pool, do not oversubscribe the CPU.
+  return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+# Environment variables read by the common BLAS / OpenMP runtimes and by VTK's
+# SMP backend when a worker process starts.
+_THREAD_LIMIT_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                           "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS", "VTK_SMP_MAX_THREADS")
+
+
+@contextlib.contextmanager
+def workerThreadLimit(threads):
+  # Spawned workers inherit the parent environment when they start, and the
+  # thread pools above are sized once at import time, so the limit has to be in
+  # the environment while the pool starts its processes. The parent's own
+  # libraries are already loaded and are not affected.
+  saved = {name: os.environ.get(name) for name in _THREAD_LIMIT_VARIABLES}
+  os.environ.update({name: str(threads) for name in _THREAD_LIMIT_VARIABLES})
+  try:
+    yield
+  finally:
+    for name, value in saved.items():
+      if value is None:
+        os.environ.pop(name, None)
+      else:
+        os.environ[name] = value
+
+
+def createProcessPool(workers, pythonExecutable=None, initializer=None, initargs=()):
+  # Workers are always spawned (never forked): a forked copy of a running Slicer
+  # process inherits its Qt/OpenGL state and is not safe to use. Inside Slicer
+  # sys.executable is the application itself, so callers pass the PythonSlicer
+  # interpreter to use for the workers instead.
+  context = multiprocessing.get_context("spawn")
+  if pythonExecutable:
+    context.set_executable(pythonExecutable)
+  return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initializer, initargs=initargs)
+
+
+def mapUnordered(function, argumentList, workers=1, pythonExecutable=None):
+  # Call function(*arguments) for every entry of argumentList and yield
+  # (index, result, error) as the calls finish: in this process when workers is
+  # 1, otherwise on a pool of up to workers processes (0: all cores). function
+  # must be importable by the workers (a module-level function of DeCALib). A
+  # call that raises yields its exception as error and the others carry on.
+  argumentList = list(argumentList)
+  workers = min(resolveWorkerCount(workers), max(1, len(argumentList)))
+  if workers == 1:
+    for index, arguments in enumerate(argumentList):
+      try:
+        yield index, function(*arguments), None
+      except Exception as error:
+        yield index, None, error
+    return
+  # the limit stays set while the pool is open, since it starts its processes
+  # as tasks are submitted
+  with workerThreadLimit(threadsPerWorker(workers)), createProcessPool(workers, pythonExecutable) as pool:
+    futures = {pool.submit(function, *arguments): index for index, arguments in enumerate(argumentList)}
+    for future in as_completed(futures):
+      error = future.exception()
+      yield futures[future], None if error else future.result(), error
+
+
+class SharedArrays:
+  # Packs a dict of numpy arrays into a single shared memory block so that large
+  # inputs are copied once and then read by every worker, instead of being
+  # pickled into each task. Pass `descriptor` to the workers and open it there
+  # with attachSharedArrays. The creating process owns the block and must call
+  # close() (or use it as a context manager) to release it.
+  def __init__(self, arrays):
+    layout = []
+    offset = 0
+    for key, array in arrays.items():
+      array = np.ascontiguousarray(array)
+      layout.append((key, offset, array.shape, array.dtype.str))
+      # keep every array 8-byte aligned within the block
+      offset += -(-array.nbytes // 8) * 8
+    self._shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (key, start, shape, dtype) in layout:
+      view = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=start)
+      view[...] = arrays[key]
+    self.descriptor = (self._shm.name, tuple(layout))
+
+  def close(self):
+    if self._shm is not None:
+      self._shm.close()
+      self._shm.unlink()
+      self._shm = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def attachSharedArrays(descriptor):
+  # Open a SharedArrays block from another process. Returns the SharedMemory
+  # handle (keep it referenced for as long as the views are used, then close it)
+  # and a dict of read-only numpy views into the block.
+  name, layout = descriptor
+  try:
+    shm = shared_memory.SharedMemory(name=name, track=False)
+  except TypeError:  # Python < 3.13 has no track argument
+    shm = shared_memory.SharedMemory(name=name)
+  arrays = {}
+  for (key, start, shape, dtype) in layout:
+    view = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+    view.flags.writeable = False
+    arrays[key] = view
+  return shm, arrays
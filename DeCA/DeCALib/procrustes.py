@@ -0,0 +1,97 @@
+import numpy as np
+
+# vtkProcrustesAlignmentFilter stops after this many iterations, or once the
+# mean moves by less than CONVERGENCE_TOLERANCE (sum of squared point moves).
+MAX_ITERATIONS = 5
+CONVERGENCE_TOLERANCE = 1e-6
+
+
+class ProcrustesResult:
+  # Output of generalizedProcrustes:
+  #   meanShape      (P, 3) mean shape (unit centroid size with scaling)
+  #   aligned        (S, P, 3) every subject aligned to the mean
+  #   centroidSizes  (S,) centroid size of every input subject
+  #   distances      (S,) per-subject Procrustes distance to the mean: the sum of
+  #                  point-to-point distances, as getClosestToMeanIndex has always
+  #                  measured it
+
+  def __init__(self, meanShape, aligned, centroidSizes, distances):
+    self.meanShape = meanShape
+    self.aligned = aligned
+    self.centroidSizes = centroidSizes
+    self.distances = distances
+
+  def closestToMeanIndex(self):
+    return int(np.argmin(self.distances))
+
+
+def centroidSizes(shapes):
+  # (S, P, 3) -> (S,) square root of the summed squared distances to the centroid
+  shapes = np.asarray(shapes, dtype=np.float64)
+  centered = shapes - shapes.mean(axis=-2, keepdims=True)
+  return np.sqrt(np.einsum("...pi,...pi->...", centered, centered))
+
+
+def landmarkTransforms(sourceShapes, targetShape, scaling=True):
+  # Least-squares rotation (+ uniform scale) and translation taking each of the
+  # (S, P, 3) source shapes onto one (P, 3) target, computed for all subjects at
+  # once. Matches vtkLandmarkTransform: proper rotations only, and in similarity
+  # mode the scale is the ratio of the RMS spreads of target and source. Returns
+  # (S, 3, 3) matrices A and (S, 3) translations t with y = A x + t.
+  sourceShapes = np.asarray(sourceShapes, dtype=np.float64)
+  targetShape = np.asarray(targetShape, dtype=np.float64)
+  sourceCentroids = sourceShapes.mean(axis=1)
+  targetCentroid = targetShape.mean(axis=0)
+  source = sourceShapes - sourceCentroids[:, None, :]
+  target = targetShape - targetCentroid
+  # rotation maximizing trace(R M) over proper rotations (Kabsch with the
+  # reflection correction, equivalent to VTK's quaternion solution)
+  covariance = np.matmul(np.transpose(source, (0, 2, 1)), target)
+  u, _, vt = np.linalg.svd(covariance)
+  signs = np.ones((len(source), 3))
+  signs[:, 2] = np.sign(np.linalg.det(np.matmul(u, vt)))
+  signs[signs == 0] = 1
+  rotations = np.matmul(np.transpose(vt, (0, 2, 1)) * signs[:, None, :], np.transpose(u, (0, 2, 1)))
+  if scaling:
+    sourceSpread = np.einsum("spi,spi->s", source, source)
+    targetSpread = np.einsum("pi,pi->", target, target)
+    scales = np.sqrt(targetSpread / np.where(sourceSpread > 0, sourceSpread, 1.0))
+    rotations = rotations * scales[:, None, None]
+  translations = targetCentroid - np.einsum("sij,sj->si", rotations, sourceCentroids)
+  return rotations, translations
+
+
+def applyTransforms(rotations, translations, shapes):
+  return np.matmul(shapes, np.transpose(rotations, (0, 2, 1))) + translations[:, None, :]
+
+
+def _normalized(shape):
+  centered = shape - shape.mean(axis=0)
+  return centered / np.sqrt(np.einsum("pi,pi->", centered, centered))
+
+
+def generalizedProcrustes(shapes, scaling=True, maxIterations=MAX_ITERATIONS, tolerance=CONVERGENCE_TOLERANCE):
+  # Generalized Procrustes analysis of an (S, P, 3) landmark tensor, following
+  # vtkProcrustesAlignmentFilter: the first shape is the initial mean, every
+  # iteration aligns all subjects to the mean, averages them and aligns the new
+  # mean back onto the first one (which fixes orientation). With scaling
+  # (similarity mode) the mean is kept at unit centroid size; scaling=False is
+  # the filter's rigid-body mode.
+  shapes = np.asarray(shapes, dtype=np.float64)
+  if shapes.ndim != 3 or shapes.shape[0] == 0 or shapes.shape[2] != 3:
+    raise ValueError("No landmark data available for Procrustes analysis")
+  firstMean = _normalized(shapes[0]) if scaling else shapes[0].copy()
+  meanShape = firstMean
+  for _ in range(maxIterations):
+    aligned = applyTransforms(*landmarkTransforms(shapes, meanShape, scaling), shapes)
+    newMean = aligned.mean(axis=0)
+    newMean = applyTransforms(*landmarkTransforms(newMean[None], firstMean, scaling), newMean[None])[0]
+    if scaling:
+      newMean = _normalized(newMean)
+    difference = np.einsum("pi,pi->", newMean - meanShape, newMean - meanShape)
+    meanShape = newMean
+    if difference < tolerance:
+      break
+  residuals = aligned - meanShape
+  distances = np.sqrt(np.einsum("spi,spi->sp", residuals, residuals)).sum(axis=1)
+  return ProcrustesResult(meanShape, aligned, centroidSizes(shapes), distances)
@@ -0,0 +1,165 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# The trace being recorded by this process, or None when not profiling; stage()
+# then costs one global lookup.
+_activeTrace = None
+
+
+class StageTrace:
+  # Timings of the per-subject stages of a run (mesh load, forward TPS, locator
+  # build, query, inverse TPS, write, ...), recorded by stage() while the trace
+  # is active (see tracing). Each event is a dict with the subject, stage,
+  # start (seconds since the epoch, so events of several processes line up),
+  # seconds and pid. Worker processes record into their own trace and send the
+  # events back with their results; subjects may then be recorded by index and
+  # are written under subjectLabels[index].
+
+  def __init__(self, subjectLabels=None):
+    self.events = []
+    self.subject = None
+    self.subjectLabels = subjectLabels
+    self._lock = threading.Lock()
+
+  def add(self, stage, start, seconds, subject=None):
+    event = {"subject": self.subject if subject is None else subject, "stage": stage, "start": start,
+             "seconds": seconds, "pid": os.getpid()}
+    with self._lock:
+      self.events.append(event)
+
+  def extend(self, events):
+    with self._lock:
+      self.events.extend(events)
+
+  def takeEvents(self):
+    with self._lock:
+      events, self.events = self.events, []
+    return events
+
+  def _label(self, subject):
+    if self.subjectLabels is not None and isinstance(subject, int) and 0 <= subject < len(self.subjectLabels):
+      return self.subjectLabels[subject]
+    return subject
+
+  def stageTotals(self):
+    # {stage: (count, total seconds)} in order of first appearance
+    totals = {}
+    for event in self.events:
+      count, seconds = totals.get(event["stage"], (0, 0.0))
+      totals[event["stage"]] = (count + 1, seconds + event["seconds"])
+    return totals
+
+  def summary(self):
+    return "stage times: " + ", ".join(f"{stage} {seconds:.1f} s ({count}x)" for stage, (count, seconds) in self.stageTotals().items())
+
+  def write(self, path):
+    # .jsonl: one event per line. Anything else: Chrome trace event format, which
+    # chrome://tracing and Perfetto show as one lane per process.
+    with open(path, "w", encoding="utf-8") as traceFile:
+      if path.endswith(".jsonl"):
+        for event in self.events:
+          traceFile.write(json.dumps(dict(event, subject=self._label(event["subject"]))) + "\n")
+        return
+      json.dump({"traceEvents": [
+        {"name": event["stage"], "cat": "DeCA", "ph": "X", "ts": round(event["start"] * 1e6), "dur": round(event["seconds"] * 1e6),
+         "pid": event["pid"], "tid": event["pid"], "args": {"subject": self._label(event["subject"])}}
+        for event in self.events], "displayTimeUnit": "ms"}, traceFile)
+
+
+def setActiveTrace(trace):
+  # Record stage() timings into trace from now on (None: stop profiling).
+  # Returns the previously active trace, to restore afterwards.
+  global _activeTrace
+  previous, _activeTrace = _activeTrace, trace
+  return previous
+
+
+def activeTrace():
+  return _activeTrace
+
+
+@contextlib.contextmanager
+def tracing(trace):
+  previous = setActiveTrace(trace)
+  try:
+    yield trace
+  finally:
+    setActiveTrace(previous)
+
+
+@contextlib.contextmanager
+def subject(name):
+  # Attribute the stages recorded inside to subject name.
+  trace = _activeTrace
+  if trace is None:
+    yield
+    return
+  previous, trace.subject = trace.subject, name
+  try:
+    yield
+  finally:
+    trace.subject = previous
+
+
+@contextlib.contextmanager
+def stage(name):
+  trace = _activeTrace
+  if trace is None:
+    yield
+    return
+  start = time.time()
+  startCounter = time.perf_counter()
+  try:
+    yield
+  finally:
+    trace.add(name, start, time.perf_counter() - startCounter)
+
+
+def _durationText(seconds):
+  if seconds < 60:
+    return f"{seconds:.0f} s"
+  if seconds < 3600:
+    return f"{seconds // 60:.0f} min {seconds % 60:.0f} s"
+  return f"{seconds // 3600:.0f} h {seconds % 3600 // 60:.0f} min"
+
+
+class ProgressRate:
+  # Throughput and ETA of a progress sequence (current, total, message), and
+  # throttling for its display: update() is True at most once per minInterval
+  # seconds, and always for the first and last item of a stage, so refreshing a
+  # progress bar or log costs nothing noticeable on large runs. A new message
+  # (or a count going backwards) starts a new stage.
+
+  def __init__(self, minInterval=0.25):
+    self.minInterval = minInterval
+    self.message = None
+    self.lastCount = 0
+    self.lastRefresh = 0.0
+
+  def update(self, current, total, message):
+    now = time.monotonic()
+    if message != self.message or current < self.lastCount:
+      self.message = message
+      self.stageStart = now
+      self.stageStartCount = current
+      self.lastRefresh = 0.0
+    self.lastCount = current
+    if current < total and self.lastRefresh and now - self.lastRefresh < self.minInterval:
+      return False
+    self.lastRefresh = now
+    return True
+
+  def describe(self, current, total):
+    # e.g. "12.5/min, ETA 3 min 20 s"; empty until a rate can be measured
+    elapsed = time.monotonic() - self.stageStart
+    done = current - self.stageStartCount
+    if done <= 0 or elapsed <= 0:
+      return ""
+    perSecond = done / elapsed
+    rate = f"{perSecond * 60:.1f}/min" if perSecond < 10 else f"{perSecond:.1f}/s"
+    if current >= total:
+      return f"{rate}, {_durationText(elapsed)}"
+    return f"{rate}, ETA {_durationText((total - current) / perSecond)}"
@@ -0,0 +1,58 @@
+import json
+import os
+import uuid
+
+import numpy as np
+
+# Bump when the stored arrays change; older frames are then refused.
+FRAME_VERSION = 1
+
+
+class ReferenceFrame:
+  # Everything a DeCAL run fixes before the per-subject loop, so that new
+  # specimens can later be put into correspondence in exactly the same frame
+  # without recomputing Procrustes over the whole sample:
+  #   meanShape          (L, 3) Procrustes mean of the run's landmarks
+  #   atlasLandmarks     (L, 3) alignment atlas landmarks
+  #   meanWarpedBase     (N, 3) atlas output points warped onto meanShape
+  #   atlasPoints        (N, 3) atlas output points (written as atlas.mrk.json)
+  #   outputIndex        (N,) atlas vertex of each output point
+  #   outputLabels       (N,) template position of each output point
+  #   settings           correspondence options of the run (method, splines,
+  #                      point spacing), which appended subjects must share
+  #   runKey             result cache key of the run (see resultCache)
+
+  def __init__(self, meanShape, atlasLandmarks, meanWarpedBase, atlasPoints, outputIndex, outputLabels, settings, runKey):
+    self.meanShape = np.asarray(meanShape)
+    self.atlasLandmarks = np.asarray(atlasLandmarks)
+    self.meanWarpedBase = np.asarray(meanWarpedBase)
+    self.atlasPoints = np.asarray(atlasPoints)
+    self.outputIndex = np.asarray(outputIndex, dtype=np.int64)
+    self.outputLabels = np.asarray(outputLabels, dtype=np.int64)
+    self.settings = dict(settings)
+    self.runKey = runKey
+
+
+def writeReferenceFrame(path, frame):
+  # .npz written to a temporary name and renamed into place, so a frame on disk
+  # is always complete.
+  temporaryPath = f"{path}.{uuid.uuid4().hex}.npz"
+  try:
+    np.savez(temporaryPath, version=FRAME_VERSION, meanShape=frame.meanShape, atlasLandmarks=frame.atlasLandmarks,
+      meanWarpedBase=frame.meanWarpedBase, atlasPoints=frame.atlasPoints, outputIndex=frame.outputIndex,
+      outputLabels=frame.outputLabels, settings=json.dumps(frame.settings), runKey=frame.runKey)
+    os.replace(temporaryPath, path)
+  finally:
+    if os.path.exists(temporaryPath):
+      os.remove(temporaryPath)
+
+
+def readReferenceFrame(path):
+  try:
+    with np.load(path) as arrays:
+      if int(arrays["version"]) != FRAME_VERSION:
+        raise ValueError(f"Reference frame {path} was written by an incompatible DeCA version")
+      return ReferenceFrame(arrays["meanShape"], arrays["atlasLandmarks"], arrays["meanWarpedBase"], arrays["atlasPoints"],
+        arrays["outputIndex"], arrays["outputLabels"], json.loads(str(arrays["settings"])), str(arrays["runKey"]))
+  except (OSError, KeyError) as error:
+    raise ValueError(f"Could not read the DeCAL reference frame {path}: {error}")
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+
+from DeCALib.warpCache import evictLeastRecentlyUsed, hashArray, hashFile, hashPolyData
+
+# Bump when the correspondence computation changes in a way that alters results,
+# so entries computed by older versions are no longer reused.
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 16 * 1024 ** 3
+
+
+def runKey(atlasMesh, atlasLandmarkXYZ, meanShapeXYZ, outputIndex, settings):
+  # settings: JSON-serializable dict of the options that change results
+  # (correspondence method, spline implementation, point spacing)
+  digest = hashlib.sha256(f"DeCA correspondence v{CACHE_VERSION}".encode())
+  digest.update(json.dumps(settings, sort_keys=True).encode())
+  hashPolyData(digest, atlasMesh)
+  hashArray(digest, atlasLandmarkXYZ)
+  hashArray(digest, meanShapeXYZ)
+  hashArray(digest, np.asarray(outputIndex, dtype=np.int64))
+  return digest.hexdigest()
+
+
+def subjectKey(runKey, meshPath, landmarkXYZ, meshMatrix=None):
+  # meshMatrix: the alignment applied to the mesh file when it is read (see
+  # alignment.meshSources); keys of meshes used as written are unchanged.
+  digest = hashlib.sha256(runKey.encode())
+  hashFile(digest, meshPath)
+  hashArray(digest, landmarkXYZ)
+  if meshMatrix is not None:
+    hashArray(digest, np.asarray(meshMatrix, dtype=np.float64))
+  return digest.hexdigest()
+
+
+class CorrespondenceResultCache:
+  # On-disk, content-addressed store of per-subject DeCAL results, shared by
+  # every output folder. A result is keyed by a hash of everything it depends on:
+  # the run key (atlas mesh and landmarks, mean shape, output point index and
+  # method settings, see runKey) combined with the subject's mesh file bytes and
+  # landmarks (subjectKey). A changed input therefore only misses for the
+  # subjects it affects; note that the mean shape depends on every subject's
+  # landmarks, so editing one landmark file changes all keys.
+  #
+  # Each entry is one (N, 3) .npy file, written to a temporary name and
+  # renamed into place, so a crash never leaves a truncated entry and several
+  # processes can share the store. The directory is created by the first
+  # store(). evict() removes the least recently used entries once the store
+  # exceeds maxBytes, clear() all of them.
+
+  def __init__(self, directory, maxBytes=DEFAULT_MAX_BYTES):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.hits = 0
+    self.misses = 0
+
+  def _entryPath(self, key):
+    return os.path.join(self.directory, key + ".npy")
+
+  def load(self, key, pointCount):
+    # The cached (pointCount, 3) result, or None on a miss.
+    entryPath = self._entryPath(key)
+    try:
+      pointsXYZ = np.load(entryPath)
+      os.utime(entryPath)  # mark as recently used
+    except (OSError, ValueError):
+      pointsXYZ = None
+    if pointsXYZ is None or pointsXYZ.shape != (pointCount, 3):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return pointsXYZ
+
+  def store(self, key, pointsXYZ):
+    temporaryPath = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex}.npy")
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      np.save(temporaryPath, np.asarray(pointsXYZ))
+      os.replace(temporaryPath, self._entryPath(key))
+    except OSError:
+      # the store is an optimization; never fail the run over it
+      try:
+        os.remove(temporaryPath)
+      except OSError:
+        pass
+
+  def evict(self):
+    if os.path.isdir(self.directory):
+      evictLeastRecentlyUsed(self.directory, self.maxBytes)
+
+  def clear(self):
+    if os.path.isdir(self.directory):
+      evictLeastRecentlyUsed(self.directory, 0)
+
+  def summary(self):
+    return f"correspondence result cache: {self.hits} reused, {self.misses} computed"
@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+
+from DeCALib import markupsIO, profiling
+from DeCALib.journal import OutputJournal, inputFingerprint
+from DeCALib.resultCache import subjectKey
+
+
+class SubjectTracker:
+  # Per-subject bookkeeping of a DeCAL run writing into outputDirectory: which
+  # subjects still need computing, and everything that happens to a subject's
+  # result once it is known. Subject i is the i-th of names, meshPaths,
+  # landmarkXYZ ((L, 3) fixed landmarks) and meshMatrices (alignment applied
+  # when the mesh is read, or None); its points are written to
+  # <name>.mrk.json, labelled with outputLabels.
+  #
+  # Subjects are keyed by a hash of their inputs (resultCache.subjectKey),
+  # which the output folder's journal uses to resume. isPending skips a subject
+  # completed by an earlier run when its input fingerprint (journal.
+  # inputFingerprint: mesh file size and time, landmarks) still matches, without
+  # hashing the mesh or reading the output back; the result key is only
+  # computed for subjects that are not, or with verifyOutput, which also checks
+  # each skipped file against its checksum. Optional parts:
+  #   cache   resultCache.CorrespondenceResultCache; computed subjects are
+  #           kept in it and subjects found in it are written without
+  #           computing
+  #   store   correspondenceStore.CorrespondenceStore open for writing; every
+  #           subject's fixed and semi-landmarks go into it as they are
+  #           written, rows of subjects completed earlier are filled in from
+  #           their files
+  #   queue   workQueue.WorkQueue of a distributed run; a subject is claimed
+  #           (by fingerprint) before its mesh is hashed and it is computed, and
+  #           marked done afterwards, so processes sharing the output folder
+  #           each take different subjects. Claims are refreshed as subjects
+  #           finish and released by close().
+
+  def __init__(self, outputDirectory, runKey, names, meshPaths, landmarkXYZ, meshMatrices, outputLabels,
+               verifyOutput=False, cache=None, store=None, queue=None):
+    self.outputDirectory = outputDirectory
+    self.runKey = runKey
+    self.names = names
+    self.meshPaths = meshPaths
+    self.landmarkXYZ = landmarkXYZ
+    self.meshMatrices = meshMatrices
+    self.outputLabels = outputLabels
+    self.verifyOutput = verifyOutput
+    self.cache = cache
+    self.store = store
+    self.queue = queue
+    self.journal = OutputJournal(outputDirectory, queue.owner if queue is not None else None)
+    self.keys = {}
+    self.fingerprints = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def outputPath(self, i):
+    return os.path.join(self.outputDirectory, self.names[i] + ".mrk.json")
+
+  def isPending(self, i):
+    # False if subject i is already done: completed by an earlier run, or
+    # written here from the result cache. In a distributed run only the journal
+    # is checked; the rest waits for claim(i).
+    self.fingerprints[i] = inputFingerprint(self.runKey, self.meshPaths[i], self.landmarkXYZ[i], self.meshMatrices[i])
+    completedKey = None if self.verifyOutput else self.journal.completedKey(self.names[i], self.fingerprints[i], self.outputPath(i))
+    if completedKey is not None:
+      self.keys[i] = completedKey
+      self._skipCompleted(i)
+      return False
+    return self.queue is not None or self._needsComputing(i)
+
+  def claim(self, i):
+    # True if this process is to compute pending subject i. In a distributed run
+    # False when the subject is done, being computed elsewhere, or was taken
+    # from the result cache.
+    if self.queue is None:
+      return True
+    return self.queue.claim(self.names[i], self.fingerprints[i]) and self._needsComputing(i)
+
+  def finish(self, i, pointsXYZ, cached=False):
+    # Write subject i's (N, 3) points and record it as done.
+    if self.cache is not None and not cached:
+      self.cache.store(self.keys[i], pointsXYZ)
+    with profiling.stage("write"):
+      markupsIO.writeMarkups(self.outputPath(i), pointsXYZ, self.outputLabels)
+    self._storeSubject(i, pointsXYZ)
+    self.journal.record(self.names[i], self.keys[i], len(self.outputLabels), self.outputPath(i), self.fingerprints[i])
+    if self.queue is not None:
+      self.queue.complete(self.names[i], self.fingerprints[i])
+      # the claims of subjects still being computed
+      self.queue.refreshAll()
+
+  def close(self):
+    if self.store is not None:
+      self.store.close()
+    if self.queue is not None:
+      self.queue.releaseAll()
+
+  def _needsComputing(self, i):
+    # Hash subject i's inputs into its result key and finish it without
+    # computing if the journal (entries written before fingerprints, or with
+    # verifyOutput) or the result cache already has it.
+    name = self.names[i]
+    self.keys[i] = subjectKey(self.runKey, self.meshPaths[i], self.landmarkXYZ[i], self.meshMatrices[i])
+    if self.journal.isComplete(name, self.keys[i], self.outputPath(i), self.verifyOutput):
+      if self.journal.entries[name].get("fingerprint") != self.fingerprints[i]:
+        self.journal.record(name, self.keys[i], len(self.outputLabels), self.outputPath(i), self.fingerprints[i])
+      self._skipCompleted(i)
+      return False
+    cachedXYZ = self.cache.load(self.keys[i], len(self.outputLabels)) if self.cache is not None else None
+    if cachedXYZ is None:
+      return True
+    with profiling.subject(i):
+      self.finish(i, cachedXYZ, cached=True)
+    return False
+
+  def _skipCompleted(self, i):
+    # subject i was completed by an earlier run
+    if self.queue is not None and not self.queue.isDone(self.names[i], self.fingerprints[i]):
+      self.queue.complete(self.names[i], self.fingerprints[i])
+    if self.store is not None and not self.store.contains(self.names[i], self.keys[i]):
+      self._storeSubject(i, markupsIO.readMarkupsPoints(self.outputPath(i)))
+
+  def _storeSubject(self, i, semiLandmarkXYZ):
+    if self.store is not None:
+      with profiling.stage("store write"):
+        self.store.write(self.names[i], self.keys[i], np.concatenate((self.landmarkXYZ[i], semiLandmarkXYZ)))
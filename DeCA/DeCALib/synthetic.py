@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+from DeCALib import markupsIO
+
+
+def fibonacciDirections(count):
+  # count roughly evenly spread unit vectors; used as landmark positions that are
+  # homologous across all synthetic specimens
+  index = np.arange(count) + 0.5
+  polar = np.arccos(1 - 2 * index / count)
+  azimuth = np.pi * (1 + 5 ** 0.5) * index
+  return np.column_stack((np.cos(azimuth) * np.sin(polar), np.sin(azimuth) * np.sin(polar), np.cos(polar)))
+
+
+def randomRotation(rng):
+  q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+  q *= np.sign(np.diag(r))
+  if np.linalg.det(q) < 0:
+    q[:, 0] *= -1
+  return q
+
+
+class SpecimenShape:
+  # A perturbed ellipsoid: every unit direction d maps to the surface point
+  #   R (size * axes * d * (1 + sum_j a_j exp(-|d - c_j|^2 / w^2))) + t
+  # so meshes and landmarks (placed at fixed directions) sample one smooth
+  # surface, and the specimens differ in proportions, local bumps, size and pose.
+
+  def __init__(self, rng, meanAxes=(1.0, 0.75, 0.55), size=50.0, bumpCount=6, bumpWidth=0.6, shapeVariation=0.08):
+    self.axes = np.asarray(meanAxes) * (1 + shapeVariation * rng.normal(size=3))
+    self.bumpCenters = fibonacciDirections(bumpCount)
+    self.bumpAmplitudes = shapeVariation * rng.normal(size=bumpCount)
+    self.bumpWidth = bumpWidth
+    self.size = size * (1 + 0.1 * rng.normal())
+    self.rotation = randomRotation(rng)
+    self.translation = 20 * rng.normal(size=3)
+
+  def surfacePoints(self, directions):
+    directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    squaredDistances = ((directions[:, None, :] - self.bumpCenters[None]) ** 2).sum(axis=2)
+    radial = 1 + (self.bumpAmplitudes * np.exp(-squaredDistances / self.bumpWidth ** 2)).sum(axis=1)
+    local = self.size * self.axes * directions * radial[:, None]
+    return local @ self.rotation.T + self.translation
+
+
+def sphereWithVertexCount(vertexCount):
+  # Triangulated unit sphere with about vertexCount points.
+  resolution = max(8, int(np.ceil(np.sqrt(vertexCount))))
+  sphere = vtk.vtkSphereSource()
+  sphere.SetRadius(1.0)
+  sphere.SetThetaResolution(resolution)
+  sphere.SetPhiResolution(resolution)
+  sphere.Update()
+  return sphere.GetOutput()
+
+
+def writeDataset(directory, specimenCount, vertexCount, landmarkCount, seed=0):
+  # Write specimenCount synthetic specimens as meshes/<name>.ply and
+  # landmarks/<name>.mrk.json under directory, in the layout the DeCA and DeCAL
+  # workflows read. The same seed always gives the same files. Returns the mesh
+  # and landmark folders.
+  rng = np.random.default_rng(seed)
+  meshDirectory = os.path.join(directory, "meshes")
+  landmarkDirectory = os.path.join(directory, "landmarks")
+  os.makedirs(meshDirectory, exist_ok=True)
+  os.makedirs(landmarkDirectory, exist_ok=True)
+  sphere = sphereWithVertexCount(vertexCount)
+  sphereXYZ = vtk_np.vtk_to_numpy(sphere.GetPoints().GetData()).astype(np.float64)
+  landmarkDirections = fibonacciDirections(landmarkCount)
+  writer = vtk.vtkPLYWriter()
+  for i in range(specimenCount):
+    name = f"specimen_{i:04d}"
+    shape = SpecimenShape(rng)
+    # points and triangles only: the sphere's normals do not fit the specimen
+    mesh = vtk.vtkPolyData()
+    points = vtk.vtkPoints()
+    points.SetData(vtk_np.numpy_to_vtk(shape.surfacePoints(sphereXYZ).astype(np.float32), deep=True))
+    mesh.SetPoints(points)
+    mesh.SetPolys(sphere.GetPolys())
+    meshPath = os.path.join(meshDirectory, name + ".ply")
+    writer.SetFileName(meshPath)
+    writer.SetInputData(mesh)
+    if not writer.Write():
+      raise OSError(f"Could not write model: {meshPath}")
+    # .ply coordinates are read as LPS and markups are given in RAS, so flip x
+    # and y for the landmarks to sit on the mesh once both are loaded
+    markupsIO.writeMarkups(os.path.join(landmarkDirectory, name + ".mrk.json"),
+      shape.surfacePoints(landmarkDirections) * np.array([-1.0, -1.0, 1.0]))
+  return meshDirectory, landmarkDirectory
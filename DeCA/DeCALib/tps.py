@@ -0,0 +1,111 @@
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Points per evaluation chunk: bounds the (chunk x landmarks) kernel block that is
+# held in memory at once, whatever the mesh size.
+DEFAULT_CHUNK_SIZE = 16384
+
+
+class ThinPlateSpline:
+  # Vectorized 3D thin-plate spline with the R (|r|) basis, equivalent to
+  # vtkThinPlateSplineTransform with SetBasisToR() and the default sigma of 1.
+  #
+  # The linear system depends only on the source landmarks, so it is LU-factorized
+  # once here and reused for any number of target landmark sets: solve() takes
+  # one (N, 3) target or a stack of S targets (S, N, 3) and solves them all as a
+  # single multi-right-hand-side system. This is what makes the inverse DeCA warp
+  # cheap: its source is always the mean shape. Without scipy each solve() call
+  # factorizes the system with np.linalg.solve instead.
+  def __init__(self, sourceXYZ):
+    self.sourceXYZ = np.array(sourceXYZ, dtype=np.float64)
+    landmarkCount = len(self.sourceXYZ)
+    system = np.zeros((landmarkCount + 4, landmarkCount + 4))
+    system[:landmarkCount, :landmarkCount] = _pairwiseDistances(self.sourceXYZ, self.sourceXYZ)
+    system[:landmarkCount, landmarkCount] = 1
+    system[:landmarkCount, landmarkCount + 1:] = self.sourceXYZ
+    system[landmarkCount, :landmarkCount] = 1
+    system[landmarkCount + 1:, :landmarkCount] = self.sourceXYZ.T
+    self._system = system
+    self._factorization = None
+    self._pseudoInverse = None
+    try:
+      from scipy.linalg import lu_factor
+    except ImportError:
+      return
+    with warnings.catch_warnings():
+      # an exactly singular system is detected from the factors below
+      warnings.simplefilter("ignore")
+      lu, pivots = lu_factor(system)
+    if np.all(np.diag(lu) != 0):
+      self._factorization = (lu, pivots)
+    else:
+      # degenerate (e.g. coplanar) landmarks: least-squares solution
+      self._pseudoInverse = np.linalg.pinv(system)
+
+  def solve(self, targetXYZ):
+    # Spline coefficients mapping the source landmarks onto targetXYZ: an
+    # (N + 4, 3) array, or (S, N + 4, 3) for a stack of S targets. The first N
+    # rows are the kernel weights, then the translation and the 3x3 linear part.
+    targetXYZ = np.asarray(targetXYZ, dtype=np.float64)
+    landmarkCount = len(self.sourceXYZ)
+    stackShape = targetXYZ.shape[:-2]
+    # the S targets side by side as the 3 S columns of one right-hand side
+    rightHandSide = np.zeros((landmarkCount + 4,) + stackShape + (3,))
+    rightHandSide[:landmarkCount] = np.moveaxis(targetXYZ, -2, 0)
+    rightHandSide = rightHandSide.reshape(landmarkCount + 4, -1)
+    if self._factorization is not None:
+      from scipy.linalg import lu_solve
+      coefficients = lu_solve(self._factorization, rightHandSide)
+    elif self._pseudoInverse is not None:
+      coefficients = self._pseudoInverse @ rightHandSide
+    else:
+      try:
+        coefficients = np.linalg.solve(self._system, rightHandSide)
+      except np.linalg.LinAlgError:
+        self._pseudoInverse = np.linalg.pinv(self._system)
+        coefficients = self._pseudoInverse @ rightHandSide
+    return np.moveaxis(coefficients.reshape((landmarkCount + 4,) + stackShape + (3,)), 0, -2)
+
+  def evaluate(self, coefficients, pointsXYZ, chunkSize=DEFAULT_CHUNK_SIZE, workers=None):
+    # Warp (M, 3) pointsXYZ with coefficients from solve(). The points are
+    # processed in chunks, and the chunks are spread over a thread pool (numpy
+    # releases the GIL for the heavy array work). Returns float64 (M, 3).
+    pointsXYZ = np.asarray(pointsXYZ, dtype=np.float64)
+    landmarkCount = len(self.sourceXYZ)
+    weights = coefficients[:landmarkCount]
+    translation = coefficients[landmarkCount]
+    linear = coefficients[landmarkCount + 1:]
+    warpedXYZ = np.empty_like(pointsXYZ)
+
+    def evaluateChunk(start):
+      chunk = pointsXYZ[start:start + chunkSize]
+      warpedXYZ[start:start + chunkSize] = _pairwiseDistances(chunk, self.sourceXYZ) @ weights + chunk @ linear + translation
+
+    starts = range(0, len(pointsXYZ), chunkSize)
+    workers = workers or os.cpu_count() or 1
+    if workers < 2 or len(starts) < 2:
+      for start in starts:
+        evaluateChunk(start)
+    else:
+      with ThreadPoolExecutor(max_workers=min(workers, len(starts))) as executor:
+        list(executor.map(evaluateChunk, starts))
+    return warpedXYZ
+
+  def warp(self, targetXYZ, pointsXYZ, chunkSize=DEFAULT_CHUNK_SIZE, workers=None):
+    # Solve for a single target and evaluate in one call.
+    return self.evaluate(self.solve(targetXYZ), pointsXYZ, chunkSize, workers)
+
+
+def _pairwiseDistances(a, b):
+  # (len(a), len(b)) Euclidean distances, accumulated one coordinate at a time so
+  # only (len(a), len(b)) blocks are allocated. Explicit differences (rather
+  # than |a|^2 + |b|^2 - 2ab) keep the result accurate for points far from the
+  # origin.
+  squared = np.zeros((len(a), len(b)))
+  for axis in range(3):
+    difference = np.subtract.outer(a[:, axis], b[:, axis])
+    squared += difference * difference
+  return np.sqrt(squared, out=squared)
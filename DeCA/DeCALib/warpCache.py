@@ -0,0 +1,131 @@
+import hashlib
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from DeCALib import closestPoint
+
+# Bump when the cached content or its layout changes, so old entries are ignored.
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+
+def hashArray(digest, array):
+  # Feed dtype, shape and contents of an array into a hashlib digest.
+  array = np.ascontiguousarray(array)
+  digest.update(str(array.dtype).encode())
+  digest.update(str(array.shape).encode())
+  digest.update(array.tobytes())
+
+
+def hashFile(digest, path):
+  with open(path, "rb") as dataFile:
+    for block in iter(lambda: dataFile.read(1 << 20), b""):
+      digest.update(block)
+
+
+def hashPolyData(digest, mesh):
+  for name, array in sorted(closestPoint.polyDataToArrays(mesh).items()):
+    digest.update(name.encode())
+    hashArray(digest, array)
+
+
+def evictLeastRecentlyUsed(directory, maxBytes):
+  # Remove the entries (files or folders) of a cache directory with the oldest
+  # modification time until it holds at most maxBytes. Names starting with "."
+  # are entries still being written and are left alone.
+  entries = []
+  totalBytes = 0
+  for entry in os.scandir(directory):
+    if entry.name.startswith("."):
+      continue
+    try:
+      if entry.is_dir():
+        entryBytes = sum(f.stat().st_size for f in os.scandir(entry.path))
+      else:
+        entryBytes = entry.stat().st_size
+      entries.append((entry.stat().st_mtime, entryBytes, entry.path))
+    except OSError:
+      continue
+    totalBytes += entryBytes
+  for _, entryBytes, entryPath in sorted(entries):
+    if totalBytes <= maxBytes:
+      break
+    if os.path.isdir(entryPath):
+      shutil.rmtree(entryPath, ignore_errors=True)
+    else:
+      try:
+        os.remove(entryPath)
+      except OSError:
+        continue
+    totalBytes -= entryBytes
+
+
+class WarpedMeshCache:
+  # On-disk cache of subjects warped onto a mean shape, shared by every run that
+  # points at the same directory. An entry is keyed by a hash of the subject mesh
+  # (file bytes, or point and cell arrays), its landmarks, the mean shape and the
+  # warp method, and holds the warped mesh as .npy arrays that are memory-mapped
+  # on load. (The k-d tree of the fast method is rebuilt from the points, which
+  # is cheap, rather than unpickled from a shared folder.) Entries are written
+  # to a temporary folder and renamed into place, so
+  # several processes can share a cache. When the cache grows past maxBytes the
+  # least recently used entries are removed. hits and misses count lookups made
+  # through this object.
+
+  def __init__(self, directory, maxBytes=DEFAULT_MAX_BYTES):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(directory, exist_ok=True)
+
+  def key(self, mesh, landmarkXYZ, meanShapeXYZ, useNumpyTPS=False):
+    digest = hashlib.sha256(f"DeCA warped mesh v{CACHE_VERSION} numpyTPS={bool(useNumpyTPS)}".encode())
+    if isinstance(mesh, str):
+      hashFile(digest, mesh)
+    else:
+      hashPolyData(digest, mesh)
+    hashArray(digest, landmarkXYZ)
+    hashArray(digest, meanShapeXYZ)
+    return digest.hexdigest()
+
+  def _entryPath(self, key):
+    return os.path.join(self.directory, key)
+
+  def load(self, key):
+    # The cached meanWarpedMesh, or None on a miss. Its arrays are memory-mapped
+    # copy-on-write, so only the pages the caller touches are read and the
+    # entry's files are never modified.
+    entryPath = self._entryPath(key)
+    try:
+      arrays = {fileName[:-len(".npy")]: np.load(os.path.join(entryPath, fileName), mmap_mode="c")
+                for fileName in os.listdir(entryPath) if fileName.endswith(".npy")}
+      mesh = closestPoint.arraysToPolyData(arrays, deep=False)
+      os.utime(entryPath)  # mark as recently used
+    except (OSError, ValueError, KeyError):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return mesh
+
+  def store(self, key, mesh):
+    temporaryPath = self._entryPath(f".{key}.{uuid.uuid4().hex}")
+    try:
+      os.makedirs(temporaryPath)
+      for name, array in closestPoint.polyDataToArrays(mesh).items():
+        np.save(os.path.join(temporaryPath, name + ".npy"), array)
+      os.rename(temporaryPath, self._entryPath(key))
+    except OSError:
+      # another process stored the same entry first, or the disk is full; the
+      # cache is an optimization, so never fail the run over it
+      shutil.rmtree(temporaryPath, ignore_errors=True)
+      return
+    evictLeastRecentlyUsed(self.directory, self.maxBytes)
+
+  def summary(self):
+    return f"warped mesh cache: {self.hits} hits, {self.misses} misses"
+
@@ -0,0 +1,108 @@
+import json
+import os
+import socket
+import time
+import uuid
+
+# A claim whose file has not been touched for this long belongs to a process
+# that died; any other process may take the subject over.
+DEFAULT_STALE_SECONDS = 2 * 60 * 60
+
+
+class WorkQueue:
+  # Coordinator-free claims on subjects, shared by any number of processes on
+  # any number of hosts through lock files in one folder of a shared
+  # filesystem. A process claims a subject by creating <name>.claim exclusively
+  # (O_EXCL), computes it, and marks it done by writing its result key to
+  # <name>.done and removing the claim. Done subjects are never claimed again for
+  # the same key; claims older than staleSeconds are broken and retaken. In the
+  # rare race where two processes break the same stale claim a subject is
+  # computed twice, which is harmless: results are identical and written
+  # atomically.
+
+  def __init__(self, directory, staleSeconds=DEFAULT_STALE_SECONDS, owner=None):
+    self.directory = directory
+    self.staleSeconds = staleSeconds
+    self.owner = owner or f"{socket.gethostname()}-{os.getpid()}"
+    self.held = set()
+    os.makedirs(directory, exist_ok=True)
+
+  def _path(self, name, suffix):
+    return os.path.join(self.directory, name + suffix)
+
+  def isDone(self, name, key=None):
+    try:
+      with open(self._path(name, ".done"), "r", encoding="utf-8") as doneFile:
+        doneKey = doneFile.read().strip()
+    except OSError:
+      return False
+    return key is None or doneKey == key
+
+  def claim(self, name, key):
+    # True if this process now owns the subject and should compute it.
+    if self.isDone(name, key):
+      return False
+    claimPath = self._path(name, ".claim")
+    for attempt in range(2):
+      try:
+        claimFile = os.open(claimPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+      except FileExistsError:
+        if attempt or not self._breakStaleClaim(claimPath):
+          return False
+        continue
+      with os.fdopen(claimFile, "w", encoding="utf-8") as claimFile:
+        json.dump({"owner": self.owner, "time": time.time()}, claimFile)
+      self.held.add(name)
+      # another process may have finished it between the check and the claim
+      if self.isDone(name, key):
+        self.release(name)
+        return False
+      return True
+    return False
+
+  def _breakStaleClaim(self, claimPath):
+    try:
+      age = time.time() - os.stat(claimPath).st_mtime
+    except OSError:
+      return True  # released meanwhile
+    if age < self.staleSeconds:
+      return False
+    # rename first, so that of several processes finding the same stale claim
+    # only one removes it
+    stalePath = f"{claimPath}.{uuid.uuid4().hex}.stale"
+    try:
+      os.rename(claimPath, stalePath)
+      os.remove(stalePath)
+    except OSError:
+      return False
+    return True
+
+  def refresh(self, name):
+    # Keep a long-running claim from going stale.
+    try:
+      os.utime(self._path(name, ".claim"))
+    except OSError:
+      pass
+
+  def refreshAll(self):
+    for name in list(self.held):
+      self.refresh(name)
+
+  def complete(self, name, key):
+    temporaryPath = self._path(f".{name}.{uuid.uuid4().hex}", ".done")
+    with open(temporaryPath, "w", encoding="utf-8") as doneFile:
+      doneFile.write(key)
+    os.replace(temporaryPath, self._path(name, ".done"))
+    self.release(name)
+
+  def release(self, name):
+    if name in self.held:
+      self.held.discard(name)
+      try:
+        os.remove(self._path(name, ".claim"))
+      except OSError:
+        pass
+
+  def releaseAll(self):
+    for name in list(self.held):
+      self.release(name)
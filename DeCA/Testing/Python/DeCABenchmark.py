@@ -0,0 +1,243 @@
+#
+# Benchmark of the DeCA pipeline stages on synthetic specimens.
+#
+#   Slicer --no-main-window --python-script DeCABenchmark.py --out results.json
+#     [--specimens 20] [--vertices 20000] [--landmarks 30] [--seed 0]
+#     [--workers 1] [--compare baseline.json] [--tolerance 0.2]
+#
+# Generates perturbed ellipsoids with placed landmarks (DeCALib.synthetic),
+# runs runAlign, runMean, runDeCAL (exact and fast), runMergeLandmarks,
+# runBackTransformLandmarks and runDCAlign on them as the DeCAL tab and
+# runBatch do, and records per stage the wall time, peak resident memory and
+# throughput. Results are written as JSON (with the versions and settings of
+# the run) and as CSV next to it. With --compare, stages more than tolerance
+# slower than in an earlier results file are reported and the exit code is 1.
+#
+
+import argparse
+import csv
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import vtk
+
+import slicer
+
+from DeCA import DeCALogic
+from DeCALib import synthetic
+
+
+def _peakRSSBytes():
+  # VmHWM, the peak resident set size since the last _resetPeakRSS (Linux);
+  # elsewhere the process-lifetime peak from getrusage, or on Windows from
+  # psutil's peak working set. None if neither is available.
+  try:
+    with open("/proc/self/status", "r") as statusFile:
+      for line in statusFile:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return _rusagePeakBytes("RUSAGE_SELF")
+
+
+def _rusagePeakBytes(who):
+  try:
+    import resource
+  except ImportError:
+    # Windows
+    if who != "RUSAGE_SELF":
+      return None
+    try:
+      import psutil
+    except ImportError:
+      return None
+    return getattr(psutil.Process().memory_info(), "peak_wset", None)
+  peak = resource.getrusage(getattr(resource, who)).ru_maxrss
+  return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _resetPeakRSS():
+  # Writing 5 to clear_refs resets VmHWM, so each stage reports its own peak.
+  try:
+    with open("/proc/self/clear_refs", "w") as clearRefsFile:
+      clearRefsFile.write("5")
+    return True
+  except OSError:
+    return False
+
+
+def _childPeakRSSBytes():
+  # Largest peak of any finished worker process (parallel runs only; None on
+  # Windows).
+  return _rusagePeakBytes("RUSAGE_CHILDREN")
+
+
+def _mebibytes(byteCount):
+  return None if byteCount is None else round(byteCount / 2 ** 20, 1)
+
+
+class StageTimer:
+
+  def __init__(self):
+    self.rows = []
+    self.perStagePeak = _resetPeakRSS()
+
+  def run(self, stage, function, items=None, itemName="points"):
+    # items: number of points (or subjects) the stage processes, for throughput;
+    # may be a callable evaluated after the stage has run.
+    _resetPeakRSS()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    if callable(items):
+      items = items(result)
+    row = {"stage": stage, "seconds": round(seconds, 4), "peakRSSMiB": _mebibytes(_peakRSSBytes()),
+           "childPeakRSSMiB": _mebibytes(_childPeakRSSBytes()), "items": items, "itemName": itemName,
+           "itemsPerSecond": round(items / seconds, 2) if items and seconds > 0 else None}
+    self.rows.append(row)
+    print(f"{stage}: {seconds:.2f} s" + (f", peak {row['peakRSSMiB']} MiB" if row["peakRSSMiB"] is not None else "")
+      + (f", {row['itemsPerSecond']} {itemName}/s" if row["itemsPerSecond"] else ""), flush=True)
+    return result
+
+
+def _gitDescription():
+  try:
+    return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)),
+      capture_output=True, text=True, timeout=10).stdout.strip() or None
+  except (OSError, subprocess.SubprocessError):
+    return None
+
+
+def _environment():
+  return {
+    "git": _gitDescription(),
+    "slicer": slicer.app.applicationVersion,
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "vtk": vtk.vtkVersion.GetVTKVersion(),
+    "platform": platform.platform(),
+    "processor": platform.processor(),
+    "cpuCount": os.cpu_count(),
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def runBenchmark(args, workDirectory):
+  logic = DeCALogic()
+  timer = StageTimer()
+  meshDirectory, landmarkDirectory = timer.run("generate", lambda: synthetic.writeDataset(
+    os.path.join(workDirectory, "input"), args.specimens, args.vertices, args.landmarks, seed=args.seed),
+    items=args.specimens, itemName="subjects")
+  subjectCount = args.specimens
+  vertexCount = synthetic.sphereWithVertexCount(args.vertices).GetNumberOfPoints()
+  folders = logic.setUpOutputDirectories(os.path.join(workDirectory, "output"), DeCALOption=True)
+  parallel = {"workers": args.workers, "parallelSubjects": args.workers != 1}
+
+  # rigid alignment to the first specimen, keeping the transforms for the
+  # back-transform stage
+  atlasMeshPath = os.path.join(meshDirectory, sorted(os.listdir(meshDirectory))[0])
+  atlasLandmarkPath = os.path.join(landmarkDirectory, sorted(os.listdir(landmarkDirectory))[0])
+  alignAtlasModel = slicer.util.loadModel(atlasMeshPath)
+  alignAtlasLMs = slicer.util.loadMarkups(atlasLandmarkPath)
+  timer.run("runAlign", lambda: logic.runAlign(alignAtlasModel, alignAtlasLMs, meshDirectory, landmarkDirectory,
+    folders['alignedModels'], folders['alignedLMs'], True, transformDirectory=folders['alignmentTransforms']),
+    items=subjectCount * vertexCount)
+
+  atlasModel, atlasLMs = timer.run("runMean", lambda: logic.runMean(folders['alignedLMs'], folders['alignedModels'], **parallel),
+    items=subjectCount * vertexCount)
+  atlasModelPath = os.path.join(folders['output'], 'decaAtlasModel.ply')
+  atlasLMPath = os.path.join(folders['output'], 'decaAtlasLM.mrk.json')
+  slicer.util.saveNode(atlasModel, atlasModelPath)
+  slicer.util.saveNode(atlasLMs, atlasLMPath)
+  templatePointCount = logic.runCheckPoints(atlasModel, args.spacing)[1]
+
+  # the result cache is off so that both runs compute every subject
+  semiLandmarkDirectories = {}
+  for method, useFast in (("exact", False), ("fast", True)):
+    semiLandmarkDirectories[method] = os.path.join(folders['output'], f"DeCALOutput_{method}")
+    os.makedirs(semiLandmarkDirectories[method], exist_ok=True)
+    timer.run(f"runDeCAL_{method}", lambda: logic.runDeCAL(atlasModel, atlasLMs, folders['alignedModels'], folders['alignedLMs'],
+      semiLandmarkDirectories[method], args.spacing, useFastCorrespondence=useFast, useResultCache=False, **parallel),
+      items=subjectCount * templatePointCount)
+
+  mergedDirectory = os.path.join(folders['output'], "mergedLMs")
+  os.makedirs(mergedDirectory, exist_ok=True)
+  mergedCount = timer.run("runMergeLandmarks", lambda: logic.runMergeLandmarks(folders['alignedLMs'], semiLandmarkDirectories["exact"],
+    mergedDirectory, atlasLMPath), items=lambda count: count and count * (templatePointCount + args.landmarks))
+  if mergedCount is None:
+    timer.rows[-1]["skipped"] = "MergeMarkups module (SlicerMorph) not available"
+
+  timer.run("runBackTransformLandmarks", lambda: logic.runBackTransformLandmarks(semiLandmarkDirectories["exact"],
+    folders['alignmentTransforms'], os.path.join(folders['output'], "DeCALOutput_originalFrame")),
+    items=lambda count: count * templatePointCount)
+
+  dcAlignDirectory = os.path.join(workDirectory, "DeCAOutput")
+  os.makedirs(dcAlignDirectory, exist_ok=True)
+  timer.run("runDCAlign", lambda: logic.runDCAlign(atlasModelPath, atlasLMPath, folders['alignedModels'], folders['alignedLMs'],
+    dcAlignDirectory, False, **parallel), items=subjectCount * atlasModel.GetPolyData().GetNumberOfPoints())
+
+  return timer, {"templatePoints": templatePointCount, "meshVertices": vertexCount}
+
+
+def compareResults(rows, baselinePath, tolerance):
+  # Stages slower than the baseline by more than tolerance (a fraction).
+  with open(baselinePath, "r", encoding="utf-8") as baselineFile:
+    baseline = {row["stage"]: row for row in json.load(baselineFile)["stages"]}
+  regressions = []
+  for row in rows:
+    before = baseline.get(row["stage"])
+    if before and before["seconds"] > 0 and row["seconds"] > before["seconds"] * (1 + tolerance):
+      regressions.append(f"{row['stage']}: {before['seconds']:.2f} s -> {row['seconds']:.2f} s")
+  return regressions
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Benchmark the DeCA pipeline stages on synthetic specimens")
+  parser.add_argument("--out", required=True, help="results .json file; a .csv with the same name is written next to it")
+  parser.add_argument("--specimens", type=int, default=20)
+  parser.add_argument("--vertices", type=int, default=20000, help="approximate vertices per mesh")
+  parser.add_argument("--landmarks", type=int, default=30)
+  parser.add_argument("--spacing", type=float, default=4, help="DeCAL point spacing tolerance (percent)")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--workers", type=int, default=1, help="worker processes (0: all cores)")
+  parser.add_argument("--workDirectory", help="keep the generated data and outputs here instead of a temporary folder")
+  parser.add_argument("--compare", help="earlier results .json to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against --compare, as a fraction")
+  args = parser.parse_args(argv)
+
+  if args.workDirectory:
+    os.makedirs(args.workDirectory, exist_ok=True)
+    timer, sizes = runBenchmark(args, args.workDirectory)
+  else:
+    with tempfile.TemporaryDirectory(prefix="DeCABenchmark") as workDirectory:
+      timer, sizes = runBenchmark(args, workDirectory)
+
+  parameters = {key: value for key, value in vars(args).items() if key not in ("out", "compare", "workDirectory")}
+  parameters.update(sizes)
+  results = {"environment": _environment(), "parameters": parameters, "perStagePeakRSS": timer.perStagePeak, "stages": timer.rows}
+  with open(args.out, "w", encoding="utf-8") as resultsFile:
+    json.dump(results, resultsFile, indent=2)
+  fieldNames = ["stage", "seconds", "peakRSSMiB", "childPeakRSSMiB", "items", "itemName", "itemsPerSecond", "skipped"]
+  with open(os.path.splitext(args.out)[0] + ".csv", "w", newline="", encoding="utf-8") as csvFile:
+    writer = csv.DictWriter(csvFile, fieldnames=fieldNames)
+    writer.writeheader()
+    writer.writerows(timer.rows)
+  print(f"Results written to {args.out}", flush=True)
+
+  if args.compare:
+    regressions = compareResults(timer.rows, args.compare, args.tolerance)
+    for regression in regressions:
+      print(f"Slower than {args.compare}: {regression}", flush=True)
+    return 1 if regressions else 0
+  return 0
+
+
+if __name__ == "__main__":
+  slicer.util.exit(main(sys.argv[1:]))
@@ -0,0 +1,516 @@
+#
+# Unit tests of the scene-free DeCALib helpers.
+#
+#   python -m unittest DeCALibTest    (with the DeCA folder on PYTHONPATH)
+#
+# or as a ctest of the extension build. Needs numpy, scipy and VTK, but not
+# Slicer.
+#
+
+import mmap
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import vtk
+import vtk.util.numpy_support as vtk_np
+
+from DeCALib import alignment, closestPoint, correspondence, markupsIO, procrustes, resultCache, tps
+from DeCALib.subjectTracker import SubjectTracker
+from DeCALib.warpCache import WarpedMeshCache
+from DeCALib.workQueue import WorkQueue
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+
+def _roughSphere(resolution, noise, seed):
+  # vtkSphereSource triangles with every vertex moved by Gaussian noise
+  sphere = vtk.vtkSphereSource()
+  sphere.SetRadius(10)
+  sphere.SetThetaResolution(resolution)
+  sphere.SetPhiResolution(resolution)
+  sphere.Update()
+  mesh = vtk.vtkPolyData()
+  mesh.SetPoints(sphere.GetOutput().GetPoints())
+  mesh.SetPolys(sphere.GetOutput().GetPolys())
+  points = vtk_np.vtk_to_numpy(mesh.GetPoints().GetData())
+  points += np.random.default_rng(seed).normal(0, noise, points.shape).astype(points.dtype)
+  mesh.GetPoints().Modified()
+  return mesh
+
+
+class ClosestPointTest(unittest.TestCase):
+
+  def test_hybridMatchesExactOnRoughMesh(self):
+    target = _roughSphere(120, 0.05, 0)
+    for noise in (0.02, 0.3):
+      queryXYZ = vtk_np.vtk_to_numpy(_roughSphere(80, noise, 1).GetPoints().GetData()).astype(np.float64)
+      exactXYZ = closestPoint.closestPointsOnSurface(target, queryXYZ)
+      hybridXYZ, _ = closestPoint.projectedNearestVertices(target, queryXYZ)
+      exactDistances = np.linalg.norm(exactXYZ - queryXYZ, axis=1)
+      hybridDistances = np.linalg.norm(hybridXYZ - queryXYZ, axis=1)
+      np.testing.assert_allclose(hybridDistances, exactDistances, rtol=0, atol=1e-9)
+      np.testing.assert_allclose(hybridXYZ, exactXYZ, rtol=0, atol=1e-6)
+
+  def test_hybridFallsBackWithoutTriangles(self):
+    # a vertex outside every triangle is never returned
+    target = _roughSphere(20, 0.0, 0)
+    points = vtk_np.vtk_to_numpy(target.GetPoints().GetData())
+    target.GetPoints().SetData(vtk_np.numpy_to_vtk(np.concatenate((points, [[0, 0, 0]])), deep=True))
+    queryXYZ = np.array([[0.0, 0.0, 0.1], [0.0, 0.0, 11.0]])
+    hybridXYZ, exactCount = closestPoint.projectedNearestVertices(target, queryXYZ)
+    self.assertEqual(exactCount, 1)
+    np.testing.assert_allclose(hybridXYZ, closestPoint.closestPointsOnSurface(target, queryXYZ), atol=1e-9)
+
+  def test_parallelExactQueryMatchesSerial(self):
+    target = _roughSphere(60, 0.05, 0)
+    queryXYZ = vtk_np.vtk_to_numpy(_roughSphere(80, 0.3, 1).GetPoints().GetData()).astype(np.float64)
+    self.assertGreater(len(queryXYZ), closestPoint.MINIMUM_PARALLEL_QUERY_COUNT)
+    with closestPoint.ExactClosestPointEngine(2) as engine:
+      # the worker count is capped at the core count; two workers run the pool
+      # path on any machine
+      engine.workers = 2
+      parallelXYZ = engine.query(target, queryXYZ)
+      self.assertFalse(engine._poolFailed)
+    self.assertTrue(np.array_equal(parallelXYZ, closestPoint.closestPointsOnSurface(target, queryXYZ)))
+
+
+
+def _vtkPoints(pointsXYZ):
+  points = vtk.vtkPoints()
+  points.SetData(vtk_np.numpy_to_vtk(np.ascontiguousarray(pointsXYZ, dtype=np.float64), deep=True))
+  return points
+
+
+class ThinPlateSplineTest(unittest.TestCase):
+
+  def _vtkWarp(self, sourceXYZ, targetXYZ, pointsXYZ):
+    transform = vtk.vtkThinPlateSplineTransform()
+    transform.SetSourceLandmarks(_vtkPoints(sourceXYZ))
+    transform.SetTargetLandmarks(_vtkPoints(targetXYZ))
+    transform.SetBasisToR()
+    return np.array([transform.TransformPoint(point) for point in pointsXYZ])
+
+  def test_matchesVTK(self):
+    rng = np.random.default_rng(0)
+    sourceXYZ = rng.uniform(-50, 50, (40, 3)) + [100, -20, 300]
+    targetsXYZ = sourceXYZ + rng.normal(0, 3, (3, 40, 3))
+    pointsXYZ = rng.uniform(-60, 60, (500, 3)) + [100, -20, 300]
+    spline = tps.ThinPlateSpline(sourceXYZ)
+    coefficients = spline.solve(targetsXYZ)
+    for targetXYZ, targetCoefficients in zip(targetsXYZ, coefficients):
+      expectedXYZ = self._vtkWarp(sourceXYZ, targetXYZ, pointsXYZ)
+      np.testing.assert_allclose(spline.evaluate(targetCoefficients, pointsXYZ, chunkSize=128), expectedXYZ, rtol=0, atol=1e-8)
+      # a single target solves like one of the stack
+      np.testing.assert_allclose(spline.solve(targetXYZ), targetCoefficients, rtol=0, atol=1e-10)
+
+  def test_coplanarLandmarksStayFinite(self):
+    rng = np.random.default_rng(1)
+    sourceXYZ = np.column_stack((rng.uniform(-10, 10, (12, 2)), np.zeros(12)))
+    warpedXYZ = tps.ThinPlateSpline(sourceXYZ).warp(sourceXYZ + [1, 2, 0], rng.uniform(-10, 10, (20, 3)))
+    self.assertTrue(np.isfinite(warpedXYZ).all())
+
+
+class WarpCacheTest(unittest.TestCase):
+
+  def test_hitWrapsTheMappedEntry(self):
+    mesh = _roughSphere(30, 0.1, 0)
+    with tempfile.TemporaryDirectory() as directory:
+      cache = WarpedMeshCache(directory)
+      key = cache.key(mesh, np.zeros((3, 3)), np.ones((3, 3)))
+      self.assertIsNone(cache.load(key))
+      cache.store(key, mesh)
+      cached = cache.load(key)
+      self.assertEqual((cache.hits, cache.misses), (1, 1))
+      # arrays only, no pickled k-d tree
+      self.assertTrue(all(name.endswith(".npy") for name in os.listdir(os.path.join(directory, key))))
+      # the VTK points use the mapped file rather than a copy of it
+      pointData = cached.GetPoints().GetData()
+      cachedPoints = vtk_np.vtk_to_numpy(pointData)
+      # numpy_to_vtk keeps its source array on the VTK array, or in newer VTK
+      # versions on the array's buffer
+      mappedPoints = getattr(pointData, "_numpy_reference", None)
+      if mappedPoints is None:
+        mappedPoints = pointData.GetBuffer()._numpy_reference
+      base = mappedPoints
+      while base is not None and not isinstance(base, mmap.mmap):
+        base = getattr(base, "base", None)
+      self.assertIsInstance(base, mmap.mmap)
+      self.assertTrue(np.shares_memory(cachedPoints, mappedPoints))
+      np.testing.assert_array_equal(cachedPoints, vtk_np.vtk_to_numpy(mesh.GetPoints().GetData()))
+      np.testing.assert_array_equal(vtk_np.vtk_to_numpy(cached.GetPolys().GetConnectivityArray()),
+        vtk_np.vtk_to_numpy(mesh.GetPolys().GetConnectivityArray()))
+      np.testing.assert_allclose(closestPoint.closestPointsOnSurface(cached, [[0.0, 0.0, 20.0]]),
+        closestPoint.closestPointsOnSurface(mesh, [[0.0, 0.0, 20.0]]))
+      del cached, pointData, cachedPoints, mappedPoints
+
+
+class ResultCacheTest(unittest.TestCase):
+
+  def test_folderIsCreatedByTheFirstStore(self):
+    with tempfile.TemporaryDirectory() as directory:
+      cacheDirectory = os.path.join(directory, "correspondences")
+      cache = resultCache.CorrespondenceResultCache(cacheDirectory)
+      self.assertIsNone(cache.load("key", 2))
+      cache.evict()
+      cache.clear()
+      self.assertFalse(os.path.exists(cacheDirectory))
+      pointsXYZ = np.arange(6.0).reshape(2, 3)
+      cache.store("key", pointsXYZ)
+      np.testing.assert_array_equal(cache.load("key", 2), pointsXYZ)
+      self.assertIsNone(cache.load("key", 3))
+      self.assertEqual((cache.hits, cache.misses), (1, 2))
+      cache.clear()
+      self.assertEqual(os.listdir(cacheDirectory), [])
+
+
+class ProcrustesTest(unittest.TestCase):
+
+  def _vtkProcrustes(self, shapes, scaling):
+    group = vtk.vtkMultiBlockDataGroupFilter()
+    for shape in shapes:
+      polyData = vtk.vtkPolyData()
+      polyData.SetPoints(_vtkPoints(shape))
+      group.AddInputData(polyData)
+    group.Update()
+    procrustesFilter = vtk.vtkProcrustesAlignmentFilter()
+    if not scaling:
+      procrustesFilter.GetLandmarkTransform().SetModeToRigidBody()
+    procrustesFilter.SetInputData(group.GetOutput())
+    procrustesFilter.Update()
+    output = procrustesFilter.GetOutput()
+    aligned = np.array([vtk_np.vtk_to_numpy(output.GetBlock(i).GetPoints().GetData()) for i in range(len(shapes))])
+    return vtk_np.vtk_to_numpy(procrustesFilter.GetMeanPoints().GetData()), aligned
+
+  def _shapes(self, mirrored):
+    rng = np.random.default_rng(2)
+    baseXYZ = rng.uniform(-10, 10, (15, 3))
+    shapes = []
+    for i in range(8):
+      rotation = np.linalg.qr(rng.normal(size=(3, 3)))[0]
+      rotation *= np.sign(np.linalg.det(rotation))
+      shape = (baseXYZ + rng.normal(0, 0.5, baseXYZ.shape)) @ rotation.T * rng.uniform(0.5, 2) + rng.normal(0, 20, 3)
+      shapes.append(shape)
+    if mirrored:
+      # a left-right mirrored specimen is aligned by a proper rotation too
+      shapes[3] = shapes[3] * [-1, 1, 1]
+    return np.array(shapes)
+
+  def test_matchesVTKFilter(self):
+    for mirrored in (False, True):
+      shapes = self._shapes(mirrored)
+      for scaling in (True, False):
+        result = procrustes.generalizedProcrustes(shapes, scaling=scaling)
+        meanXYZ, alignedXYZ = self._vtkProcrustes(shapes, scaling)
+        np.testing.assert_allclose(result.meanShape, meanXYZ, rtol=0, atol=1e-10)
+        np.testing.assert_allclose(result.aligned, alignedXYZ, rtol=0, atol=1e-10)
+        rotations, _ = procrustes.landmarkTransforms(shapes, result.meanShape, scaling)
+        self.assertTrue((np.linalg.det(rotations) > 0).all())
+
+
+class MeshIOTest(unittest.TestCase):
+
+  def test_writeMeshRoundTripKeepsNormals(self):
+    sphere = vtk.vtkSphereSource()
+    sphere.SetCenter(3, 4, 5)
+    sphere.Update()
+    mesh = sphere.GetOutput()
+    pointsXYZ = vtk_np.vtk_to_numpy(mesh.GetPoints().GetData()).copy()
+    normals = vtk_np.vtk_to_numpy(mesh.GetPointData().GetNormals()).copy()
+    with tempfile.TemporaryDirectory() as directory:
+      for extension in (".ply", ".vtk"):
+        path = os.path.join(directory, "sphere" + extension)
+        correspondence.writeMesh(path, mesh)
+        # the input is not modified
+        np.testing.assert_array_equal(vtk_np.vtk_to_numpy(mesh.GetPointData().GetNormals()), normals)
+        # the file is LPS, normals included: still pointing outwards
+        reader = vtk.vtkPLYReader() if extension == ".ply" else vtk.vtkPolyDataReader()
+        reader.SetFileName(path)
+        reader.Update()
+        filePoints = vtk_np.vtk_to_numpy(reader.GetOutput().GetPoints().GetData())
+        fileNormals = vtk_np.vtk_to_numpy(reader.GetOutput().GetPointData().GetNormals())
+        outwards = filePoints - np.array([-3, -4, 5])
+        outwards /= np.linalg.norm(outwards, axis=1, keepdims=True)
+        self.assertGreater(np.einsum("ni,ni->n", outwards, fileNormals).min(), 0.99)
+        # and reads back as written
+        readBack = correspondence.readMesh(path)
+        # (legacy .vtk files are ASCII, with six significant digits)
+        np.testing.assert_allclose(vtk_np.vtk_to_numpy(readBack.GetPoints().GetData()), pointsXYZ, atol=1e-4)
+        np.testing.assert_allclose(vtk_np.vtk_to_numpy(readBack.GetPointData().GetNormals()), normals, atol=1e-4)
+
+
+def _transformed(mesh, transform):
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetInputData(mesh)
+  transformFilter.SetTransform(transform)
+  transformFilter.Update()
+  return transformFilter.GetOutput()
+
+
+class MirroringTest(unittest.TestCase):
+
+  def test_mirroredSubjectMatchesSceneMirroring(self):
+    # writeMirroredSubject against the steps of the scene-based mirroring it
+    # replaced: mirror and rigid transforms hardened with
+    # vtkTransformPolyDataFilter, auto-oriented normals in between, and the
+    # RAS to LPS transform of slicer.util.saveNode
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(30)
+    sphere.SetPhiResolution(30)
+    shape = vtk.vtkTransform()
+    shape.Translate(4, 2, -3)
+    shape.RotateZ(20)
+    shape.Scale(12, 7, 5)
+    sphere.Update()
+    meshRAS = _transformed(sphere.GetOutput(), shape)
+    meshXYZ = vtk_np.vtk_to_numpy(meshRAS.GetPoints().GetData())
+    landmarkXYZ = meshXYZ[[0, 1, 100, 250, 400, 600]].astype(np.float64)
+    mirrorIndex = [0, 1, 3, 2, 5, 4]
+    with tempfile.TemporaryDirectory() as directory:
+      meshPath = os.path.join(directory, "subject.ply")
+      landmarkPath = os.path.join(directory, "subject.mrk.json")
+      correspondence.writeMesh(meshPath, meshRAS)
+      markupsIO.writeMarkups(landmarkPath, landmarkXYZ)
+      mirrorMeshPath = os.path.join(directory, "subject_mirror.ply")
+      alignment.writeMirroredSubject("subject", meshPath, landmarkPath, (-1, 1, 1), mirrorIndex, mirrorMeshPath,
+        os.path.join(directory, "subject_mirror.mrk.json"))
+      reader = vtk.vtkPLYReader()
+      reader.SetFileName(mirrorMeshPath)
+      reader.Update()
+      written = reader.GetOutput()
+
+    mirror = vtk.vtkTransform()
+    mirror.Scale(-1, 1, 1)
+    mirrored = _transformed(meshRAS, mirror)
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputData(mirrored)
+    normals.SetAutoOrientNormals(True)
+    normals.Update()
+    sourcePoints = vtk.vtkPoints()
+    targetPoints = vtk.vtkPoints()
+    for i in range(len(landmarkXYZ)):
+      sourcePoints.InsertNextPoint(landmarkXYZ[mirrorIndex[i]] * [-1, 1, 1])
+      targetPoints.InsertNextPoint(landmarkXYZ[i])
+    rigid = vtk.vtkLandmarkTransform()
+    rigid.SetSourceLandmarks(sourcePoints)
+    rigid.SetTargetLandmarks(targetPoints)
+    rigid.SetModeToRigidBody()
+    rasToLps = vtk.vtkTransform()
+    rasToLps.Scale(-1, -1, 1)
+    expected = _transformed(_transformed(normals.GetOutput(), rigid), rasToLps)
+
+    np.testing.assert_allclose(vtk_np.vtk_to_numpy(written.GetPoints().GetData()),
+      vtk_np.vtk_to_numpy(expected.GetPoints().GetData()), atol=1e-4)
+    np.testing.assert_allclose(vtk_np.vtk_to_numpy(written.GetPointData().GetNormals()),
+      vtk_np.vtk_to_numpy(expected.GetPointData().GetNormals()), atol=1e-4)
+
+
+# Point lists as Slicer writes them, holding the RAS points _LANDMARKS_RAS. The
+# .fcsv headers cover the current "LPS"/"RAS" and the legacy 1/0 coordinate
+# system values.
+_LANDMARKS_RAS = np.array([[1.5, -2.25, 3.0], [-10.0, 20.5, -0.125], [100.25, 0.0, 7.75]])
+
+_LANDMARK_FILES = {
+  "a_lps.mrk.json": """{"@schema": "https://raw.githubusercontent.com/slicer/slicer/master/Modules/Loadable/Markups/Resources/Schema/markups-schema-v1.0.3.json#",
+"markups": [{"type": "Fiducial", "coordinateSystem": "LPS", "coordinateUnits": "mm", "locked": false, "labelFormat": "%N-%d", "controlPoints": [
+{"id": "1", "label": "F-1", "description": "", "associatedNodeID": "", "position": [-1.5, 2.25, 3.0], "orientation": [-1.0, -0.0, -0.0, -0.0, -1.0, -0.0, 0.0, 0.0, 1.0], "selected": true, "locked": false, "visibility": true, "positionStatus": "defined"},
+{"id": "2", "label": "F-2", "description": "", "associatedNodeID": "", "position": [10.0, -20.5, -0.125], "orientation": [-1.0, -0.0, -0.0, -0.0, -1.0, -0.0, 0.0, 0.0, 1.0], "selected": true, "locked": false, "visibility": true, "positionStatus": "defined"},
+{"id": "3", "label": "F-3", "description": "", "associatedNodeID": "", "position": [-100.25, -0.0, 7.75], "orientation": [-1.0, -0.0, -0.0, -0.0, -1.0, -0.0, 0.0, 0.0, 1.0], "selected": true, "locked": false, "visibility": true, "positionStatus": "defined"}
+], "measurements": []}]}
+""",
+  "b_ras.mrk.json": """{"@schema": "https://raw.githubusercontent.com/slicer/slicer/master/Modules/Loadable/Markups/Resources/Schema/markups-schema-v1.0.3.json#",
+"markups": [{"type": "Fiducial", "coordinateSystem": "RAS", "controlPoints": [
+{"id": "1", "label": "F-1", "position": [1.5, -2.25, 3.0], "positionStatus": "defined"},
+{"id": "2", "label": "F-2", "position": [-10.0, 20.5, -0.125], "positionStatus": "defined"},
+{"id": "3", "label": "F-3", "position": [100.25, 0.0, 7.75], "positionStatus": "defined"}
+]}]}
+""",
+  "c_lps.fcsv": """# Markups fiducial file version = 5.0
+# CoordinateSystem = LPS
+# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID
+1,-1.5,2.25,3,0,0,0,1,1,1,0,F-1,,
+2,10,-20.5,-0.125,0,0,0,1,1,1,0,F-2,,
+3,-100.25,0,7.75,0,0,0,1,1,1,0,F-3,,
+""",
+  "d_ras.fcsv": """# Markups fiducial file version = 4.11
+# CoordinateSystem = RAS
+# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID
+vtkMRMLMarkupsFiducialNode_0,1.5,-2.25,3,0,0,0,1,1,1,0,F-1,,
+vtkMRMLMarkupsFiducialNode_1,-10,20.5,-0.125,0,0,0,1,1,1,0,F-2,,
+vtkMRMLMarkupsFiducialNode_2,100.25,0,7.75,0,0,0,1,1,1,0,F-3,,
+""",
+  "e_legacy_lps.fcsv": """# Markups fiducial file version = 4.10
+# CoordinateSystem = 1
+# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID
+vtkMRMLMarkupsFiducialNode_0,-1.5,2.25,3,0,0,0,1,1,1,0,F-1,,
+vtkMRMLMarkupsFiducialNode_1,10,-20.5,-0.125,0,0,0,1,1,1,0,F-2,,
+vtkMRMLMarkupsFiducialNode_2,-100.25,0,7.75,0,0,0,1,1,1,0,F-3,,
+""",
+  "f_legacy_ras.fcsv": """# Markups fiducial file version = 4.10
+# CoordinateSystem = 0
+# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID
+vtkMRMLMarkupsFiducialNode_0,1.5,-2.25,3,0,0,0,1,1,1,0,F-1,,
+vtkMRMLMarkupsFiducialNode_1,-10,20.5,-0.125,0,0,0,1,1,1,0,F-2,,
+vtkMRMLMarkupsFiducialNode_2,100.25,0,7.75,0,0,0,1,1,1,0,F-3,,
+""",
+}
+
+
+class LandmarkReadingTest(unittest.TestCase):
+
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.directory = self._directory.name
+    self.addCleanup(self._directory.cleanup)
+    for fileName, text in _LANDMARK_FILES.items():
+      with open(os.path.join(self.directory, fileName), "w", encoding="utf-8") as landmarkFile:
+        landmarkFile.write(text)
+
+  def test_readLandmarkDirectory(self):
+    landmarkSet = markupsIO.readLandmarkDirectory(self.directory)
+    self.assertEqual(landmarkSet.names, sorted(_LANDMARK_FILES))
+    self.assertEqual(landmarkSet.points.dtype, np.float32)
+    for i in range(len(landmarkSet)):
+      np.testing.assert_array_equal(landmarkSet.subject(i), _LANDMARKS_RAS.astype(np.float32), err_msg=landmarkSet.names[i])
+
+  @unittest.skipIf(slicer is None, "needs Slicer")
+  def test_matchesLoadMarkups(self):
+    landmarkSet = markupsIO.readLandmarkDirectory(self.directory)
+    for i, fileName in enumerate(landmarkSet.names):
+      node = slicer.util.loadMarkups(os.path.join(self.directory, fileName))
+      try:
+        sceneXYZ = slicer.util.arrayFromMarkupsControlPoints(node)
+      finally:
+        slicer.mrmlScene.RemoveNode(node)
+      np.testing.assert_allclose(landmarkSet.subject(i), sceneXYZ, rtol=0, atol=1e-6, err_msg=fileName)
+
+
+class WorkQueueTest(unittest.TestCase):
+  # Two queues on one folder stand for two processes sharing a run.
+
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.directory = self._directory.name
+    self.addCleanup(self._directory.cleanup)
+
+  def test_doubleClaim(self):
+    first, second = WorkQueue(self.directory, owner="first"), WorkQueue(self.directory, owner="second")
+    self.assertTrue(first.claim("subject", "key"))
+    self.assertFalse(second.claim("subject", "key"))
+    self.assertFalse(first.claim("subject", "key"))
+    self.assertEqual(first.held, {"subject"})
+    self.assertEqual(second.held, set())
+
+  def test_staleClaimIsRetaken(self):
+    first, second = WorkQueue(self.directory, owner="first"), WorkQueue(self.directory, staleSeconds=60, owner="second")
+    self.assertTrue(first.claim("subject", "key"))
+    self.assertFalse(second.claim("subject", "key"))
+    claimPath = os.path.join(self.directory, "subject.claim")
+    past = time.time() - 120
+    os.utime(claimPath, (past, past))
+    self.assertTrue(second.claim("subject", "key"))
+    self.assertEqual([name for name in os.listdir(self.directory) if name.endswith(".stale")], [])
+    # refreshing keeps the new claim from going stale
+    os.utime(claimPath, (past, past))
+    second.refreshAll()
+    self.assertFalse(first.claim("subject", "key"))
+
+  def test_doneRespectsKey(self):
+    first, second = WorkQueue(self.directory, owner="first"), WorkQueue(self.directory, owner="second")
+    self.assertTrue(first.claim("subject", "old"))
+    first.complete("subject", "old")
+    self.assertEqual(first.held, set())
+    self.assertFalse(os.path.exists(os.path.join(self.directory, "subject.claim")))
+    self.assertTrue(second.isDone("subject"))
+    self.assertTrue(second.isDone("subject", "old"))
+    self.assertFalse(second.isDone("subject", "new"))
+    self.assertFalse(second.claim("subject", "old"))
+    # changed inputs: the subject is computed again
+    self.assertTrue(second.claim("subject", "new"))
+
+  def test_releaseOfClaimNotHeld(self):
+    first, second = WorkQueue(self.directory, owner="first"), WorkQueue(self.directory, owner="second")
+    self.assertTrue(first.claim("subject", "key"))
+    second.release("subject")
+    second.releaseAll()
+    self.assertTrue(os.path.exists(os.path.join(self.directory, "subject.claim")))
+    self.assertFalse(second.claim("subject", "key"))
+    first.release("subject")
+    self.assertTrue(second.claim("subject", "key"))
+
+
+class SubjectTrackerTest(unittest.TestCase):
+  # The "meshes" are only hashed and stat'ed, so any bytes will do.
+
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.addCleanup(self._directory.cleanup)
+    self.names = ["first", "second"]
+    self.meshPaths = []
+    for name in self.names:
+      self.meshPaths.append(os.path.join(self._directory.name, name + ".ply"))
+      with open(self.meshPaths[-1], "wb") as meshFile:
+        meshFile.write(name.encode())
+    self.landmarkXYZ = [np.full((3, 3), i, dtype=float) for i in range(len(self.names))]
+    self.outputLabels = np.arange(4)
+    self.pointsXYZ = [np.full((4, 3), 10.0 + i) for i in range(len(self.names))]
+
+  def _outputDirectory(self, name):
+    directory = os.path.join(self._directory.name, name)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+  def _tracker(self, outputDirectory, cache=None, queue=None):
+    return SubjectTracker(outputDirectory, "run", self.names, self.meshPaths, self.landmarkXYZ, [None, None], self.outputLabels,
+      cache=cache, queue=queue)
+
+  def _computeAll(self, tracker):
+    computed = [i for i in range(len(self.names)) if tracker.isPending(i) and tracker.claim(i)]
+    for i in computed:
+      tracker.finish(i, self.pointsXYZ[i])
+    tracker.close()
+    return computed
+
+  def test_resumeSkipsCompletedSubjects(self):
+    outputDirectory = self._outputDirectory("output")
+    self.assertEqual(self._computeAll(self._tracker(outputDirectory)), [0, 1])
+    np.testing.assert_array_equal(markupsIO.readMarkupsPoints(os.path.join(outputDirectory, "second.mrk.json")), self.pointsXYZ[1])
+    self.assertEqual(self._computeAll(self._tracker(outputDirectory)), [])
+    # changed inputs: only that subject is computed again
+    with open(self.meshPaths[1], "ab") as meshFile:
+      meshFile.write(b"changed")
+    self.assertEqual(self._computeAll(self._tracker(outputDirectory)), [1])
+
+  def test_resultCacheFillsAnotherOutputFolder(self):
+    cache = resultCache.CorrespondenceResultCache(os.path.join(self._directory.name, "cache"))
+    self._computeAll(self._tracker(self._outputDirectory("output"), cache))
+    otherDirectory = self._outputDirectory("other")
+    self.assertEqual(self._computeAll(self._tracker(otherDirectory, cache)), [])
+    self.assertEqual(cache.hits, 2)
+    np.testing.assert_array_equal(markupsIO.readMarkupsPoints(os.path.join(otherDirectory, "first.mrk.json")), self.pointsXYZ[0])
+
+  def test_distributedProcessesTakeDifferentSubjects(self):
+    outputDirectory = self._outputDirectory("output")
+    queueDirectory = os.path.join(outputDirectory, ".decal_queue")
+    first = self._tracker(outputDirectory, queue=WorkQueue(queueDirectory, owner="first"))
+    second = self._tracker(outputDirectory, queue=WorkQueue(queueDirectory, owner="second"))
+    self.assertTrue(first.isPending(0) and first.claim(0))
+    self.assertTrue(second.isPending(0))
+    self.assertFalse(second.claim(0))
+    self.assertTrue(second.isPending(1) and second.claim(1))
+    first.finish(0, self.pointsXYZ[0])
+    second.finish(1, self.pointsXYZ[1])
+    first.close()
+    second.close()
+    queue = WorkQueue(queueDirectory, owner="finalize")
+    self.assertTrue(all(queue.isDone(name) for name in self.names))
+    self.assertEqual(self._computeAll(self._tracker(outputDirectory, queue=queue)), [])
+
+
+if __name__ == "__main__":
+  unittest.main()